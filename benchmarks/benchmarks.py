@@ -0,0 +1,108 @@
+"""
+airspeed velocity (asv) benchmarks for fahmunge, run on synthetic FAH projects.
+
+Run with::
+
+    asv run
+
+or compare two commits with::
+
+    asv continuous master HEAD
+
+"""
+from __future__ import print_function, division
+import os, os.path
+import sys
+import shutil
+import tempfile
+import numpy as np
+
+from fahmunge import core21, fah, cli
+from fahmunge.tests.synthetic import create_project, write_projects_csv
+
+class ListResultPackets(object):
+    """Time listing result packets in a CLONE with a long history."""
+    params = [10, 1000]
+    param_names = ['n_packets']
+
+    def setup(self, n_packets):
+        self.tempdir = tempfile.mkdtemp()
+        self.clone_path = os.path.join(self.tempdir, 'CLONE0')
+        os.makedirs(self.clone_path)
+        # Empty packets are sufficient since only the directory listing is timed
+        for packet_index in range(n_packets):
+            os.makedirs(os.path.join(self.clone_path, 'results%d' % packet_index))
+            open(os.path.join(self.clone_path, 'results-%03d.tar.bz2' % packet_index), 'w').close()
+
+    def teardown(self, n_packets):
+        shutil.rmtree(self.tempdir)
+
+    def time_list_core21_result_packets(self, n_packets):
+        core21.list_core21_result_packets(self.clone_path)
+
+class ProcessClone(object):
+    """Time munging all result packets in a single CLONE."""
+    params = (['ws8', 'ws9'], [1000, 20000])
+    param_names = ['packet_format', 'n_atoms']
+    number = 1
+    repeat = 3
+    warmup_time = 0
+    timeout = 600
+
+    def setup(self, packet_format, n_atoms):
+        self.tempdir = tempfile.mkdtemp()
+        self.project = create_project(self.tempdir, n_runs=1, n_clones=1, n_packets=5, n_frames=50, n_atoms=n_atoms, packet_format=packet_format)
+        self.clone_path = os.path.join(self.project.location, 'RUN0', 'CLONE0')
+        self.output_filename = os.path.join(self.tempdir, 'run0-clone0.h5')
+
+    def teardown(self, packet_format, n_atoms):
+        shutil.rmtree(self.tempdir)
+
+    def time_process_core21_clone(self, packet_format, n_atoms):
+        core21.process_core21_clone(self.clone_path, self.project.pdb, self.output_filename, self.project.topology_selection)
+
+class StripWater(object):
+    """Time stripping solvent from a Core17-style all-atom trajectory."""
+    number = 1
+    repeat = 3
+    warmup_time = 0
+    timeout = 600
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        project = create_project(self.tempdir, n_runs=1, n_clones=1, n_packets=5, n_frames=50, n_atoms=20000, packet_format='ws8')
+        self.allatom_filename = os.path.join(self.tempdir, 'allatom.h5')
+        fah.concatenate_core17(os.path.join(project.location, 'RUN0', 'CLONE0'), project.pdb, self.allatom_filename)
+        self.protein_filename = os.path.join(self.tempdir, 'protein.h5')
+        self.protein_atom_indices = np.arange(2000)
+
+    def teardown(self):
+        shutil.rmtree(self.tempdir)
+
+    def time_strip_water(self):
+        fah.strip_water(self.allatom_filename, self.protein_filename, self.protein_atom_indices)
+
+class MungeIteration(object):
+    """Time a full munge-fah-data iteration over several projects in serial mode."""
+    number = 1
+    repeat = 3
+    warmup_time = 0
+    timeout = 600
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        projects = [ create_project(self.tempdir, project=project, n_runs=2, n_clones=3, n_packets=3, n_frames=20, n_atoms=3000, per_run_topology=(project % 2 == 1)) for project in [10000, 10001] ]
+        self.projects_filename = os.path.join(self.tempdir, 'projects.csv')
+        write_projects_csv(self.projects_filename, projects)
+        self.output_path = os.path.join(self.tempdir, 'munged')
+
+    def teardown(self):
+        shutil.rmtree(self.tempdir)
+
+    def time_munge_iteration(self):
+        argv = sys.argv
+        sys.argv = ['munge-fah-data', '--projects', self.projects_filename, '--outpath', self.output_path, '--maxits', '1', '--debug']
+        try:
+            cli.main()
+        finally:
+            sys.argv = argv
@@ -10,6 +10,18 @@ from __future__ import absolute_import
 from . import fah
 from . import automation
 from . import core21
+from . import statedb
+from . import metrics
+from . import profiling
+from . import report
+from . import memory
+from . import tiered
+from . import watch
+from . import quarantine
+from . import schedule
+from . import progress
+from . import validation
+from . import frameindex
 
 # versioneer
 from ._version import get_versions
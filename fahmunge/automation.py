@@ -2,12 +2,20 @@ import glob
 import os
 import mdtraj as md
 from fahmunge import fah
+from fahmunge import metrics
 import signal
 import time
 import sys
 import collections
+import re
+import threading
 from multiprocessing import Pool
 
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
 def set_signals():
     """
     Set signals so that multiprocessing processes are correctly killed.
@@ -21,6 +29,81 @@ def make_path(filename):
     except OSError:
         pass
 
+RUN_PATTERN = re.compile(r'^RUN(\d+)$')
+CLONE_PATTERN = re.compile(r'^CLONE(\d+)$')
+
+# Directories modified more recently than this (in seconds) before they were scanned are rescanned,
+# since a change within the filesystem's timestamp granularity would not change their mtime
+MTIME_GRANULARITY = 2.0
+
+# Cached project layouts: project_path : (mtime, scan_time, runs), where runs is { run : (run_path, mtime, scan_time, clones) }
+_project_layouts = dict()
+
+def _subdirectory_indices(path, pattern):
+    """
+    Return the sorted indices parsed from the names of subdirectories of path matching pattern, with a single directory scan.
+    """
+    indices = list()
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            match = pattern.match(entry.name)
+            if match and entry.is_dir():
+                indices.append(int(match.group(1)))
+    else:
+        for name in os.listdir(path):
+            match = pattern.match(name)
+            if match and os.path.isdir(os.path.join(path, name)):
+                indices.append(int(match.group(1)))
+    return sorted(indices)
+
+def _cache_is_valid(cached_mtime, scan_time, mtime):
+    return (cached_mtime == mtime) and (scan_time - mtime > MTIME_GRANULARITY)
+
+def scan_project(project_path, use_cache=True):
+    """Find the RUNs of a FAH project and the CLONEs of each RUN.
+
+    RUNs may have different numbers of CLONEs, and RUN or CLONE indices may be missing.
+    The layout is cached per project; a RUN is rescanned only when its directory mtime
+    changes (i.e. when CLONEs are added or removed), so repeated scans cost one stat per RUN.
+
+    Parameters
+    ----------
+    project_path : str
+        Path to FAH project data (containing RUN*/CLONE* directories).
+    use_cache : bool, optional, default=True
+        If False, ignore (and replace) any cached layout for this project.
+
+    Returns
+    -------
+    layout : list of (int, list of int)
+        (run, clones) for each RUN in increasing order, where clones are the CLONE indices of the RUN in increasing order
+
+    """
+    cached = _project_layouts.get(project_path) if use_cache else None
+    try:
+        mtime = os.stat(project_path).st_mtime
+    except OSError:
+        return list()
+    if cached and _cache_is_valid(cached[0], cached[1], mtime):
+        (project_scan_time, run_indices) = (cached[1], sorted(cached[2]))
+    else:
+        (project_scan_time, run_indices) = (time.time(), _subdirectory_indices(project_path, RUN_PATTERN))
+    cached_runs = cached[2] if cached else dict()
+    runs = dict()
+    for run in run_indices:
+        run_path = os.path.join(project_path, "RUN%d" % run)
+        try:
+            run_mtime = os.stat(run_path).st_mtime
+        except OSError:
+            # RUN was removed since the project was scanned
+            continue
+        entry = cached_runs.get(run)
+        if not (entry and _cache_is_valid(entry[1], entry[2], run_mtime)):
+            entry = (run_path, run_mtime, time.time(), _subdirectory_indices(run_path, CLONE_PATTERN))
+        runs[run] = entry
+    _project_layouts[project_path] = (mtime, project_scan_time, runs)
+    return [ (run, runs[run][3]) for run in sorted(runs) ]
+
 def get_num_runs_clones(path):
     """Get the number of runs and clones.
 
@@ -33,27 +116,316 @@ def get_num_runs_clones(path):
     -------
     n_runs : int
     n_clones : int
+        Total number of CLONEs in all RUNs
 
     Notes
     -----
-    Assumes each run has the same number of clones.
+    RUNs may have different numbers of CLONEs; use scan_project() for the RUN and CLONE indices.
     """
-    runs = glob.glob(os.path.join(path, "RUN*"))
-    n_runs = len(runs)
+    layout = scan_project(path)
+    return len(layout), sum(len(clones) for (run, clones) in layout)
 
-    if n_runs == 0:
-        n_clones = 0
-    else:
-        clones = glob.glob(os.path.join(path, "RUN0", "CLONE*"))
-        n_clones = len(clones)
+def parse_topology_selections(topology_selection):
+    """Parse the topology_selection field of a projects CSV file.
+
+    The field is either a single MDTraj DSL selection, or a ';'-separated list of named selections
+    of the form 'name=selection', e.g. 'no-solvent=not water; protein=protein; ca=name CA'.
+    Named selections are each written to their own subdirectory of the project output path.
+
+    Parameters
+    ----------
+    topology_selection : str
+        topology_selection field of the projects CSV file
+
+    Returns
+    -------
+    selections : list of (str, str)
+        (name, selection) pairs; name is None for a single unnamed selection
+
+    """
+    named_selection = re.compile(r'^\s*([A-Za-z0-9_.+-]+)\s*=(?![=~])\s*(.*?)\s*$')
+    items = [ item for item in topology_selection.split(';') if item.strip() ]
+    matches = [ named_selection.match(item) for item in items ]
+    if not any(matches):
+        return [ (None, topology_selection) ]
+    if not all(matches):
+        raise ValueError("topology_selection '%s' mixes named ('name=selection') and unnamed selections" % topology_selection)
+    selections = [ (match.group(1), match.group(2)) for match in matches ]
+    names = [ name for (name, selection) in selections ]
+    if len(set(names)) != len(names):
+        raise ValueError("topology_selection '%s' contains duplicate selection names" % topology_selection)
+    return selections
+
+def selection_output_paths(output_path, selections):
+    """Return the path in which munged trajectories are stored for each selection.
+
+    Parameters
+    ----------
+    output_path : str
+        Path in which munged trajectories for a project are stored.
+    selections : list of (str, str)
+        Named selections returned by parse_topology_selections().
+
+    Returns
+    -------
+    output_paths : list of str
+        output_path for an unnamed selection, or a subdirectory of output_path named for each selection
+
+    """
+    return [ output_path if (name is None) else os.path.join(output_path, "%s/" % name) for (name, selection) in selections ]
+
+def stride_output_paths(output_paths, stride):
+    """Return the paths in which strided companion trajectories are stored.
+
+    Parameters
+    ----------
+    output_paths : list of str
+        Paths in which munged trajectories are stored, one per selection.
+    stride : int
+        Stride of the companion trajectories.
+
+    Returns
+    -------
+    strided_output_paths : list of str
+        A 'stride<N>' subdirectory of each of output_paths
+
+    """
+    return [ os.path.join(output_path, "stride%d/" % stride) for output_path in output_paths ]
+
+def project_outputs(output_path, topology_selection, stride=0):
+    """Determine the munged trajectory paths, selections, and strides for a project.
+
+    Parameters
+    ----------
+    output_path : str
+        Path in which munged trajectories for the project are stored.
+    topology_selection : str
+        topology_selection field of the projects CSV file, parsed by parse_topology_selections().
+    stride : int, optional, default=0
+        If greater than 1, a companion trajectory keeping every stride-th frame is written alongside
+        the trajectory for each selection.
+
+    Returns
+    -------
+    output_paths : list of str
+        Path for each munged trajectory
+    atom_selection_strings : list of str
+        Atom selection for each munged trajectory
+    strides : list of int
+        Stride for each munged trajectory
+
+    """
+    selections = parse_topology_selections(topology_selection)
+    output_paths = selection_output_paths(output_path, selections)
+    atom_selection_strings = [ selection for (name, selection) in selections ]
+    strides = [1] * len(output_paths)
+    if stride > 1:
+        output_paths = output_paths + stride_output_paths(output_paths, stride)
+        atom_selection_strings = atom_selection_strings + atom_selection_strings
+        strides = strides + [stride] * len(strides)
+    return (output_paths, atom_selection_strings, strides)
+
+def pop_project_strides(projects):
+    """Remove the optional 'stride' column from the projects read from a projects CSV file.
+
+    Parameters
+    ----------
+    projects : pandas.DataFrame
+        Projects read from the projects CSV file; modified in place.
+
+    Returns
+    -------
+    strides : dict of project : int
+        Stride of the companion trajectories of each project; 0 or 1 if there are none
+
+    """
+    if 'stride' not in projects.columns:
+        return dict()
+    strides = projects.pop('stride').fillna(0).astype(int)
+    for (project, stride) in strides.items():
+        if stride < 0:
+            raise ValueError("Project %s: stride must be non-negative; got %d" % (project, stride))
+    return dict(strides.items())
+
+def iterate_clones(project_path, topology_filename, output_paths):
+    """Generate the CLONEs of a project along with their topology and munged trajectory filenames.
+
+    Parameters
+    ----------
+    project_path : str
+        Path to FAH project data (containing RUN*/CLONE* directories).
+    topology_filename : str
+        Topology filename, which may contain '%(run)d' to be substituted per RUN.
+    output_paths : list of str
+        Paths in which munged trajectories for this project are stored, one per selection.
+
+    Yields
+    ------
+    run : int
+    clone : int
+    clone_path : str
+        Source CLONE directory
+    pdb_filename : str
+        Topology filename after substitution
+    processed_clone_filenames : list of str
+        Munged trajectory filename in each of output_paths
+
+    """
+    for (run, clones) in scan_project(project_path):
+        for clone in clones:
+            clone_path = os.path.join(project_path, "RUN%d" % run, "CLONE%d" % clone)
+            processed_clone_filenames = [ os.path.join(output_path, "run%d-clone%d.h5" % (run, clone)) for output_path in output_paths ]
+            yield (run, clone, clone_path, topology_filename % vars(), processed_clone_filenames)
+
+def batch_clones(clones_to_process, clone_projects, max_batch_size, clone_costs=None):
+    """Group CLONEs that share a topology into batches for dispatch to workers.
+
+    CLONEs are grouped by project and topology filename (one group per RUN for projects with a
+    topology for each RUN), preserving their order. Groups larger than max_batch_size are split
+    so that a RUN with many CLONEs can still be spread across workers.
+
+    Parameters
+    ----------
+    clones_to_process : sequence of tuple
+        Work packets (clone_path, topology_filename, ...) for each CLONE
+    clone_projects : sequence
+        Project of each CLONE in clones_to_process
+    max_batch_size : int
+        Maximum number of CLONEs in a batch
+    clone_costs : sequence of float, optional, default=None
+        If specified, the predicted cost of each CLONE; batches are returned in order of decreasing total cost
 
-    return n_runs, n_clones
+    Returns
+    -------
+    batches : list of list of tuple
+        Work packets of each batch
+    batch_projects : list
+        Project of each batch
+
+    """
+    if clone_costs is None:
+        clone_costs = [ 0 ] * len(clone_projects)
+    groups = collections.OrderedDict()
+    for (project, work_args, cost) in zip(clone_projects, clones_to_process, clone_costs):
+        groups.setdefault((project, work_args[1]), list()).append((work_args, cost))
+    batches = list()
+    batch_projects = list()
+    batch_costs = list()
+    for ((project, topology_filename), group) in groups.items():
+        for start in range(0, len(group), max_batch_size):
+            batches.append([ work_args for (work_args, cost) in group[start:start+max_batch_size] ])
+            batch_projects.append(project)
+            batch_costs.append(sum(cost for (work_args, cost) in group[start:start+max_batch_size]))
+    order = sorted(range(len(batches)), key=lambda index: -batch_costs[index])
+    return ([ batches[index] for index in order ], [ batch_projects[index] for index in order ])
+
+def iterate_windows(iterable, window_size):
+    """Generate successive lists of up to window_size items from an iterable, consuming it lazily.
+
+    Parameters
+    ----------
+    iterable : iterable
+        Items, e.g. a generator of work packets
+    window_size : int
+        Maximum number of items in each list
+
+    Yields
+    ------
+    window : list
+        The next window_size (or fewer, at the end) items
+
+    """
+    window = list()
+    for item in iterable:
+        window.append(item)
+        if len(window) >= window_size:
+            yield window
+            window = list()
+    if window:
+        yield window
+
+def bounded_map(pool, func, tasks, max_outstanding, should_stop=None, wakeup=None, deadline=None):
+    """Apply func to tasks drawn lazily from an iterable using a pool, keeping at most max_outstanding in flight.
+
+    Unlike Pool.map_async() or Pool.imap(), which consume (and pickle) all tasks up front, the next
+    task is only drawn from `tasks` when a worker is about to need it, so `tasks` may be a generator
+    over a very large amount of work and the first task starts as soon as it is generated.
+
+    Parameters
+    ----------
+    pool : multiprocessing.Pool
+        Pool of workers
+    func : callable
+        Function applied to each task in a worker
+    tasks : iterable
+        Tasks, each passed as the single argument to func
+    max_outstanding : int
+        Maximum number of tasks submitted to the pool but not yet completed
+    should_stop : callable, optional, default=None
+        If specified, no further tasks are submitted once should_stop() returns True; tasks already submitted are still collected
+    wakeup : threading.Event, optional, default=None
+        If specified, an event (e.g. SignalHandler.wakeup) that is set when a task completes, so that setting it elsewhere also interrupts waiting
+    deadline : float, optional, default=None
+        If specified, a time (as returned by time.time()) at which to stop waiting and check should_stop()
+
+    Yields
+    ------
+    task : object
+        Completed task, in order of completion
+    result : object
+        Result of func(task), or None if it raised an exception
+    error : Exception
+        Exception raised by func(task), or None if it succeeded
+
+    """
+    completed = Queue()
+    wakeup = wakeup if (wakeup is not None) else threading.Event()
+    def post(item):
+        completed.put(item)
+        wakeup.set()
+    tasks = iter(tasks)
+    outstanding = 0
+    exhausted = False
+    while True:
+        stopping = should_stop() if should_stop else False
+        while not (exhausted or stopping) and (outstanding < max_outstanding):
+            try:
+                task = next(tasks)
+            except StopIteration:
+                exhausted = True
+                break
+            pool.apply_async(func, (task,), callback=lambda result, task=task: post((task, result, None)),
+                error_callback=lambda error, task=task: post((task, None, error)))
+            outstanding += 1
+        if (outstanding == 0) and (exhausted or stopping):
+            return
+        try:
+            item = completed.get_nowait()
+        except Empty:
+            # Sleep until a task completes or something else happens, or until the deadline
+            timeout = max(0.0, deadline - time.time()) if ((deadline is not None) and not stopping) else None
+            wakeup.wait(timeout)
+            wakeup.clear()
+            continue
+        outstanding -= 1
+        yield item
 
 def concatenate_core17_wrapper(kwargs):
     """
     Wrapper for using fah.concatenate_core17 in map.
+
+    Returns the record of the work done (see fahmunge.metrics.clone_statistics()), including failures.
     """
-    fah.concatenate_core17(**kwargs)
+    initial_time = time.time()
+    try:
+        return fah.concatenate_core17(**kwargs)
+    except Exception as e:
+        print("Concatenating '%s' failed: %s" % (kwargs['path'], str(e)))
+        statistics = metrics.clone_statistics()
+        statistics['failures'] = 1
+        statistics['error'] = e.__class__.__name__
+        statistics['task_seconds'] = time.time() - initial_time
+        return statistics
 
 def strip_water_wrapper(args):
     """
@@ -114,48 +486,47 @@ def merge_fah_trajectories(input_data_path, output_data_path, top_filename, npro
     nprocesses : int, optional, default=None
         If not None, use multiprocessing to parallelize up to the specified number of workers.
 
+    Returns
+    -------
+    summary : dict
+        Summary of the records returned for each RUN/CLONE (see fahmunge.metrics.IterationSummary.record())
+
     """
     MAXPACKETS = 1 # maximum number of packets to process per iteration
 
-    # Build a list of work to parallelize
-    n_runs, n_clones = get_num_runs_clones(input_data_path)
-    work = collections.deque()
-    for run in range(n_runs):
-        for clone in range(n_clones):
-            path = os.path.join(input_data_path, "RUN%d" % run, "CLONE%d" % clone)
-            out_filename = os.path.join(output_data_path, "run%d-clone%d.h5" % (run, clone))
-            kwargs = {'path' : path, 'top_filename' : top_filename % vars(), 'output_filename' : out_filename}
-            # Set maxpackets and maxtime
-            kwargs['maxpackets'] = MAXPACKETS
-            if maxtime:
-                kwargs['maxtime'] = maxtime
-            # Append work
-            work.append(kwargs)
-    print('merging %s : work has %d RUN/CLONE pairs to process' % (input_data_path, len(work)))
+    # Generate work lazily, so that workers start immediately and memory does not grow with the number of RUN/CLONE pairs
+    def iterate_work():
+        for (run, clones) in scan_project(input_data_path):
+            for clone in clones:
+                path = os.path.join(input_data_path, "RUN%d" % run, "CLONE%d" % clone)
+                out_filename = os.path.join(output_data_path, "run%d-clone%d.h5" % (run, clone))
+                kwargs = {'path' : path, 'top_filename' : top_filename % vars(), 'output_filename' : out_filename}
+                # Set maxpackets and maxtime
+                kwargs['maxpackets'] = MAXPACKETS
+                if maxtime:
+                    kwargs['maxtime'] = maxtime
+                yield kwargs
 
     print('Using %d threads' % nprocesses)
-    batchsize = 2*nprocesses
+    max_outstanding = 2*nprocesses
     maxtasksperchild = 10*nprocesses
 
     if maxtime:
         print('Starting timer. Will gracefully terminate phase after %d seconds.' % maxtime)
     initial_time = time.time()
-    timeout = False
+    def timeout():
+        return maxtime and (time.time() - initial_time > maxtime)
+    summary = metrics.IterationSummary()
     try:
         print("Creating thread pool...")
         pool = Pool(nprocesses, set_signals, maxtasksperchild=maxtasksperchild)
         print("Starting asynchronous map operations...")
-        while (len(work) > 0) and (not timeout):
-            # Queue up some work
-            work_batch = [ work.popleft() for index in range(batchsize) if (len(work) > 0) ]
-            job = pool.map_async(concatenate_core17_wrapper, work_batch)
-            while(not job.ready()):
-                time.sleep(1)
-            if maxtime:
-                elapsed_time = time.time() - initial_time
-                if elapsed_time > maxtime:
-                    timeout = True
-                    print('Elapsed time (%.1f s) exceeds timeout (%.1f s) so moving on to next project/phase.' % (elapsed_time, maxtime))
+        for (kwargs, statistics, error) in bounded_map(pool, concatenate_core17_wrapper, iterate_work(), max_outstanding, should_stop=timeout):
+            if error is not None:
+                raise error
+            summary.add(input_data_path, statistics)
+        if timeout():
+            print('Elapsed time (%.1f s) exceeds timeout (%.1f s) so moving on to next project/phase.' % (time.time() - initial_time, maxtime))
     except KeyboardInterrupt:
         print("Caught KeyboardInterrupt, safely terminating workers. This may take several minutes. Please be patient to avoid data corruption.")
         pool.close()
@@ -168,6 +539,9 @@ def merge_fah_trajectories(input_data_path, output_data_path, top_filename, npro
         pool.close()
         pool.join()
 
+    print('merging %s : %s' % (input_data_path, summary.format()))
+    return summary.record(time.time() - initial_time)
+
 def strip_water(path_to_merged_trajectories, output_path, topology_selection, min_num_frames=1, nprocesses=None, maxtime=None):
     """Strip the water for a set of trajectories.
 
@@ -241,8 +615,7 @@ def strip_water(path_to_merged_trajectories, output_path, topology_selection, mi
             # Queue up some work
             work_batch = [ work.popleft() for index in range(batchsize) if (len(work) > 0) ]
             job = pool.map_async(strip_water_wrapper, work_batch)
-            while(not job.ready()):
-                time.sleep(1)
+            job.wait()
             if maxtime:
                 elapsed_time = time.time() - initial_time
                 if elapsed_time > maxtime:
@@ -5,23 +5,107 @@ import argparse
 import sys
 import collections
 import datetime
+import tempfile
+import shutil
+import math
 import pandas as pd
-import mdtraj as md
 
 import fahmunge
 
 # Reads in a list of project details from a CSV file with Core17/18 FAH projects and munges them.
 
-def setup_worker(terminate_event, delete_on_unpack, compress_xml):
+def setup_worker(terminate_event, delete_on_unpack, compress_xml, statedb_filename=None, reconcile=False, profile_directory=None, memory_limit=None, prefetch=1, progress_queue=None):
     global global_terminate_event
     global_terminate_event = terminate_event
     global global_delete_on_unpack
     global_delete_on_unpack = delete_on_unpack
     global global_compress_xml
     global_compress_xml = compress_xml
-
-def worker(args):
-    return fahmunge.core21.process_core21_clone(*args, terminate_event=global_terminate_event, delete_on_unpack=global_delete_on_unpack, compress_xml=global_compress_xml)
+    global global_state_database
+    global_state_database = fahmunge.statedb.StateDatabase(statedb_filename) if statedb_filename else None
+    global global_reconcile
+    global_reconcile = reconcile
+    global global_profile_directory
+    global_profile_directory = profile_directory
+    global global_memory_limit
+    global_memory_limit = memory_limit
+    global global_prefetch
+    global_prefetch = prefetch
+    global global_progress_queue
+    global_progress_queue = progress_queue
+
+def process_clone(clone_path, topology_filename, processed_trajectory_filename, atom_selection_string, strides=None, state_database=None, **kwargs):
+    """
+    Process a CLONE, recording any exception in the state database before re-raising it.
+    """
+    initial_time = time.time()
+    try:
+        statistics = fahmunge.core21.process_core21_clone(clone_path, topology_filename, processed_trajectory_filename, atom_selection_string, state_database=state_database, strides=strides, **kwargs)
+        statistics['task_seconds'] = time.time() - initial_time
+        return statistics
+    except Exception as e:
+        if state_database:
+            (processed_trajectory_filenames, atom_selection_strings, strides) = fahmunge.core21.normalize_outputs(processed_trajectory_filename, atom_selection_string, strides)
+            for filename in processed_trajectory_filenames:
+                state_database.record_error(filename, clone_path, '%s: %s' % (e.__class__.__name__, str(e)))
+        raise
+
+def worker(task):
+    """
+    Process a (project, batch) task for a batch of CLONEs sharing a topology, which is read only once.
+
+    Once the worker exceeds its memory budget, the remaining CLONEs of the batch are deferred to the next
+    iteration, so that the pool replaces the worker before it takes on more work. Deferral waits until at
+    least one packet has been appended, so that every task makes progress.
+
+    Returns a list of records (see fahmunge.metrics.clone_statistics()) for the CLONEs in the batch.
+    """
+    (project, batch) = task
+    topology_cache = dict()
+    records = list()
+    for (index, args) in enumerate(batch):
+        if any(record['packets'] for record in records) and fahmunge.memory.exceeds_budget(global_memory_limit):
+            print('Worker %d exceeded memory budget (%.0f MB > %.0f MB); deferring %d CLONEs to the next iteration' % (os.getpid(), fahmunge.memory.current_rss() / 1.0e6, global_memory_limit / 1.0e6, len(batch) - index))
+            for (deferred_index, deferred_args) in enumerate(batch[index:]):
+                statistics = fahmunge.metrics.clone_statistics()
+                statistics['memory_exceeded'] = 1
+                statistics['recycles'] = 1 if (deferred_index == 0) else 0
+                if global_progress_queue is not None:
+                    global_progress_queue.put(('clone', deferred_args[0]))
+                records.append(statistics)
+            break
+        records.append(process_clone_in_worker(args, topology_cache))
+    return records
+
+def report_progress(progress_queue, clone_path):
+    """
+    Return a callback for process_core21_clone that sends progress messages (see fahmunge.progress) for a CLONE.
+    """
+    if progress_queue is None:
+        return None
+    def progress(n_frames, uncompressed_bytes):
+        progress_queue.put(('packets', clone_path, 1, n_frames, uncompressed_bytes))
+    return progress
+
+def process_clone_in_worker(args, topology_cache=None):
+    initial_time = time.time()
+    kwargs = dict(terminate_event=global_terminate_event, delete_on_unpack=global_delete_on_unpack, compress_xml=global_compress_xml, state_database=global_state_database, reconcile=global_reconcile, memory_limit=global_memory_limit, prefetch=global_prefetch, topology_cache=topology_cache,
+        progress=report_progress(global_progress_queue, args[0]))
+    try:
+        if global_profile_directory:
+            statistics = fahmunge.profiling.profile_call(global_profile_directory, process_clone, *args, **kwargs)
+        else:
+            statistics = process_clone(*args, **kwargs)
+    except Exception as e:
+        # Report the failure back to the parent process rather than losing it inside the pool
+        print("Processing CLONE '%s' failed: %s" % (args[0], str(e)))
+        statistics = fahmunge.metrics.clone_statistics()
+        statistics['failures'] = 1
+        statistics['error'] = e.__class__.__name__
+        statistics['task_seconds'] = time.time() - initial_time
+    if global_progress_queue is not None:
+        global_progress_queue.put(('clone', args[0]))
+    return statistics
 
 def main():
     description = 'Munge FAH data'
@@ -43,11 +127,49 @@ def main():
     parser.add_argument('-m', '--maxits', metavar='MAXITS', dest='maximum_iterations', action='store', type=int, default=None,
         help='Perform specified number of iterations and exist (default: no limit, process indefinitely)')
     parser.add_argument('-s', '--sleeptime', metavar='SLEEPTIME', dest='sleep_time', action='store', type=int, default=0,
-        help='Sleep for specified time (in seconds) between iterations (default: 0)')
+        help='Sleep for specified time (in seconds) after an iteration that found no new packets (default: 0)')
     parser.add_argument('-v', '--version', action='store_true', default=False,
         help='Print version information and exit')
     parser.add_argument('-c', '--compress-xml', dest='compress_xml', action='store_true', default=False,
         help='If specified, will compress XML data')
+    parser.add_argument('--statedb', metavar='STATEDB', dest='statedb_filename', action='store', type=str, default=None,
+        help='SQLite state database used to track processed packets and skip unchanged CLONEs (default: none)')
+    parser.add_argument('--reconcile-every', metavar='NITERATIONS', dest='reconcile_interval', action='store', type=int, default=10,
+        help='Reconcile the state database against the munged trajectories every NITERATIONS iterations (default: 10)')
+    parser.add_argument('--metrics-file', metavar='METRICSFILE', dest='metrics_filename', action='store', type=str, default=None,
+        help='Atomically write per-project Prometheus metrics to this node-exporter textfile (e.g. munge.prom) after each iteration')
+    parser.add_argument('--history-file', metavar='HISTORYFILE', dest='history_filename', action='store', type=str, default=None,
+        help='Append a JSON summary of each iteration (task outcomes, errors, packets, frames, bytes, and stage timings) to this JSON Lines file')
+    parser.add_argument('--profile', dest='profile', action='store_true', default=False,
+        help='Run cProfile in each worker and print a merged report at the end of each iteration')
+    parser.add_argument('--profile-dir', metavar='PROFILEDIR', dest='profile_directory', action='store', type=str, default='.',
+        help='Directory in which to write merged per-iteration profiles with --profile (default: current directory)')
+    parser.add_argument('--report', dest='report', action='store_true', default=False,
+        help='Report the pending backlog per project without munging anything, then exit')
+    parser.add_argument('--json', dest='emit_json', action='store_true', default=False,
+        help='With --report, emit the report as JSON')
+    parser.add_argument('--memory-limit', metavar='MB', dest='memory_limit', action='store', type=int, default=None,
+        help='Per-worker memory budget in MB; chunk sizes adapt to it, workers exceeding it finish their current packet and defer the rest of their task, and workers are replaced after each task unless --max-tasks-per-child is given')
+    parser.add_argument('--max-tasks-per-child', metavar='NTASKS', dest='max_tasks_per_child', action='store', type=int, default=None,
+        help='Recycle each worker process after it has processed NTASKS batches of CLONEs (default: never)')
+    parser.add_argument('--prefetch', metavar='NPACKETS', dest='prefetch', action='store', type=int, default=1,
+        help='Number of result packets each worker unpacks in a background thread ahead of the packet being written; 0 disables (default: 1)')
+    parser.add_argument('--batch-size', metavar='NCLONES', dest='batch_size', action='store', type=int, default=None,
+        help='Maximum number of CLONEs sharing a topology to dispatch to a worker at once (default: enough batches for 4 per process)')
+    parser.add_argument('--window-size', metavar='NCLONES', dest='window_size', action='store', type=int, default=1000,
+        help='Number of CLONEs discovered, scheduled, and batched at a time while earlier CLONEs are processed, bounding the memory used by the work list (default: 1000)')
+    parser.add_argument('--decoders', metavar='NDECODERS', dest='ndecoders', action='store', type=int, default=0,
+        help='Unpack and decode result packets in a separate pool of NDECODERS processes, leaving NPROCESSES processes to write munged trajectories (default: 0, each process handles whole CLONEs)')
+    parser.add_argument('--watch', dest='watch', action='store_true', default=False,
+        help='Watch project directories with inotify, starting an iteration as soon as new result packets arrive and examining only the CLONEs that received them')
+    parser.add_argument('--full-scan-every', metavar='SECONDS', dest='full_scan_interval', action='store', type=int, default=3600,
+        help='With --watch, scan all CLONEs at least this often to catch missed events (default: 3600)')
+    parser.add_argument('--progress-every', metavar='SECONDS', dest='progress_interval', action='store', type=int, default=60,
+        help='Print a progress line (completed CLONEs, frames/s, MB/s decompressed, ETA) every SECONDS seconds while CLONEs are processed (default: 60)')
+    parser.add_argument('--status-file', metavar='STATUSFILE', dest='status_filename', action='store', type=str, default=None,
+        help='Atomically rewrite this JSON file with the progress of the current iteration, including per-project completion, along with each progress line')
+    parser.add_argument('--retry-backoff', metavar='SECONDS', dest='retry_backoff', action='store', type=int, default=600,
+        help='Quarantine a CLONE whose processing fails for SECONDS, doubling with each consecutive failure, before retrying it; 0 retries every iteration (default: 600)')
     args = parser.parse_args()
 
     if args.version:
@@ -67,43 +189,72 @@ def main():
         print('ERROR: nprocesses must be positive\n\n')
         parser.print_help()
         sys.exit(1)
+    if (args.memory_limit is not None) and (args.memory_limit <= 0):
+        print('ERROR: memory-limit must be positive\n\n')
+        parser.print_help()
+        sys.exit(1)
+    if (args.max_tasks_per_child is not None) and (args.max_tasks_per_child <= 0):
+        print('ERROR: max-tasks-per-child must be positive\n\n')
+        parser.print_help()
+        sys.exit(1)
+    if args.prefetch < 0:
+        print('ERROR: prefetch must be non-negative\n\n')
+        parser.print_help()
+        sys.exit(1)
+    if (args.batch_size is not None) and (args.batch_size <= 0):
+        print('ERROR: batch-size must be positive\n\n')
+        parser.print_help()
+        sys.exit(1)
+    if args.window_size <= 0:
+        print('ERROR: window-size must be positive\n\n')
+        parser.print_help()
+        sys.exit(1)
+    if args.ndecoders < 0:
+        print('ERROR: decoders must be non-negative\n\n')
+        parser.print_help()
+        sys.exit(1)
+    if args.ndecoders and not fahmunge.tiered.shared_memory_available():
+        print('ERROR: decoders requires multiprocessing.shared_memory (Python 3.8 or later)\n\n')
+        parser.print_help()
+        sys.exit(1)
+    if args.ndecoders and args.profile:
+        print('ERROR: profile is not supported with decoders\n\n')
+        parser.print_help()
+        sys.exit(1)
+    if args.reconcile_interval <= 0:
+        print('ERROR: reconcile-every must be positive\n\n')
+        parser.print_help()
+        sys.exit(1)
+    if args.full_scan_interval <= 0:
+        print('ERROR: full-scan-every must be positive\n\n')
+        parser.print_help()
+        sys.exit(1)
+    if args.progress_interval <= 0:
+        print('ERROR: progress-every must be positive\n\n')
+        parser.print_help()
+        sys.exit(1)
+    if args.retry_backoff < 0:
+        print('ERROR: retry-backoff must be non-negative\n\n')
+        parser.print_help()
+        sys.exit(1)
 
     # Read project tuples
     projects = pd.read_csv(args.projectfile, index_col=0)
+    # An optional 'stride' column requests strided companion trajectories
+    project_strides = fahmunge.automation.pop_project_strides(projects)
+
+    # Report the backlog without munging if requested
+    if args.report:
+        state_database = fahmunge.statedb.StateDatabase(args.statedb_filename) if args.statedb_filename else None
+        fahmunge.report.report_backlog(projects, args.output_path, state_database=state_database, nprocesses=args.nprocesses, emit_json=args.emit_json, strides=project_strides)
+        return
 
     # Check that all locations and PDB files exist, raising an exception if they do not (indicating misconfiguration)
-    # TODO: Parallelize validation by entry?
+    # Entries are validated in parallel, and validated topologies are cached by file hash and selection
     print('Validating contents of project CSV file...')
-    for (project, location, pdb, topology_selection) in projects.itertuples():
-        # Check project path exists.
-        if not os.path.exists(location):
-            raise Exception("Project %s: Cannot find data path '%s'. Check that you specified the correct location." % (project, location))
-        # Check PDB file(s) exist
-        # TODO: Check atom counts match?
-        # TODO: Generalize with a generator for iterating over all RUN/CLONEs?
-        n_runs, n_clones = fahmunge.automation.get_num_runs_clones(location)
-        print("Project %s: %d RUNs %d CLONEs found; topology_selection = '%s'" % (project, n_runs, n_clones, topology_selection))
-        if '%' in pdb:
-            # perform filename substitution on all RUNs
-            pdb_filenames_to_check = list()
-            for run in range(n_runs):
-                pdb_filename = pdb % vars()
-                pdb_filenames_to_check.append(pdb_filename)
-        else:
-            pdb_filenames_to_check = [ pdb ] # just one filename
-        for pdb_filename in pdb_filenames_to_check:
-            if not os.path.exists(pdb_filename):
-                raise Exception("Project %s: PDB filename specified as '%s' but '%s' was not found. Check that you specified the correct path and PDB files are present." % (project, pdb, pdb_filename))
-            if args.validate_topology_selection:
-                # Check toplogy selection is valid.
-                # TODO: Report on original and stripped atom numbers
-                traj = md.load(pdb_filename)
-                original_topology = traj.top
-                indices = original_topology.select(topology_selection)
-                print("  %s : %d atoms; selection '%s' has %d atoms" % (pdb_filename, original_topology.n_atoms, topology_selection, len(indices)))
-                if len(indices)==0:
-                    raise Exception("topology_selection '%s' matches zero atoms!" % topology_selection)
-                del traj, original_topology, indices
+    validation_cache_filename = os.path.join(args.output_path, 'validation-cache.json')
+    fahmunge.automation.make_path(validation_cache_filename)
+    fahmunge.validation.validate_projects(projects, nprocesses=args.nprocesses, validate_topology_selection=args.validate_topology_selection, cache_filename=validation_cache_filename)
     print('All specified paths and PDB files found.')
     print('')
 
@@ -113,101 +264,274 @@ def main():
     if args.time_limit:
         print('Will run for %s seconds and terminate' % args.time_limit)
     if args.sleep_time:
-        print('Will sleep for %s seconds between iterations' % args.sleep_time)
+        print('Will sleep for %s seconds after iterations that find no new packets' % args.sleep_time)
+    if args.statedb_filename:
+        print("Tracking progress in state database '%s'; reconciling every %d iterations" % (args.statedb_filename, args.reconcile_interval))
+    if args.metrics_filename:
+        print("Writing metrics to '%s' after each iteration" % args.metrics_filename)
+    if args.history_filename:
+        print("Appending iteration summaries to '%s'" % args.history_filename)
+    if args.memory_limit:
+        print('Limiting each worker to %d MB of memory' % args.memory_limit)
+    memory_limit = args.memory_limit * 1000000 if args.memory_limit else None
+    if args.profile:
+        print("Profiling workers; merged profiles will be written to '%s'" % args.profile_directory)
     print('')
 
+    # Open state database
+    state_database = fahmunge.statedb.StateDatabase(args.statedb_filename) if args.statedb_filename else None
+
+    # Accumulate throughput metrics
+    metrics = fahmunge.metrics.Metrics()
+
+    # Keep CLONEs that fail repeatedly from being retried on every iteration
+    quarantine = None
+    if args.retry_backoff:
+        fahmunge.automation.make_path(args.output_path)
+        quarantine = fahmunge.quarantine.Quarantine(os.path.join(args.output_path, 'quarantine.json'), args.retry_backoff)
+        if len(quarantine):
+            print('%d CLONEs are quarantined after failures' % len(quarantine))
+
     # Set signal handling
     signal_handler = fahmunge.core21.SignalHandler()
 
+    # Watch for new result packets
+    watcher = None
+    if args.watch:
+        try:
+            watcher = fahmunge.watch.ProjectWatcher([ project_path for (project, project_path, topology_filename, topology_selection) in projects.itertuples() ], wakeup=signal_handler.wakeup)
+            print('Watching %d directories for new result packets; scanning all CLONEs every %d seconds' % (watcher.n_watches, args.full_scan_interval))
+        except OSError as e:
+            print('Cannot watch for new result packets (%s); scanning all CLONEs every iteration' % str(e))
+        print('')
+    last_full_scan = None
+    examined_clones = set() # CLONEs examined in the previous iteration, which may still have work
+
     # Main processing loop
     iteration = 0
     terminate = False # if True, terminate
     initial_time = time.time()
     while(not terminate):
-        # Assemble list of CLONEs to process
+        iteration_initial_time = time.time()
+        # Decide which CLONEs to examine
         print('----------' * 8)
-        print('Iteration %8d : Assembling list of CLONEs to process...' % iteration)
+        print('Iteration %8d : Preparing to find CLONEs to process...' % iteration)
         print(datetime.datetime.now().isoformat())
         print('----------' * 8)
-        clones_to_process = collections.deque()
-        for (project, project_path, topology_filename, topology_selection) in projects.itertuples():
-
-            print('Project %s' % project)
-            print("  location: '%s'" % project_path)
-            print("  reference topology file: '%s'" % topology_filename)
-            print("  topology selection: '%s'" % topology_selection)
-
-            # Form output path
-            output_path = os.path.join(args.output_path, "%s/" % project)
-
-            # Make sure output path exists
-            fahmunge.automation.make_path(output_path)
-
-            # Determine number of RUNs and CLONEs
-            n_runs, n_clones = fahmunge.automation.get_num_runs_clones(project_path)
-
-            # Compile CLONEs to process
-            for run in range(n_runs):
-                for clone in range(n_clones):
-                    # Get clone source and destination paths
-                    clone_path = os.path.join(project_path, "RUN%d" % run, "CLONE%d" % clone)
-                    processed_clone_filename = os.path.join(output_path, "run%d-clone%d.h5" % (run, clone))
-                    # Form work packet
-                    work_args = (clone_path, topology_filename % vars(), processed_clone_filename, topology_selection)
-                    # Append work packet
-                    clones_to_process.append(work_args)
-
-            # Terminate if instructed
-            if signal_handler.terminate:
-                print('Signal caught; terminating.')
-                exit(1)
-
-        print('There are %d CLONEs to process' % len(clones_to_process))
+        # Periodically ignore the state database and reconcile it against the munged trajectories
+        reconcile = (iteration % args.reconcile_interval == 0)
+        if state_database:
+            clone_states = dict() if reconcile else state_database.clone_states()
+            if reconcile:
+                print('Reconciling state database with munged trajectories this iteration')
+        # With --watch, examine only CLONEs that received new packets (or may still have work) between full scans
+        watched_clones = None
+        unsettled_clones = set()
+        if watcher:
+            (changed_clones, missed_events) = watcher.collect()
+            # CLONEs whose new packets are still being written are examined once they settle
+            unsettled_clones = watcher.unsettled_clones()
+            if missed_events or (last_full_scan is None) or (time.time() - last_full_scan >= args.full_scan_interval):
+                print('Scanning all CLONEs this iteration')
+                last_full_scan = time.time()
+            else:
+                watched_clones = changed_clones | examined_clones
+                if quarantine is not None:
+                    watched_clones |= set(os.path.normpath(clone_path) for clone_path in quarantine.due_for_retry())
+                print('Examining %d CLONEs that received new result packets' % len(watched_clones))
         print('----------' * 8)
         print('')
 
         # Munge data in parallel
         print('----------' * 8)
-        print('Iteration %8d : Processing %d CLONEs...' % (iteration, len(clones_to_process)))
+        print('Iteration %8d : Processing CLONEs as they are found...' % iteration)
         print(datetime.datetime.now().isoformat())
+        processing_initial_time = time.time()
+        summary = fahmunge.metrics.IterationSummary(iteration)
+        (iteration_statistics, project_statistics) = (summary.totals, summary.projects)
+        profile_directory = tempfile.mkdtemp(prefix='fahmunge-profile-') if args.profile else None
+        progress = fahmunge.progress.Progress(iteration, interval=args.progress_interval, status_filename=args.status_filename)
+        progress.start()
+        def record_clone(project, clone_path, statistics):
+            metrics.add_clone(project, statistics)
+            summary.add(project, statistics)
+            if quarantine is not None:
+                quarantine.record(clone_path, statistics)
+
+        # The work list is generated lazily, so that munging starts as soon as the first CLONEs are found
+        # and the memory it uses does not grow with the number of RUNs and CLONEs
+        discovery = collections.Counter() # numbers of CLONEs found to process, skipped, and deferred
+        if watcher:
+            examined_clones = set()
+        def iterate_work():
+            """
+            Generate (project, work_args) for each CLONE to process this iteration.
+            """
+            for (project, project_path, topology_filename, topology_selection) in projects.itertuples():
+
+                print('Project %s' % project)
+                print("  location: '%s'" % project_path)
+                print("  reference topology file: '%s'" % topology_filename)
+                print("  topology selection: '%s'" % topology_selection)
+
+                # Form output paths, one for each named selection and strided companion
+                output_path = os.path.join(args.output_path, "%s/" % project)
+                (output_paths, atom_selection_strings, strides) = fahmunge.automation.project_outputs(output_path, topology_selection, project_strides.get(project, 0))
+                if len(set(strides)) > 1:
+                    print("  strided companion trajectories: every %d frames" % max(strides))
+
+                # Make sure output paths exist
+                for path in output_paths:
+                    fahmunge.automation.make_path(path)
+
+                # Find CLONEs to process
+                n_project_clones = 0
+                for (run, clone, clone_path, pdb_filename, processed_clone_filenames) in fahmunge.automation.iterate_clones(project_path, topology_filename, output_paths):
+                    if (watched_clones is not None) and (os.path.normpath(clone_path) not in watched_clones):
+                        continue
+                    if os.path.normpath(clone_path) in unsettled_clones:
+                        discovery['settling'] += 1
+                        continue
+                    # Skip CLONEs quarantined after failing until their backoff expires
+                    if (quarantine is not None) and quarantine.is_quarantined(clone_path):
+                        discovery['quarantined'] += 1
+                        continue
+                    # Skip CLONEs the state database shows are unchanged since they were last processed
+                    if state_database and all(fahmunge.statedb.clone_is_unchanged(clone_states, clone_path, filename) for filename in processed_clone_filenames):
+                        discovery['unchanged'] += 1
+                        continue
+                    n_project_clones += 1
+                    if watcher:
+                        examined_clones.add(os.path.normpath(clone_path))
+                    # Form work packet
+                    yield (project, (clone_path, pdb_filename, processed_clone_filenames, atom_selection_strings, strides))
+
+                metrics.set_backlog(project, n_project_clones)
+                discovery['clones'] += n_project_clones
+
+                # Stop looking for work if instructed
+                if signal_handler.terminate:
+                    return
+
+            progress.finish_discovery()
+            print('Found all %d CLONEs to process' % discovery['clones'])
+
+        def iterate_scheduled_windows():
+            """
+            Generate (window_clones, window_projects, clone_costs) for successive windows of up to --window-size CLONEs.
+            """
+            nworkers = 1 if args.debug else (args.nprocesses + args.ndecoders)
+            # Times at which workers are predicted to finish the CLONEs admitted from earlier windows
+            worker_free_times = [ 0.0 ] * nworkers
+            for window in fahmunge.automation.iterate_windows(iterate_work(), args.window_size):
+                window_projects = [ project for (project, work_args) in window ]
+                window_clones = [ work_args for (project, work_args) in window ]
+                clone_costs = None
+                # Start the most expensive CLONEs first, estimating costs from their pending packets and recent throughput,
+                # and defer CLONEs that are not predicted to make progress before the time limit
+                if state_database or args.time_limit:
+                    throughputs = dict((project, fahmunge.schedule.learned_throughput(project, state_database=state_database, metrics=metrics)) for project in set(window_projects))
+                    packet_costs = [ fahmunge.schedule.pending_packet_sizes(work_args[0], work_args[2], state_database=state_database) for work_args in window_clones ]
+                    remaining = None
+                    if all(throughputs.values()):
+                        packet_costs = [ [ nbytes / throughputs[project] for nbytes in sizes ] for (project, sizes) in zip(window_projects, packet_costs) ]
+                        if args.time_limit:
+                            remaining = initial_time + args.time_limit - time.time()
+                    now = time.time()
+                    free = [ max(free_time - now, 0.0) for free_time in worker_free_times ]
+                    (admitted, deferred) = fahmunge.schedule.plan_schedule(packet_costs, nworkers, remaining, free=free)
+                    worker_free_times = [ now + free_time for free_time in free ]
+                    discovery['deferred'] += len(deferred)
+                    window_clones = [ window_clones[index] for index in admitted ]
+                    window_projects = [ window_projects[index] for index in admitted ]
+                    clone_costs = [ sum(packet_costs[index]) for index in admitted ]
+                for (index, work_args) in enumerate(window_clones):
+                    progress.add(work_args[0], window_projects[index], clone_costs[index] if clone_costs else None)
+                yield (window_clones, window_projects, clone_costs)
 
         if args.debug:
             print('Using serial debug mode')
             print('----------' * 8)
-            for packed_args in clones_to_process:
-                fahmunge.core21.process_core21_clone(*packed_args, delete_on_unpack=args.delete_on_unpack, compress_xml=args.compress_xml, signal_handler=signal_handler)
-                # Terminate if instructed
-                if signal_handler.terminate:
-                    print('Signal caught; terminating.')
-                    exit(1)
+            topology_cache = dict()
+            for (window_clones, window_projects, clone_costs) in iterate_scheduled_windows():
+                for (project, packed_args) in zip(window_projects, window_clones):
+                    kwargs = dict(delete_on_unpack=args.delete_on_unpack, compress_xml=args.compress_xml, signal_handler=signal_handler, state_database=state_database, reconcile=reconcile, memory_limit=memory_limit, prefetch=args.prefetch, topology_cache=topology_cache,
+                        progress=report_progress(progress.queue, packed_args[0]))
+                    if profile_directory:
+                        statistics = fahmunge.profiling.profile_call(profile_directory, process_clone, *packed_args, **kwargs)
+                    else:
+                        statistics = process_clone(*packed_args, **kwargs)
+                    record_clone(project, packed_args[0], statistics)
+                    progress.queue.put(('clone', packed_args[0]))
+                    # Terminate if instructed
+                    if signal_handler.terminate:
+                        print('Signal caught; terminating.')
+                        exit(1)
+        elif args.ndecoders:
+            print('Using %d decoder processes and %d writer processes' % (args.ndecoders, args.nprocesses))
+            print('----------' * 8)
+            def should_terminate():
+                elapsed_time = time.time() - initial_time
+                return signal_handler.terminate or (args.time_limit and (elapsed_time > args.time_limit))
+            for (window_clones, window_projects, clone_costs) in iterate_scheduled_windows():
+                clone_statistics = fahmunge.tiered.munge_clones(window_clones, window_projects, args.nprocesses, args.ndecoders,
+                    statedb_filename=args.statedb_filename, reconcile=reconcile, delete_on_unpack=args.delete_on_unpack, compress_xml=args.compress_xml,
+                    should_terminate=should_terminate, wakeup=signal_handler.wakeup, deadline=(initial_time + args.time_limit) if args.time_limit else None, progress=progress.queue.put)
+                for (project, work_args, statistics) in zip(window_projects, window_clones, clone_statistics):
+                    record_clone(project, work_args[0], statistics)
+                if should_terminate():
+                    break
+            if signal_handler.terminate:
+                print('Signal caught; terminating.')
+                terminate = True
         else:
             # Settings for thread processing
             print('Using %d threads' % args.nprocesses)
             print('----------' * 8)
             from multiprocessing import Pool, Event
+            def iterate_batches():
+                """
+                Generate (project, batch) for each batch of CLONEs to dispatch to a worker.
+                """
+                for (window_clones, window_projects, clone_costs) in iterate_scheduled_windows():
+                    # Group CLONEs sharing a topology so that it is read once per batch, splitting large groups to balance load
+                    max_batch_size = args.batch_size or max(1, int(math.ceil(len(window_clones) / (4.0 * args.nprocesses))))
+                    (batches, batch_projects) = fahmunge.automation.batch_clones(window_clones, window_projects, max_batch_size, clone_costs)
+                    for (project, batch) in zip(batch_projects, batches):
+                        yield (project, batch)
             print("Creating thread pool of %d threads..." % args.nprocesses)
             terminate_event = Event()
-            pool = Pool(args.nprocesses, setup_worker, (terminate_event, args.delete_on_unpack, args.compress_xml))
+            # With a memory budget, replace each worker after its task so that memory it accumulated is returned
+            max_tasks_per_child = args.max_tasks_per_child or (1 if memory_limit else None)
+            pool = Pool(args.nprocesses, setup_worker, (terminate_event, args.delete_on_unpack, args.compress_xml, args.statedb_filename, reconcile, profile_directory, memory_limit, args.prefetch, progress.queue), maxtasksperchild=max_tasks_per_child)
 
-
-            try:
-                print("Starting asynchronous map operations...")
-                job = pool.map_async(worker, clones_to_process, chunksize=1)
-
-                sleep_interval = 5 # seconds between polling of multiprocessing pool
-                while( (not job.ready()) and (not terminate_event.is_set()) ):
-                    time.sleep(sleep_interval)
+            def should_stop():
+                if not terminate_event.is_set():
                     # Terminate if maximum time has elapsed.
                     elapsed_time = time.time() - initial_time
                     if args.time_limit and (elapsed_time > args.time_limit):
                         print('Elapsed time (%.1f s) exceeds timeout (%.1f s); signaling jobs to terminate.' % (elapsed_time, args.time_limit))
                         terminate_event.set()
-                        terminate = True
                     # Terminate if a signal has been caught
                     if signal_handler.terminate:
                         print('Signal caught; terminating.')
                         terminate_event.set()
-                        terminate = True
+                return terminate_event.is_set()
+
+            try:
+                # Keep up to two batches queued per worker, drawing more from the work list as batches complete
+                max_outstanding = 2 * args.nprocesses
+                print("Starting asynchronous dispatch of batches of CLONEs, with up to %d batches outstanding..." % max_outstanding)
+                for ((project, batch), batch_statistics, error) in fahmunge.automation.bounded_map(pool, worker, iterate_batches(), max_outstanding,
+                    should_stop=should_stop, wakeup=signal_handler.wakeup, deadline=(initial_time + args.time_limit) if args.time_limit else None):
+                    # Accumulate statistics returned by workers
+                    if error is not None:
+                        print('Processing a batch of %d CLONEs of project %s failed: %s' % (len(batch), project, str(error)))
+                        continue
+                    for (work_args, statistics) in zip(batch, batch_statistics):
+                        record_clone(project, work_args[0], statistics)
+                if terminate_event.is_set():
+                    terminate = True
 
             except KeyboardInterrupt:
                 print("Caught KeyboardInterrupt, safely terminating workers. This may take several minutes. Please be patient to avoid data corruption.")
@@ -229,8 +553,44 @@ def main():
                 pool.close()
                 pool.join()
 
+        # Report CLONEs that were skipped or deferred
+        if state_database:
+            print('Skipped %d CLONEs unchanged since they were last processed' % discovery['unchanged'])
+        if discovery['quarantined']:
+            print('Skipped %d quarantined CLONEs' % discovery['quarantined'])
+        if discovery['settling']:
+            print('Skipped %d CLONEs whose new result packets are still being written' % discovery['settling'])
+        if discovery['deferred']:
+            print('Deferred %d CLONEs that were not predicted to make progress before the time limit' % discovery['deferred'])
+
+        # Report final progress
+        progress.stop()
+        print(progress.format())
+
+        # Summarize where time was spent
+        nprocesses = 1 if args.debug else (args.nprocesses + args.ndecoders)
+        fahmunge.profiling.print_stage_summary(iteration_statistics, time.time() - processing_initial_time, nprocesses)
+        if profile_directory:
+            fahmunge.profiling.merge_profiles(profile_directory, os.path.join(args.profile_directory, 'profile-iteration%d.prof' % iteration))
+            shutil.rmtree(profile_directory, ignore_errors=True)
+
+        if quarantine is not None:
+            quarantine.save()
+
+        # Record throughput so that --report can estimate processing time
+        if state_database:
+            for (project, statistics) in project_statistics.items():
+                state_database.record_throughput(project, statistics['input_bytes'], statistics['task_seconds'])
+
         # Report completion of iteration
-        print('Finished iteration %d.' % iteration)
+        print('Finished iteration %d: %s' % (iteration, summary.format()))
+        if args.history_filename:
+            fahmunge.metrics.append_history(args.history_filename, summary.record(time.time() - iteration_initial_time))
+
+        # Export metrics
+        metrics.finish_iteration(time.time() - iteration_initial_time)
+        if args.metrics_filename:
+            metrics.write_textfile(args.metrics_filename)
 
         # Increment iteration counter
         iteration += 1
@@ -249,9 +609,44 @@ def main():
         if terminate:
             return
 
-        # Sleep
-        print("Sleeping for %d seconds." % (args.sleep_time))
-        time.sleep(args.sleep_time)
+        # Start the next iteration immediately if this one found work; otherwise back off,
+        # waking early if a signal is caught or the time limit is reached
+        signal_handler.wakeup.clear()
+        if signal_handler.terminate:
+            print('Signal caught; terminating.')
+            return
+        if iteration_statistics['packets'] > 0:
+            print('Processed %d packets; starting next iteration immediately.' % iteration_statistics['packets'])
+        elif watcher:
+            examined_clones = set()
+            wait_until = last_full_scan + args.full_scan_interval
+            if args.time_limit:
+                wait_until = min(wait_until, initial_time + args.time_limit)
+            print('No new packets; waiting up to %d seconds for new result packets.' % max(0.0, wait_until - time.time()))
+            while not (watcher.has_changes() or signal_handler.terminate) and (time.time() < wait_until):
+                signal_handler.wakeup.wait(wait_until - time.time())
+                signal_handler.wakeup.clear()
+            if signal_handler.terminate:
+                print('Signal caught; terminating.')
+                return
+            # Wait until new packets have not been written to for a while, so that they are complete
+            settle_time = watcher.settle_time()
+            while (settle_time is not None) and (time.time() < settle_time) and not signal_handler.terminate:
+                signal_handler.wakeup.wait(settle_time - time.time())
+                signal_handler.wakeup.clear()
+                settle_time = watcher.settle_time()
+            if signal_handler.terminate:
+                print('Signal caught; terminating.')
+                return
+        elif args.sleep_time:
+            sleep_time = args.sleep_time
+            if args.time_limit:
+                sleep_time = min(sleep_time, max(0.0, initial_time + args.time_limit - time.time()))
+            print("No new packets; sleeping for %d seconds." % sleep_time)
+            signal_handler.wakeup.wait(sleep_time)
+            if signal_handler.terminate:
+                print('Signal caught; terminating.')
+                return
 
         # If time limit has elapsed, terminate
         elapsed_time = time.time() - initial_time
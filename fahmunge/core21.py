@@ -11,9 +11,11 @@ import os, os.path
 import glob
 import tarfile
 from mdtraj.formats.hdf5 import HDF5TrajectoryFile
+from mdtraj.formats import XTCTrajectoryFile
+from mdtraj.utils import box_vectors_to_lengths_and_angles
 import mdtraj as md
+import numpy as np
 import tables
-from mdtraj.utils.contextmanagers import enter_temp_directory
 from mdtraj.utils import six
 from natsort import natsorted
 import subprocess
@@ -24,6 +26,22 @@ import time
 import copy
 import sys
 import re
+import struct
+import hashlib
+import threading
+import contextlib
+try:
+    from shutil import which as find_executable
+except ImportError:
+    from distutils.spawn import find_executable # Python 2
+try:
+    import queue
+except ImportError:
+    import Queue as queue # Python 2
+from fahmunge.metrics import clone_statistics
+from fahmunge.profiling import StageTimer
+from fahmunge.memory import current_rss, adaptive_chunksize
+from fahmunge import frameindex
 
 ################################################################################
 # ws9 core21 support
@@ -32,16 +50,24 @@ import re
 import signal
 import time
 
+MAX_FILEPATH_LENGTH = 1024 # MAXIMUM FILEPATH LENGTH; this may be too short for some installations
+
 class SignalHandler:
     """
+    Catch SIGINT and SIGTERM so that processing can stop at a safe point.
+
+    `terminate` becomes True once a signal is caught. `wakeup` is a threading.Event that is also set,
+    so that a process waiting on it for other events (e.g. task completion) reacts immediately.
     """
     terminate = False
     def __init__(self):
+        self.wakeup = threading.Event()
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
 
     def exit_gracefully(self, signum, frame):
         self.terminate = True
+        self.wakeup.set()
 
 def list_core21_result_packets(clone_path):
     """
@@ -85,17 +111,272 @@ def list_core21_result_packets(clone_path):
 
     return result_packets
 
-def ensure_result_packet_is_decompressed(result_packet, topology, atom_indices=None, chunksize=10, delete_on_unpack=False, compress_xml=False):
+def result_packet_is_processed(result_packet, processed_packets):
+    """
+    Determine whether a result packet appears in a set of processed packets.
+
+    Compressed ws8 packets are recorded under the name of the directory they are unpacked into.
+
+    Parameters
+    ----------
+    result_packet : str
+        Path to result packet, either a tarball (ws7/8) or a directory (ws9)
+    processed_packets : set of str
+        Result packets that have already been processed
+
+    Returns
+    -------
+    processed : bool
+        True if the result packet has already been processed
+
+    """
+    if result_packet in processed_packets:
+        return True
+    (basepath, filename) = os.path.split(result_packet)
+    match = re.match(r'results-(\d+).tar.bz2', filename)
+    if match:
+        return os.path.join(basepath, 'results%d' % int(match.group(1))) in processed_packets
+    return False
+
+def result_packet_size(result_packet):
+    """
+    Determine the size of a result packet as read from the work server.
+
+    Parameters
+    ----------
+    result_packet : str
+        Path to result packet, either a tarball (ws7/8) or a directory (ws9)
+
+    Returns
+    -------
+    nbytes : int
+        Size of the compressed archive, or of positions.xtc for an uncompressed packet (0 if missing)
+
+    """
+    if os.path.isdir(result_packet):
+        result_packet = os.path.join(result_packet, 'positions.xtc')
+    try:
+        return os.path.getsize(result_packet)
+    except OSError:
+        return 0
+
+def read_processed_packets(processed_trajectory_filename):
+    """
+    Read the list of processed result packets from a munged trajectory without modifying it.
+
+    Parameters
+    ----------
+    processed_trajectory_filename : str
+        Path to munged trajectory
+
+    Returns
+    -------
+    processed_packets : set of str
+        Result packets recorded in the trajectory; empty if the trajectory is missing or unreadable
+
+    """
+    if not os.path.exists(processed_trajectory_filename):
+        return set()
+    try:
+        with tables.open_file(processed_trajectory_filename, mode='r') as handle:
+            return set(folder.decode() if isinstance(folder, bytes) else folder for folder in handle.root.processed_folders)
+    except Exception:
+        return set()
+
+def pending_result_packets(clone_path, processed_trajectory_filenames, state_database=None):
+    """
+    List the result packets of a CLONE that have not yet been appended to every munged trajectory, without modifying anything.
+
+    Parameters
+    ----------
+    clone_path : str
+        Path to CLONE directory containing ws8/ws9 WUs
+    processed_trajectory_filenames : list of str
+        Munged trajectories of the CLONE, one per named selection and stride
+    state_database : fahmunge.statedb.StateDatabase, optional, default=None
+        If specified, the processed-packet ledger is read from here rather than the munged trajectories
+
+    Returns
+    -------
+    pending_packets : list of str
+        Result packets that are pending in any munged trajectory, in order of increasing FRAME number
+
+    """
+    if not os.path.isdir(clone_path):
+        return list()
+    result_packets = list_core21_result_packets(clone_path)
+    if len(result_packets) == 0:
+        return list()
+    processed_packets = list()
+    for filename in processed_trajectory_filenames:
+        if state_database and os.path.exists(filename):
+            processed_packets.append(state_database.processed_packets(filename))
+        else:
+            processed_packets.append(read_processed_packets(filename))
+    return [ result_packet for result_packet in result_packets if not all(result_packet_is_processed(result_packet, packets) for packets in processed_packets) ]
+
+def extract_bz2_archive(filename, path):
+    """
+    Extract a .tar.bz2 archive.
+
+    If a bzip2 executable is available, decompression runs in a separate process that streams into the
+    tar extractor, so it does not hold the interpreter lock and can overlap with work in other threads.
+    Otherwise, the archive is decompressed with the bz2 module.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the archive
+    path : str
+        Directory into which the archive contents are extracted
+
+    """
+    bzip2 = find_executable('lbzip2') or find_executable('bzip2')
+    if bzip2 is None:
+        with tarfile.open(filename, mode='r:bz2') as archive:
+            archive.extractall(path=path)
+        return
+
+    process = subprocess.Popen([bzip2, '-dc', filename], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=process.stdout, mode='r|') as archive:
+            archive.extractall(path=path)
+        # Consume trailing padding so bzip2 does not fail writing to a closed pipe
+        while process.stdout.read(65536):
+            pass
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise Exception("Decompressing '%s' with %s failed:\n%s" % (filename, bzip2, stderr.decode(errors='replace')))
+
+# Prefix of temporary directories into which compressed result packets are unpacked before being renamed into place
+UNPACK_PREFIX = '.unpacking-'
+
+XTC_MAGIC = 1995 # magic number at the start of each XTC frame header
+
+class AtomCountMismatch(Exception):
+    """
+    Raised when the number of atoms in a result packet does not match its topology.
+    """
+    pass
+
+def scan_xtc_headers(xtc_filename):
+    """
+    Check that an XTC file is structurally complete by walking its frame headers, without decoding any coordinates.
+
+    Each frame consists of a header (magic number, number of atoms, step, time, and box), followed by
+    either the raw coordinates (for up to 9 atoms) or the compression parameters and a byte count for
+    the compressed coordinates, which are skipped.
+
+    Parameters
+    ----------
+    xtc_filename : str
+        Path to XTC file
+
+    Returns
+    -------
+    n_atoms : int or None
+        Number of atoms in each frame, or None if the file has no frames
+    n_frames : int
+        Number of frames
+    first_time, last_time : float or None
+        Simulation times (in ps) of the first and last frames, or None if the file has no frames
+
+    Raises
+    ------
+    Exception
+        If the file is truncated or a frame header is inconsistent
+
+    """
+    file_size = os.path.getsize(xtc_filename)
+    (n_atoms, n_frames, first_time, last_time) = (None, 0, None, None)
+    offset = 0
+    with open(xtc_filename, 'rb') as xtc_file:
+        while offset < file_size:
+            xtc_file.seek(offset)
+            header = xtc_file.read(92)
+            if len(header) < 56:
+                raise Exception("XTC file '%s' is truncated in the header of frame %d" % (xtc_filename, n_frames))
+            (magic, natoms, step, frame_time) = struct.unpack_from('>iiif', header, 0)
+            (coordinates_natoms,) = struct.unpack_from('>i', header, 52)
+            if magic != XTC_MAGIC:
+                raise Exception("XTC file '%s' has bad magic number %d in frame %d" % (xtc_filename, magic, n_frames))
+            if (natoms != coordinates_natoms) or ((n_atoms is not None) and (natoms != n_atoms)):
+                raise Exception("XTC file '%s' has inconsistent numbers of atoms in frame %d" % (xtc_filename, n_frames))
+            if natoms <= 9:
+                # Coordinates of small systems are stored uncompressed
+                frame_bytes = 56 + 12 * natoms
+            else:
+                if len(header) < 92:
+                    raise Exception("XTC file '%s' is truncated in the header of frame %d" % (xtc_filename, n_frames))
+                (compressed_bytes,) = struct.unpack_from('>i', header, 88)
+                if compressed_bytes < 0:
+                    raise Exception("XTC file '%s' has a negative byte count in frame %d" % (xtc_filename, n_frames))
+                frame_bytes = 92 + 4 * ((compressed_bytes + 3) // 4)
+            if offset + frame_bytes > file_size:
+                raise Exception("XTC file '%s' is truncated in the coordinates of frame %d" % (xtc_filename, n_frames))
+            offset += frame_bytes
+            if n_frames == 0:
+                (n_atoms, first_time) = (natoms, frame_time)
+            last_time = frame_time
+            n_frames += 1
+    return (n_atoms, n_frames, first_time, last_time)
+
+def verify_result_packet(result_packet, topology, timer, description=None):
+    """
+    Verify the integrity of positions.xtc in a result packet directory by scanning its XTC frame headers, without decoding coordinates.
+
+    Parameters
+    ----------
+    result_packet : str
+        Path to result packet directory
+    topology : mdtraj.Topology
+        Topology whose number of atoms the packet must match
+    timer : fahmunge.profiling.StageTimer
+        Time spent scanning is accumulated in the 'verify' stage
+    description : str, optional, default=None
+        Description of the packet for error messages; if None, the packet directory is used
+
+    Raises
+    ------
+    Exception
+        If positions.xtc is missing, truncated, or corrupt
+    AtomCountMismatch
+        If positions.xtc is intact but has a different number of atoms than the topology
+
+    """
+    if description is None:
+        description = "Result packet '%s'" % result_packet
+    xtc_filename = os.path.join(result_packet, 'positions.xtc')
+    if not os.path.exists(xtc_filename):
+        raise Exception("%s does not contain positions.xtc" % description)
+    # Report truncation or corruption as such; only an intact packet can be compared with the topology
+    try:
+        with timer.stage('verify'):
+            (n_atoms, n_frames, first_time, last_time) = scan_xtc_headers(xtc_filename)
+    except Exception as e:
+        msg = "%s failed trajectory integrity check.\n" % description
+        msg += str(e)
+        raise Exception(msg)
+    if (n_atoms is not None) and (n_atoms != topology.n_atoms):
+        raise AtomCountMismatch("%s has %d atoms, but the topology has %d atoms; check the topology specified for this project" % (description, n_atoms, topology.n_atoms))
+
+def ensure_result_packet_is_decompressed(result_packet, topology, atom_indices=None, chunksize=10, delete_on_unpack=False, compress_xml=False, timer=None):
     """
     Ensure that the specified result packet is decompressed.
 
     If this is a ws7/ws8 compressed result packet, safely convert it to uncompressed:
-    * decompress it into a temporary directory
-    * move it into place
-    * verify integrity of files
+    * decompress it into a temporary directory in the CLONE directory, named with UNPACK_PREFIX
+    * verify integrity of files by scanning the XTC frame headers
+    * rename it into place, so that the packet directory appears complete in a single step
     * unlink (delete) the old result packet if everything looks OK [OPTIONAL]
 
-    If this is a directory, this function returns immediately.
+    Temporary directories are removed if unpacking fails, but may be left behind if the process is killed.
+
+    If this is a ws9 result packet directory, its integrity is verified in the same way, and it is returned in place.
 
     .. warning: This will irreversibly delete the compressed work packet, replacing
     it with an uncompressed one.
@@ -107,15 +388,16 @@ def ensure_result_packet_is_decompressed(result_packet, topology, atom_indices=N
     topology : mdtraj.Topology
         Topology to use for verifying integrity of trajectory
     atom_indices : list of int, optional, default=None
-        Atom indices to read when verifying integrity of trajectory
-        If None, all atoms will be read.
+        Unused; the trajectory is verified without decoding coordinates
     delete_on_unpack : bool, optional, default=True
         If True, will delete old ws8-style .tar.bz2 files after they have been unpacked.
         WARNING: THIS COULD BE DANGEROUS
     compress_xml : bool, optional, default=False
         If True, will compress XML files after unpacking them.
     chunksize : int, optional, default=10
-        Number of frames to read each call to mdtraj.iterload for verifying trajectory integrity
+        Unused; the trajectory is verified without decoding coordinates
+    timer : fahmunge.profiling.StageTimer, optional, default=None
+        If specified, time spent in the 'decompress' and 'verify' stages is accumulated here
 
     Returns
     -------
@@ -123,8 +405,12 @@ def ensure_result_packet_is_decompressed(result_packet, topology, atom_indices=N
         Path to new result packet directory
 
     """
-    # Return if this is just a directory
+    if timer is None:
+        timer = StageTimer()
+
+    # Verify a directory in place, so that a truncated packet is caught before any of its frames are decoded
     if os.path.isdir(result_packet):
+        verify_result_packet(result_packet, topology, timer)
         return result_packet
 
     # If this is a tarball, extract salient information.
@@ -136,53 +422,582 @@ def ensure_result_packet_is_decompressed(result_packet, topology, atom_indices=N
         raise Exception("Compressed results packet filename '%s' does not match expected format (results-001.tar.bz2)" % result_packet)
     frame_number = int(re.match(pattern, filename).group(1))
 
-    # Extract frames from trajectory in a temporary directory
+    # Extract frames from trajectory in a temporary directory next to the packet, so it can be renamed into place
+    # Only absolute paths are used: packets may be unpacked in a background thread while other threads
+    # open files relative to the working directory, so the working directory must not be changed
     print("      Extracting %s" % result_packet)
-    with enter_temp_directory():
-        # Create target directory
-        extracted_archive_directory = tempfile.mkdtemp()
-
-        # Extract all contents
-        archive = tarfile.open(absfilename, mode='r:bz2')
-        archive.extractall(path=extracted_archive_directory)
-
-        # Compress XML files
-        if compress_xml:
-            xml_filenames = glob.glob('%s/*.xml' % extracted_archive_directory)
-            for filename in xml_filenames:
-                print("      Compressing %s" % os.path.basename(filename))
-                subprocess.call(['gzip', filename])
-
-        # Create new result packet name
-        new_result_packet = os.path.join(basepath, 'results%d' % frame_number)
+    extracted_archive_directory = tempfile.mkdtemp(dir=basepath, prefix=UNPACK_PREFIX)
+    try:
+        with timer.stage('decompress'):
+            # Extract all contents
+            extract_bz2_archive(absfilename, extracted_archive_directory)
+
+            # Compress XML files
+            if compress_xml:
+                xml_filenames = glob.glob('%s/*.xml' % extracted_archive_directory)
+                for filename in xml_filenames:
+                    print("      Compressing %s" % os.path.basename(filename))
+                    subprocess.call(['gzip', filename])
+
+        # Verify integrity of archive contents from the XTC frame headers, without decoding coordinates
+        verify_result_packet(extracted_archive_directory, topology, timer, description="Result packet archive '%s'" % result_packet)
 
         # Move directory into place
-        shutil.move(extracted_archive_directory, new_result_packet)
-
-        # Verify integrity of archive contents
-        xtc_filename = os.path.join(new_result_packet, 'positions.xtc')
-        if not os.path.exists(xtc_filename):
-            raise Exception("Result packet archive '%s' does not contain positions.xtc; aborting unpacking.")
-        try:
-            for chunk in md.iterload(xtc_filename, top=topology, atom_indices=atom_indices, chunk=chunksize):
-                pass
-        except Exception as e:
-            msg = "Result packet archive '%s' failed trajectory integrity check; aborting unpacking.\n"
-            msg += str(e)
-            raise Exception(msg)
+        new_result_packet = os.path.join(basepath, 'results%d' % frame_number)
+        os.rename(extracted_archive_directory, new_result_packet)
+    except:
+        shutil.rmtree(extracted_archive_directory, ignore_errors=True)
+        raise
+
+    if delete_on_unpack:
+        # Remove archive permanently
+        print("      Permanently removing %s" % absfilename)
+        os.unlink(absfilename)
+
+    # Return updated result packet directory name
+    return new_result_packet
+
+def normalize_outputs(processed_trajectory_filename, atom_selection_string, strides=None):
+    """
+    Return lists of munged trajectory filenames, their atom selections, and their strides.
+
+    Parameters
+    ----------
+    processed_trajectory_filename : str or list of str
+        Munged trajectory filename, or one filename per selection
+    atom_selection_string : str or list of str
+        MDTraj DSL selection, or one selection per filename
+    strides : list of int, optional, default=None
+        Stride of each filename; if None, every frame is written to every trajectory
+
+    Returns
+    -------
+    processed_trajectory_filenames : list of str
+    atom_selection_strings : list of str
+    strides : list of int
+
+    """
+    if isinstance(processed_trajectory_filename, (list, tuple)):
+        processed_trajectory_filenames = list(processed_trajectory_filename)
+        atom_selection_strings = list(atom_selection_string)
+    else:
+        processed_trajectory_filenames = [processed_trajectory_filename]
+        atom_selection_strings = [atom_selection_string]
+    if len(processed_trajectory_filenames) != len(atom_selection_strings):
+        raise ValueError('Number of munged trajectory filenames (%d) and atom selections (%d) differ' % (len(processed_trajectory_filenames), len(atom_selection_strings)))
+    strides = [1] * len(processed_trajectory_filenames) if (strides is None) else list(strides)
+    if len(strides) != len(processed_trajectory_filenames):
+        raise ValueError('Number of munged trajectory filenames (%d) and strides (%d) differ' % (len(processed_trajectory_filenames), len(strides)))
+    return (processed_trajectory_filenames, atom_selection_strings, strides)
+
+def read_topology_selections(topology_filename, atom_selection_strings):
+    """
+    Read the topology of a work unit and determine the atoms to be written to each munged trajectory.
+
+    Trajectories are decoded once for the union of all selections; each selection is then
+    a subset of the decoded atoms.
+
+    Parameters
+    ----------
+    topology_filename : str
+        Path to PDB or other file containing topology information
+    atom_selection_strings : list of str
+        MDTraj DSL selections specifying which atoms should be written to each trajectory
+
+    Returns
+    -------
+    work_unit_topology : mdtraj.Topology
+        Topology of the full system simulated in each work unit
+    atom_indices : numpy.ndarray of int
+        Sorted indices of atoms selected by any of atom_selection_strings
+    selections : list of (numpy.ndarray of int or None, mdtraj.Topology)
+        For each selection, the indices of its atoms within atom_indices (or None if it selects all of them),
+        and the topology of the selected atom subset
+
+    """
+    top = md.load(topology_filename)
+    work_unit_topology = copy.deepcopy(top.topology) # extract topology
+    del top # close file
+
+    # Determine atoms that will be written to each trajectory
+    selected_atom_indices = [ work_unit_topology.select(atom_selection_string) for atom_selection_string in atom_selection_strings ]
+    atom_indices = np.unique(np.concatenate(selected_atom_indices))
+
+    selections = list()
+    for indices in selected_atom_indices:
+        # Create a new Topology for the atom subset to be written to the trajectory
+        trajectory_topology = work_unit_topology.subset(indices)
+        subset_indices = None if np.array_equal(indices, atom_indices) else np.searchsorted(atom_indices, indices)
+        selections.append((subset_indices, trajectory_topology))
+
+    return (work_unit_topology, atom_indices, selections)
+
+def cached_topology_selections(topology_filename, atom_selection_strings, topology_cache=None, max_cached=8, clone_path=None):
+    """
+    Return read_topology_selections(topology_filename, atom_selection_strings), reusing earlier results.
+
+    Parameters
+    ----------
+    topology_filename : str
+        Path to PDB or other file containing topology information
+    atom_selection_strings : list of str
+        MDTraj DSL selections specifying which atoms should be written to each trajectory
+    topology_cache : dict, optional, default=None
+        Results of earlier calls, keyed by topology filename and selections; updated in place.
+        If None, the topology is always read.
+    max_cached : int, optional, default=8
+        The cache is emptied before adding a topology once it holds this many
+    clone_path : str, optional, default=None
+        If specified, the CLONE the topology is read for, which is reported if the topology is actually read
+
+    Returns
+    -------
+    work_unit_topology, atom_indices, selections
+        As returned by read_topology_selections()
+
+    """
+    key = (topology_filename, tuple(atom_selection_strings))
+    if (topology_cache is not None) and (key in topology_cache):
+        return topology_cache[key]
+    if clone_path is None:
+        print('Reading topology from %s...' % topology_filename)
+    else:
+        print('Reading topology from %s for clone %s...' % (topology_filename, clone_path))
+    result = read_topology_selections(topology_filename, atom_selection_strings)
+    if topology_cache is not None:
+        if len(topology_cache) >= max_cached:
+            topology_cache.clear()
+        topology_cache[key] = result
+    return result
+
+def open_processed_trajectory(processed_trajectory_filename, trajectory_topology):
+    """
+    Open a munged trajectory for appending, initializing its topology and processed packet ledger if absent.
+
+    Parameters
+    ----------
+    processed_trajectory_filename : str
+        Path to munged trajectory
+    trajectory_topology : mdtraj.Topology
+        Topology of the atoms written to the trajectory
+
+    Returns
+    -------
+    trj_file : mdtraj.formats.HDF5TrajectoryFile
+        The open trajectory; the caller must close it
+
+    """
+    trj_file = HDF5TrajectoryFile(processed_trajectory_filename, mode='a')
 
-        # Cleanup archive object
-        del archive
+    # Initialize new trajectory with topology and list of processed WUs if they are absent
+    try:
+        # TODO: Switch from pytables StringAtom to arbitrary-length string
+        # http://www.pytables.org/usersguide/datatypes.html
+        trj_file._create_earray(where='/', name='processed_folders',atom=trj_file.tables.StringAtom(MAX_FILEPATH_LENGTH), shape=(0,))
+        trj_file.topology = trajectory_topology # assign topology
+    except trj_file.tables.NodeError:
+        pass
+
+    return trj_file
+
+def read_processed_folders(trj_file):
+    """
+    List the result packets recorded in the processed packet ledger of an open munged trajectory.
+
+    Parameters
+    ----------
+    trj_file : mdtraj.formats.HDF5TrajectoryFile
+        Open munged trajectory
+
+    Returns
+    -------
+    processed_folders : list of str
+        Result packet paths, in the order they were appended
+
+    """
+    # On Py3, the pytables list of filenames has type byte (e.g. b"hey")
+    return [ folder.decode() if isinstance(folder, bytes) else folder for folder in trj_file._handle.root.processed_folders ]
+
+def count_frames(trj_file):
+    """
+    Return the number of frames in a munged trajectory, which may not have any coordinates yet.
+    """
+    # Coordinates are only created when the first frames are written
+    return len(trj_file) if ('coordinates' in trj_file._handle.root) else 0
+
+def mark_trajectory(trj_file):
+    """
+    Record the extent of a munged trajectory, so that anything appended afterwards can be discarded with truncate_trajectory().
+
+    Parameters
+    ----------
+    trj_file : mdtraj.formats.HDF5TrajectoryFile
+        Open munged trajectory
+
+    Returns
+    -------
+    mark : tuple
+        The number of rows of each appendable array and table (frames, the processed packet ledger, and the
+        frame index), and the 'source_frames' attribute of strided trajectories (or None)
+
+    """
+    root = trj_file._handle.root
+    n_rows = dict((node._v_name, node.nrows) for node in root._f_iter_nodes() if isinstance(node, (tables.EArray, tables.Table)))
+    source_frames = root._v_attrs.source_frames if ('source_frames' in root._v_attrs._v_attrnames) else None
+    return (n_rows, source_frames)
+
+def truncate_trajectory(trj_file, mark):
+    """
+    Discard frames and ledger entries appended to a munged trajectory since mark_trajectory() returned `mark`.
+
+    Parameters
+    ----------
+    trj_file : mdtraj.formats.HDF5TrajectoryFile
+        Open munged trajectory
+    mark : tuple
+        Result of mark_trajectory(); arrays created since then are emptied
+
+    """
+    (n_rows, source_frames) = mark
+    root = trj_file._handle.root
+    for node in root._f_iter_nodes():
+        if isinstance(node, (tables.EArray, tables.Table)) and (node.nrows > n_rows.get(node._v_name, 0)):
+            node.truncate(n_rows.get(node._v_name, 0))
+    if source_frames is not None:
+        root._v_attrs.source_frames = source_frames
+    elif 'source_frames' in root._v_attrs._v_attrnames:
+        del root._v_attrs.source_frames
+    trj_file.flush()
+
+def file_sizes(filenames):
+    """
+    Return the size in bytes of each file, or zero if it does not exist yet.
+    """
+    return [ os.path.getsize(filename) if os.path.exists(filename) else 0 for filename in filenames ]
+
+def read_source_frames(trj_file):
+    """
+    Return the number of source frames examined so far for a munged trajectory.
+
+    For strided trajectories this is stored in the 'source_frames' attribute, and carries the
+    stride over from one result packet to the next; otherwise it is the number of frames.
+
+    Parameters
+    ----------
+    trj_file : mdtraj.formats.HDF5TrajectoryFile
+        Open munged trajectory
+
+    Returns
+    -------
+    source_frames : int
+        Number of frames in the result packets processed so far
+
+    """
+    root = trj_file._handle.root
+    if 'source_frames' in root._v_attrs._v_attrnames:
+        return int(root._v_attrs.source_frames)
+    return count_frames(trj_file)
+
+def append_frames(trj_file, xyz, times, cell_lengths, cell_angles, subset_indices=None, stride=1, source_frames=0):
+    """
+    Append a chunk of decoded frames to a munged trajectory, optionally keeping only some atoms and every stride-th frame.
+
+    Parameters
+    ----------
+    trj_file : mdtraj.formats.HDF5TrajectoryFile
+        Open munged trajectory
+    xyz, times, cell_lengths, cell_angles : numpy.ndarray
+        Frames as yielded by iterate_xtc_chunks()
+    subset_indices : numpy.ndarray of int, optional, default=None
+        If specified, only these atoms are written
+    stride : int, optional, default=1
+        Only source frames whose index within the CLONE is a multiple of stride are written
+    source_frames : int, optional, default=0
+        Index within the CLONE of the first frame of this chunk
+
+    Returns
+    -------
+    n_written : int
+        Number of frames written
+
+    """
+    if stride > 1:
+        frame_indices = np.arange((-source_frames) % stride, len(xyz), stride)
+        (xyz, times) = (xyz[frame_indices], times[frame_indices])
+        if cell_lengths is not None:
+            (cell_lengths, cell_angles) = (cell_lengths[frame_indices], cell_angles[frame_indices])
+    if subset_indices is not None:
+        xyz = xyz[:,subset_indices,:]
+    if len(xyz) > 0:
+        trj_file.write(coordinates=xyz, cell_lengths=cell_lengths, cell_angles=cell_angles, time=times)
+    return len(xyz)
+
+def iterate_xtc_chunks(xtc_filename, atom_indices=None, chunksize=10):
+    """
+    Read an XTC file in chunks of raw arrays, without constructing mdtraj.Trajectory objects.
+
+    This skips the topology subsetting and per-chunk Trajectory construction of mdtraj.iterload;
+    box lengths and angles are computed for the whole chunk at once.
+
+    Parameters
+    ----------
+    xtc_filename : str
+        Path to XTC file
+    atom_indices : array_like of int, optional, default=None
+        Atom indices to read; if None, all atoms are read
+    chunksize : int or None, optional, default=10
+        Number of frames per chunk; if None, the whole file is read as a single chunk
+
+    Yields
+    ------
+    xyz : numpy.ndarray of float32 with shape (n_frames, n_atoms, 3)
+        Coordinates in nm
+    times : numpy.ndarray of float32 with shape (n_frames,)
+        Simulation times in ps
+    cell_lengths, cell_angles : numpy.ndarray with shape (n_frames, 3), or None
+        Box lengths in nm and angles in degrees, or None if the file has no box
+
+    """
+    with XTCTrajectoryFile(xtc_filename, mode='r') as xtc_file:
+        while True:
+            (xyz, times, step, box) = xtc_file.read(n_frames=chunksize, atom_indices=atom_indices)
+            if len(xyz) == 0:
+                break
+            # As in mdtraj, an all-zero box means there is no periodic box
+            if (box is None) or np.all(np.abs(box) < 1e-10):
+                (cell_lengths, cell_angles) = (None, None)
+            else:
+                (a, b, c, alpha, beta, gamma) = box_vectors_to_lengths_and_angles(box[:,0], box[:,1], box[:,2])
+                cell_lengths = np.column_stack([a, b, c])
+                cell_angles = np.column_stack([alpha, beta, gamma])
+            yield (xyz, times, cell_lengths, cell_angles)
+
+class TimeContinuity(object):
+    """
+    Check the simulation times of the chunks of frames appended to a CLONE for discontinuities.
+
+    Result packets sometimes overlap or restart, so that a packet begins by repeating the last frame
+    of the previous one, or time jumps forward or backward. Each chunk is compared with the last frame
+    kept using whole-array operations, so the check costs little compared with decoding the chunk.
+
+    Each munged trajectory of a CLONE is checked separately, since trajectories may have been
+    appended up to different packets (e.g. when a selection is added to a project).
+
+    Parameters
+    ----------
+    last_time : float, optional, default=None
+        Simulation time (ps) of the last frame already appended, if any
+    last_xyz : numpy.ndarray with shape (n_atoms, 3), optional, default=None
+        Coordinates of the last frame already appended, if known
+    last_digest : str, optional, default=None
+        If last_xyz is not known, the frame_digest() of the coordinates of the last frame already appended
+    last_atoms : numpy.ndarray of int, optional, default=None
+        If specified, last_xyz or last_digest holds only these of the decoded atoms
+    timestep : float, optional, default=None
+        Expected time (ps) between frames; if None, it is estimated from the first frames checked
+    gap_factor : float, optional, default=1.5
+        Time advancing by more than gap_factor timesteps between consecutive frames is a gap
+
+    """
+    def __init__(self, last_time=None, last_xyz=None, last_atoms=None, timestep=None, gap_factor=1.5, last_digest=None):
+        self.last_time = last_time
+        self.last_xyz = last_xyz
+        self.last_digest = last_digest
+        self.last_atoms = last_atoms
+        self.timestep = timestep
+        self.gap_factor = gap_factor
+
+    def check(self, xyz, times):
+        """
+        Check a chunk of frames, which follows the last frame kept.
+
+        Parameters
+        ----------
+        xyz, times : numpy.ndarray
+            Coordinates and simulation times of the chunk, as yielded by iterate_xtc_chunks()
+
+        Returns
+        -------
+        n_duplicates : int
+            The first n_duplicates frames of the chunk repeat the last frame kept (same time and coordinates), and should be dropped
+        flags : int
+            Discontinuities found (bits frameindex.DUPLICATES_DROPPED, frameindex.TIME_GAP, frameindex.TIME_RESET)
+
+        """
+        flags = 0
+        n_duplicates = 0
+        if (self.last_time is not None) and ((self.last_xyz is not None) or (self.last_digest is not None)):
+            # Only a leading run of frames can repeat the last frame kept
+            repeated = (times == self.last_time)
+            n_candidates = len(times) if repeated.all() else int(np.argmin(repeated))
+            if n_candidates > 0:
+                candidates = xyz[:n_candidates] if (self.last_atoms is None) else xyz[:n_candidates][:, self.last_atoms]
+                if self.last_xyz is not None:
+                    identical = np.all(candidates == self.last_xyz, axis=(1, 2))
+                else:
+                    identical = np.array([ frame_digest(candidate) == self.last_digest for candidate in candidates ])
+                n_duplicates = n_candidates if identical.all() else int(np.argmin(identical))
+        if n_duplicates > 0:
+            flags |= frameindex.DUPLICATES_DROPPED
+        kept_times = times[n_duplicates:]
+        if len(kept_times) == 0:
+            return (n_duplicates, flags)
+
+        steps = np.diff(kept_times) if (self.last_time is None) else np.diff(np.concatenate([[self.last_time], kept_times]))
+        if self.timestep is None:
+            increasing = steps[steps > 0]
+            if len(increasing) > 0:
+                self.timestep = float(np.median(increasing))
+        if np.any(steps <= 0):
+            flags |= frameindex.TIME_RESET
+        if self.timestep and np.any(steps > self.gap_factor * self.timestep):
+            flags |= frameindex.TIME_GAP
+
+        (self.last_time, self.last_xyz, self.last_atoms, self.last_digest) = (kept_times[-1], xyz[-1].copy(), None, None)
+        return (n_duplicates, flags)
 
-        if delete_on_unpack:
-            # Remove archive permanently
-            print("      Permanently removing %s" % absfilename)
-            os.unlink(absfilename)
+    def save(self, trj_file, subset_indices):
+        """
+        Record the last frame kept in the attributes of a strided munged trajectory, which may not contain it.
 
-        # Return updated result packet directory name
-        return new_result_packet
+        Parameters
+        ----------
+        trj_file : mdtraj.formats.HDF5TrajectoryFile
+            Open munged trajectory
+        subset_indices : numpy.ndarray of int
+            Decoded atoms written to the trajectory
 
-def process_core21_clone(clone_path, topology_filename, processed_trajectory_filename, atom_selection_string, terminate_event=None, delete_on_unpack=False, compress_xml=False, chunksize=10, signal_handler=None):
+        """
+        if self.last_time is None:
+            return
+        if self.last_xyz is None:
+            digest = self.last_digest
+        else:
+            digest = frame_digest(self.last_xyz if (self.last_atoms is not None) else self.last_xyz[subset_indices])
+        attrs = trj_file._handle.root._v_attrs
+        (attrs.last_source_time, attrs.last_source_digest) = (float(self.last_time), digest)
+
+def frame_digest(xyz):
+    """
+    Return the SHA-1 hex digest of the coordinates of a frame, used to recognize a repeated frame that is not stored.
+    """
+    return hashlib.sha1(np.ascontiguousarray(xyz, dtype=np.float32).tobytes()).hexdigest()
+
+def time_continuity(trj_file, stride, subset_indices):
+    """
+    Start checking time continuity for a munged trajectory from the last frame appended to it.
+
+    Parameters
+    ----------
+    trj_file : mdtraj.formats.HDF5TrajectoryFile
+        Open munged trajectory
+    stride : int
+        Stride of the trajectory
+    subset_indices : numpy.ndarray of int
+        Decoded atoms written to the trajectory, as returned by read_topology_selections()
+
+    Returns
+    -------
+    continuity : TimeContinuity
+        Continuity check starting from the last frame of an unstrided trajectory, or from the last frame
+        kept for a strided trajectory (see TimeContinuity.save()), or from scratch if there is none
+
+    """
+    root = trj_file._handle.root
+    if stride == 1:
+        if count_frames(trj_file) > 0:
+            last_times = root.time[-2:]
+            timestep = float(last_times[1] - last_times[0]) if (len(last_times) == 2) and (last_times[1] > last_times[0]) else None
+            return TimeContinuity(last_time=last_times[-1], last_xyz=root.coordinates[-1], last_atoms=subset_indices, timestep=timestep)
+    elif 'last_source_time' in root._v_attrs._v_attrnames:
+        return TimeContinuity(last_time=root._v_attrs.last_source_time, last_digest=root._v_attrs.last_source_digest, last_atoms=subset_indices)
+    return TimeContinuity()
+
+def iterate_decompressed_result_packets(result_packets, topology, prefetch=1, should_terminate=None, **kwargs):
+    """
+    Generate result packets in order, ensuring each has been decompressed.
+
+    If `prefetch` > 0, a background thread unpacks and verifies up to `prefetch` packets ahead of the
+    consumer, so that bz2 decompression overlaps with decoding and writing of the current packet.
+    Packets are always yielded in their original order. An exception raised while unpacking a packet
+    is re-raised when the consumer reaches that packet, exactly as it would be without prefetching.
+    Closing the generator (e.g. with contextlib.closing) stops the background thread; packets it has
+    already unpacked are simply found as directories next time.
+
+    Parameters
+    ----------
+    result_packets : list of str
+        Result packets to decompress, in order
+    topology : mdtraj.Topology
+        Topology to use for verifying integrity of trajectories
+    prefetch : int, optional, default=1
+        Maximum number of packets to unpack ahead of the consumer; 0 disables the background thread
+    should_terminate : callable, optional, default=None
+        If specified, no further packets are unpacked once should_terminate() returns True
+    **kwargs
+        Additional arguments passed to ensure_result_packet_is_decompressed. With prefetching, the background
+        thread times its stages with its own timer, which is merged into `timer` when the generator finishes.
+
+    Yields
+    ------
+    result_packet : str
+        Path to decompressed result packet directory
+
+    """
+    if prefetch <= 0:
+        for result_packet in result_packets:
+            if should_terminate and should_terminate():
+                return
+            yield ensure_result_packet_is_decompressed(result_packet, topology, **kwargs)
+        return
+
+    unpacked = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    # Stage times are not updated atomically, so the background thread must not share the consumer's timer
+    timer = kwargs.pop('timer', None)
+    unpack_timer = StageTimer()
+
+    def put(item):
+        # Block until there is room, unless the consumer has stopped
+        while not stop.is_set():
+            try:
+                unpacked.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def unpack():
+        for result_packet in result_packets:
+            if stop.is_set() or (should_terminate and should_terminate()):
+                break
+            try:
+                item = (ensure_result_packet_is_decompressed(result_packet, topology, timer=unpack_timer, **kwargs), None)
+            except Exception as e:
+                put((None, e))
+                return
+            if not put(item):
+                return
+        put((None, None))
+
+    thread = threading.Thread(target=unpack, name='unpack')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            (result_packet, exception) = unpacked.get()
+            if exception is not None:
+                raise exception
+            if result_packet is None:
+                return
+            yield result_packet
+    finally:
+        stop.set()
+        thread.join()
+        if timer is not None:
+            timer.merge(unpack_timer)
+
+def process_core21_clone(clone_path, topology_filename, processed_trajectory_filename, atom_selection_string, terminate_event=None, delete_on_unpack=False, compress_xml=False, chunksize=10, signal_handler=None, state_database=None, reconcile=False, memory_limit=None, prefetch=1, strides=None, topology_cache=None, progress=None):
     """
     Process core21 result packets in a CLONE, concatenating to a specified trajectory.
     This will append to the specified trajectory if it already exists.
@@ -199,10 +1014,12 @@ def process_core21_clone(clone_path, topology_filename, processed_trajectory_fil
         Source path to CLONE data directory
     topology_filename : str
         Path to PDB or other file containing topology information
-    processed_trajectory_filename : str
-        Path to concatenated stripped trajectory
-    atom_selection_string : str
-        MDTraj DSL specifying which atoms should be stripped from source WUs.
+    processed_trajectory_filename : str or list of str
+        Path to concatenated stripped trajectory, or a list of paths, one per atom selection.
+        Each trajectory keeps its own record of processed result packets.
+    atom_selection_string : str or list of str
+        MDTraj DSL specifying which atoms should be stripped from source WUs, or a list of selections,
+        one per trajectory. Each result packet is decoded once for all selections.
     terminate_event : multiprocessing.Event, optional, default=None
         If specified, will terminate early if terminate_event.is_set() is True
     delete_on_unpack : bool, optional, default=True
@@ -214,6 +1031,32 @@ def process_core21_clone(clone_path, topology_filename, processed_trajectory_fil
         Chunksize (in number of frames) to use for mdtraj.iterload reading of trajectory
     signal_handler : SignalHandler, optional, default=None
         If None, a new SignalHandler object will be created.
+    state_database : fahmunge.statedb.StateDatabase, optional, default=None
+        If specified, processed packets and CLONE progress will be recorded here, and
+        the CLONE will be skipped without reading the topology if all result packets are already recorded.
+    reconcile : bool, optional, default=False
+        If True, always open the processed trajectory and overwrite the state database
+        record for this CLONE with its contents, which are the source of truth.
+    memory_limit : int, optional, default=None
+        If specified, per-process memory budget (in bytes). The chunksize is adapted to the number of atoms
+        so that decoding fits within the budget, and processing stops after the current result packet
+        if the resident set size exceeds the budget; remaining packets are processed in a later iteration.
+    prefetch : int, optional, default=1
+        Number of result packets to unpack and verify in a background thread ahead of the packet being written.
+        If 0, packets are unpacked in sequence with writing.
+    strides : list of int, optional, default=None
+        If specified, the stride of each trajectory in processed_trajectory_filename. A trajectory with stride N
+        receives only frames whose index within the CLONE is a multiple of N, independent of packet boundaries.
+    topology_cache : dict, optional, default=None
+        If specified, topologies and atom selections are looked up here and added if absent,
+        so that CLONEs sharing a topology (e.g. those of one RUN) read it only once.
+    progress : callable, optional, default=None
+        If specified, progress(n_frames, uncompressed_bytes) is called after each result packet is appended.
+
+    Returns
+    -------
+    statistics : dict
+        Record of the work done (see fahmunge.metrics.clone_statistics())
 
     TODO
     ----
@@ -221,88 +1064,192 @@ def process_core21_clone(clone_path, topology_filename, processed_trajectory_fil
     * Include a safer way to substitute vars()
 
     """
+    statistics = clone_statistics()
+    timer = StageTimer(statistics)
+    (processed_trajectory_filenames, atom_selection_strings, strides) = normalize_outputs(processed_trajectory_filename, atom_selection_string, strides)
+
     # Check for early termination since topology reading might take a while
     if terminate_event and terminate_event.is_set():
-        return
-
-    MAX_FILEPATH_LENGTH = 1024 # MAXIMUM FILEPATH LENGTH; this may be too short for some installations
+        statistics['terminated'] = 1
+        return statistics
 
     if not signal_handler:
         signal_handler = SignalHandler()
 
-    # Read the topology for the source WU
-    # TODO: Only read topology if we have not processed all the WU packets
-    # TODO: Use LRU cache to cache work_unit_topology based on filename
-    print('Reading topology from %s for clone %s...' % (topology_filename, clone_path))
-    top = md.load(topology_filename)
-    work_unit_topology = copy.deepcopy(top.topology) # extract topology
-    del top # close file
-
-    # Check for early termination since topology reading might take a while
-    if terminate_event and terminate_event.is_set():
-        return
-
-    # Determine atoms that will be written to trajectory
-    atom_indices = work_unit_topology.select(atom_selection_string)
-
-    # Create a new Topology for the atom subset to be written to the trajectory
-    trajectory_topology = work_unit_topology.subset(atom_indices)
+    # Record the CLONE directory mtime before listing result packets so that packets arriving later are not missed
+    if state_database:
+        clone_mtime = os.stat(clone_path).st_mtime
 
     # Glob file paths and return result files in sequential order.
-    result_packets = list_core21_result_packets(clone_path)
+    with timer.stage('listdir'):
+        result_packets = list_core21_result_packets(clone_path)
 
     # Return if there are no WUs to process
     if len(result_packets) <= 0:
-        return
+        return statistics
 
-    # Open trajectory for appending
-    trj_file = HDF5TrajectoryFile(processed_trajectory_filename, mode='a')
+    # Skip without reading the topology if the state database shows all packets have been processed
+    if state_database and (not reconcile) and all(os.path.exists(filename) for filename in processed_trajectory_filenames):
+        processed_packets = [ state_database.processed_packets(filename) for filename in processed_trajectory_filenames ]
+        if all(result_packet_is_processed(result_packet, packets) for result_packet in result_packets for packets in processed_packets):
+            for filename in processed_trajectory_filenames:
+                state_database.touch_clone(filename, clone_mtime)
+            return statistics
 
-    # Initialize new trajectory with topology and list of processed WUs if they are absent
+    # Read the topology for the source WU, unless another CLONE sharing it has already done so
+    with timer.stage('topology'):
+        (work_unit_topology, atom_indices, selections) = cached_topology_selections(topology_filename, atom_selection_strings, topology_cache, clone_path=clone_path)
+
+    # Check for early termination since topology reading might take a while
+    if terminate_event and terminate_event.is_set():
+        statistics['terminated'] = 1
+        return statistics
+
+    # Size chunks to fit within the memory budget
+    chunksize = adaptive_chunksize(work_unit_topology.n_atoms, memory_limit, default_chunksize=chunksize)
+
+    # Open trajectories for appending, making sure they are closed even if processing fails
+    initial_sizes = file_sizes(processed_trajectory_filenames)
+    trj_files = list()
     try:
-        # TODO: Switch from pytables StringAtom to arbitrary-length string
-        # http://www.pytables.org/usersguide/datatypes.html
-        trj_file._create_earray(where='/', name='processed_folders',atom=trj_file.tables.StringAtom(MAX_FILEPATH_LENGTH), shape=(0,))
-        trj_file.topology = trajectory_topology # assign topology
-    except trj_file.tables.NodeError:
-        pass
+        for (filename, (subset_indices, trajectory_topology)) in zip(processed_trajectory_filenames, selections):
+            trj_files.append(open_processed_trajectory(filename, trajectory_topology))
 
-    # Process each WU, checking whether signal has been received after each.
-    for result_packet in result_packets:
-        # Stop processing if signal handler indicates we should terminate
-        if (signal_handler.terminate) or (terminate_event and terminate_event.is_set()):
-            break
+        # Determine which result packets still need to be processed, and for which trajectories, noting their sizes before any are unpacked
+        processed_folders = [ set(read_processed_folders(trj_file)) for trj_file in trj_files ]
+        source_frames = [ read_source_frames(trj_file) for trj_file in trj_files ]
+        pending_packets = list()
+        pending_outputs = list() # indices of trajectories each pending packet must be appended to
+        for result_packet in result_packets:
+            outputs = [ index for (index, folders) in enumerate(processed_folders) if not result_packet_is_processed(result_packet, folders) ]
+            if outputs:
+                pending_packets.append(result_packet)
+                pending_outputs.append(outputs)
+        pending_packet_sizes = [ result_packet_size(result_packet) for result_packet in pending_packets ]
+        for (result_packet, result_packet_bytes) in zip(pending_packets, pending_packet_sizes):
+            if not os.path.isdir(result_packet):
+                statistics['compressed_bytes'] += result_packet_bytes
 
-        # Skip this WU if we have already processed it
-        if six.b(result_packet) in trj_file._handle.root.processed_folders:  # On Py3, the pytables list of filenames has type byte (e.g. b"hey"), so we need to deal with this via six.
-            continue
+        continuities = dict() # continuity check of each trajectory, started when its first packet is appended
+
+        # Unpack result packets ahead of the packet being written, if requested
+        def should_terminate():
+            return signal_handler.terminate or (terminate_event and terminate_event.is_set())
+        unpacked_packets = iterate_decompressed_result_packets(pending_packets, work_unit_topology, prefetch=prefetch, should_terminate=should_terminate,
+            delete_on_unpack=delete_on_unpack, compress_xml=compress_xml, chunksize=chunksize, timer=timer)
 
-        # If the result packet is compressed, decompress it and return the new directory name
-        result_packet = ensure_result_packet_is_decompressed(result_packet, work_unit_topology, delete_on_unpack=delete_on_unpack, compress_xml=compress_xml)
+        # Process each WU, checking whether signal has been received after each.
+        complete = False # True if all result packets have been examined
+        with contextlib.closing(unpacked_packets):
+            for (packet_index, result_packet) in enumerate(unpacked_packets):
+                result_packet_bytes = pending_packet_sizes[packet_index]
+                outputs = pending_outputs[packet_index]
 
-        # Check that we haven't violated our filename length assumption
-        if len(result_packet) > MAX_FILEPATH_LENGTH:
-            msg = "Filename is longer than hard-coded MAX_FILEPATH_LENGTH limit (%d > %d). Increase MAX_FILEPATH_LENGTH and re-install." % (len(result_packet), MAX_FILEPATH_LENGTH)
-            print(msg)
-            raise Exception(msg)
+                # Check that we haven't violated our filename length assumption
+                if len(result_packet) > MAX_FILEPATH_LENGTH:
+                    msg = "Filename is longer than hard-coded MAX_FILEPATH_LENGTH limit (%d > %d). Increase MAX_FILEPATH_LENGTH and re-install." % (len(result_packet), MAX_FILEPATH_LENGTH)
+                    print(msg)
+                    raise Exception(msg)
 
-        # Stop processing if signal handler indicates we should terminate
-        if (signal_handler.terminate) or (terminate_event and terminate_event.is_set()):
-            break
+                # Stop processing if signal handler indicates we should terminate
+                if should_terminate():
+                    statistics['terminated'] = 1
+                    break
 
-        # Process the work unit
-        # TODO: Write to logger instead of printing to terminal
-        # TODO: We could conceivably also check for early termination in the chunk loop if we carefully track the last chunk processed as well.
-        print("   Processing %s" % result_packet)
-        xtc_filename = os.path.join(result_packet, "positions.xtc")
-        for chunk in md.iterload(xtc_filename, top=work_unit_topology, atom_indices=atom_indices, chunk=chunksize):
-            trj_file.write(coordinates=chunk.xyz, cell_lengths=chunk.unitcell_lengths, cell_angles=chunk.unitcell_angles, time=chunk.time)
-        # Record that we've processed the WU
-        trj_file._handle.root.processed_folders.append([result_packet])
+                # Process the work unit
+                # TODO: Write to logger instead of printing to terminal
+                # TODO: We could conceivably also check for early termination in the chunk loop if we carefully track the last chunk processed as well.
+                print("   Processing %s" % result_packet)
+                xtc_filename = os.path.join(result_packet, "positions.xtc")
+                uncompressed_bytes = os.path.getsize(xtc_filename)
+                statistics['uncompressed_bytes'] += uncompressed_bytes
+                for index in outputs:
+                    if index not in continuities:
+                        continuities[index] = time_continuity(trj_files[index], strides[index], selections[index][0])
+                n_kept = dict((index, 0) for index in outputs)
+                n_written = dict((index, 0) for index in outputs)
+                first_frames = dict((index, count_frames(trj_files[index])) for index in outputs)
+                marks = dict((index, mark_trajectory(trj_files[index])) for index in outputs)
+                flags = dict((index, 0) for index in outputs)
+                n_dropped = dict((index, 0) for index in outputs)
+                try:
+                    chunks = iterate_xtc_chunks(xtc_filename, atom_indices=atom_indices, chunksize=chunksize)
+                    while True:
+                        with timer.stage('decode'):
+                            chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        (xyz, times, cell_lengths, cell_angles) = chunk
+                        for index in outputs:
+                            # Drop frames repeating the last frame appended to this trajectory, and note any jumps in time
+                            with timer.stage('verify'):
+                                (n_duplicates, chunk_flags) = continuities[index].check(xyz, times)
+                            flags[index] |= chunk_flags
+                            n_dropped[index] += n_duplicates
+                            if n_duplicates == len(xyz):
+                                continue
+                            with timer.stage('write'):
+                                n_written[index] += append_frames(trj_files[index], xyz[n_duplicates:], times[n_duplicates:],
+                                    cell_lengths[n_duplicates:] if (cell_lengths is not None) else None, cell_angles[n_duplicates:] if (cell_angles is not None) else None,
+                                    subset_indices=selections[index][0], stride=strides[index], source_frames=source_frames[index] + n_kept[index])
+                            n_kept[index] += len(xyz) - n_duplicates
+                    # Record that we've processed the WU, carrying the stride and last frame kept over to the next packet
+                    for index in outputs:
+                        trj_files[index]._handle.root.processed_folders.append([result_packet])
+                        frameindex.append_packet_frames(trj_files[index], result_packet, first_frames[index], flags=flags[index], n_dropped=n_dropped[index])
+                        if strides[index] > 1:
+                            trj_files[index]._handle.root._v_attrs.source_frames = source_frames[index] + n_kept[index]
+                            continuities[index].save(trj_files[index], selections[index][0])
+                except:
+                    # Discard the frames of a packet that could not be processed completely, since it is not recorded
+                    # as processed and all of its frames will be appended again when it is retried
+                    for index in outputs:
+                        truncate_trajectory(trj_files[index], marks[index])
+                    raise
+                for index in outputs:
+                    source_frames[index] += n_kept[index]
+                # Summarize the packet over the trajectories it was appended to
+                n_frames = max(n_kept.values())
+                n_dropped = max(n_dropped.values())
+                flags = np.bitwise_or.reduce(list(flags.values()))
+                statistics['packets'] += 1
+                statistics['input_bytes'] += result_packet_bytes
+                statistics['frames'] += n_frames
+                if flags:
+                    print("   %s: %s (%d duplicate frames dropped)" % (result_packet, frameindex.describe_flags(flags), n_dropped))
+                    statistics['duplicate_frames'] += n_dropped
+                    statistics['time_discontinuities'] += int(bool(flags & (frameindex.TIME_GAP | frameindex.TIME_RESET)))
+                if state_database:
+                    for index in outputs:
+                        trj_files[index].flush()
+                        state_database.record_packet(processed_trajectory_filenames[index], clone_path, result_packet, n_written[index])
+                if progress:
+                    progress(n_frames, uncompressed_bytes)
 
-    # Sync the trajectory file to flush all data to disk
-    trj_file.close()
+                # Stop processing once this packet is complete if we have exceeded our memory budget
+                if memory_limit and (packet_index < len(pending_packets) - 1) and (current_rss() > memory_limit):
+                    print("   Memory budget of %.0f MB exceeded; deferring remaining packets of %s" % (memory_limit / 1.0e6, clone_path))
+                    statistics['memory_exceeded'] += 1
+                    break
+            else:
+                # Unpacking stops early if we are terminating
+                complete = (statistics['packets'] == len(pending_packets))
+                if not complete:
+                    statistics['terminated'] = 1
+
+        # Bring the state database in line with the processed trajectories, which are the source of truth
+        # If we stopped early, record no mtime so that the CLONE is rescheduled
+        if state_database:
+            for (filename, trj_file) in zip(processed_trajectory_filenames, trj_files):
+                state_database.reconcile_clone(filename, clone_path, read_processed_folders(trj_file), count_frames(trj_file), clone_mtime if complete else None)
+    finally:
+        # Sync the trajectory files to flush all data to disk
+        for trj_file in trj_files:
+            trj_file.close()
+    statistics['output_bytes'] += sum(max(final_size - initial_size, 0) for (initial_size, final_size) in zip(initial_sizes, file_sizes(processed_trajectory_filenames)))
 
     # Make sure we tell everyone to terminate if we are terminating
     if signal_handler.terminate and terminate_event:
         terminate_event.set()
+
+    return statistics
@@ -18,6 +18,10 @@ from mdtraj.utils import six
 from natsort import natsorted
 import time
 
+from fahmunge.metrics import clone_statistics
+from fahmunge.profiling import StageTimer
+from fahmunge import frameindex
+
 ##############################################################################
 # globals
 ##############################################################################
@@ -110,6 +114,8 @@ def strip_water(allatom_filename, protein_filename, protein_atom_indices, min_nu
     trj_protein.write(coordinates=coordinates[:, protein_atom_indices], time=time, cell_lengths=cell_lengths, cell_angles=cell_angles)  # Ignoring the other fields for now, TODO.
 
     filenames_protein.append(filenames_allatom[n_files_protein:])
+    # The frame index carries over, since both trajectories have the same frames
+    frameindex.copy_frame_index(trj_allatom, trj_protein)
     del trj_allatom, trj_protein
 
 def delete_trajectory_if_broken(filename, verbose=True):
@@ -155,29 +161,40 @@ def concatenate_core17(path, top_filename, output_filename, maxtime=None, maxpac
     maxtime : int, optional, default=None
         If specified, will stop processing after `maxtime` seconds have passed.
 
+    Returns
+    -------
+    statistics : dict
+        Record of the work done (see fahmunge.metrics.clone_statistics())
+
     Notes
     -----
     We use HDF5 because it provides an easy way to store the metadata associated
     with which files have already been processed.
     """
+    task_initial_time = time.time()
+    statistics = clone_statistics()
+    timer = StageTimer(statistics)
 
     # Open topology file.
-    top = md.load(top_filename % vars())
+    with timer.stage('topology'):
+        top = md.load(top_filename % vars())
 
     # Glob file paths and return result files in sequential order.
-    glob_input = os.path.join(path, "results-*.tar.bz2")
-    filenames = glob.glob(glob_input)
-    filenames = natsorted(filenames)
+    with timer.stage('listdir'):
+        glob_input = os.path.join(path, "results-*.tar.bz2")
+        filenames = glob.glob(glob_input)
+        filenames = natsorted(filenames)
 
     print("Concatenating XTC files from '%s' into '%s' [%d results packets found]" % (path, output_filename, len(filenames)))
 
     # If no result files are present, return.
     if len(filenames) <= 0:
         del top
-        return
+        return statistics
 
     # Check integrity of trajectory if it exists.
     delete_trajectory_if_broken(output_filename)
+    initial_size = os.path.getsize(output_filename) if os.path.exists(output_filename) else 0
 
     # Open trajectory for appending.
     trj_file = HDF5TrajectoryFile(output_filename, mode='a')
@@ -208,17 +225,24 @@ def concatenate_core17(path, top_filename, output_filename, maxtime=None, maxpac
             absfilename = os.path.abspath(filename)
             with enter_temp_directory():
                 # Extract frames
-                archive = tarfile.open(absfilename, mode='r:bz2')
-                archive.extract("positions.xtc")
-                trj = md.load("positions.xtc", top=top)
+                with timer.stage('decompress'):
+                    archive = tarfile.open(absfilename, mode='r:bz2')
+                    archive.extract("positions.xtc")
+                statistics['uncompressed_bytes'] += os.path.getsize("positions.xtc")
+                with timer.stage('decode'):
+                    trj = md.load("positions.xtc", top=top)
+                n_frames = trj.n_frames
                 print("   appending %d frames from '%s' to '%s'" % (trj.n_frames, filename, output_filename))
-                for frame in trj:
-                    trj_file.write(coordinates=frame.xyz, cell_lengths=frame.unitcell_lengths, cell_angles=frame.unitcell_angles, time=frame.time)
+                first_frame = len(trj_file) if ('coordinates' in trj_file._handle.root) else 0
+                with timer.stage('write'):
+                    for frame in trj:
+                        trj_file.write(coordinates=frame.xyz, cell_lengths=frame.unitcell_lengths, cell_angles=frame.unitcell_angles, time=frame.time)
                 os.unlink("positions.xtc")
                 del archive, trj
 
-                # Append list of processed files
+                # Append list of processed files, and the frames appended from this one
                 trj_file._handle.root.processed_filenames.append([filename])
+                frameindex.append_packet_frames(trj_file, filename, first_frame)
 
                 # Flush data
                 trj_file.flush()
@@ -226,17 +250,26 @@ def concatenate_core17(path, top_filename, output_filename, maxtime=None, maxpac
             # Track statistics on processed packets
             elapsed_time = time.time() - initial_time
             result_packets_processed += 1
+            statistics['packets'] += 1
+            statistics['frames'] += n_frames
+            statistics['input_bytes'] += os.path.getsize(absfilename)
+            statistics['compressed_bytes'] += os.path.getsize(absfilename)
 
             # Return if we have processed the requested number of results packets.
             if maxpackets and (result_packets_processed >= maxpackets):
                 break
 
-    except RuntimeError:
+    except RuntimeError as e:
         print("Cannot munge %s due to damaged XTC %s or mismatch with topology file." % (path, filename))
+        statistics['failures'] = 1
+        statistics['error'] = e.__class__.__name__
 
     # Clean up.
     trj_file.close()
     del top, trj_file
+    statistics['output_bytes'] += max(os.path.getsize(output_filename) - initial_size, 0)
+    statistics['task_seconds'] = time.time() - task_initial_time
+    return statistics
 
 def concatenate_ocore(path, top_filename, output_filename):
     """Concatenate XTC files created by Siegetank OCore.
@@ -281,7 +314,9 @@ def concatenate_ocore(path, top_filename, output_filename):
         xtc_filename = os.path.join(folder, "frames.xtc")
         trj = md.load(xtc_filename, top=top)
 
+        first_frame = len(trj_file) if ('coordinates' in trj_file._handle.root) else 0
         for frame in trj:
             trj_file.write(coordinates=frame.xyz, cell_lengths=frame.unitcell_lengths, cell_angles=frame.unitcell_angles, time=frame.time)
 
         trj_file._handle.root.processed_folders.append([folder])
+        frameindex.append_packet_frames(trj_file, folder, first_frame)
@@ -0,0 +1,252 @@
+"""
+Per-packet frame index of munged trajectories.
+
+Each munged trajectory records, in a `frame_index` table, the range of its frames that was
+appended from each result packet, along with the simulation times of the first and last of
+those frames. A row is added whenever a packet is appended, alongside the processed packet
+ledger, so a bad frame can be traced back to its work unit and the frames of particular packets
+(e.g. gens 50-60) can be loaded without scanning the whole trajectory.
+
+Discontinuities in simulation time found while appending a packet (see core21.TimeContinuity)
+are recorded in the packet's `flags`, along with the number of duplicate frames dropped.
+
+Trajectories munged before the index was introduced only index the packets appended since.
+
+"""
+##############################################################################
+# imports
+##############################################################################
+
+from __future__ import print_function, division
+import os, os.path
+import re
+import bisect
+import numpy as np
+import tables
+import mdtraj as md
+from mdtraj.formats.hdf5 import HDF5TrajectoryFile
+
+##############################################################################
+# frame index
+##############################################################################
+
+MAX_PACKET_LENGTH = 1024 # maximum length of result packet paths, as in the processed packet ledger
+
+# Bits of the flags column
+DUPLICATES_DROPPED = 1 # leading frames repeating the last frame already appended were dropped
+TIME_GAP = 2 # simulation time advanced by more than expected between consecutive frames
+TIME_RESET = 4 # simulation time did not increase between consecutive frames (e.g. the packet restarted or overlaps the previous one)
+
+FLAG_NAMES = [ (DUPLICATES_DROPPED, 'duplicates dropped'), (TIME_GAP, 'time gap'), (TIME_RESET, 'time reset') ]
+
+def describe_flags(flags):
+    """
+    Return a comma-separated description of the bits set in a flags value, e.g. 'time gap, time reset'.
+    """
+    return ', '.join(name for (bit, name) in FLAG_NAMES if flags & bit)
+
+class FrameIndexRow(tables.IsDescription):
+    """
+    Frames appended to a munged trajectory from one result packet.
+    """
+    packet = tables.StringCol(MAX_PACKET_LENGTH, pos=0) # result packet path, as recorded in the processed packet ledger
+    packet_number = tables.Int64Col(pos=1) # FRAME (gen) number of the result packet, or -1 if unknown
+    first_frame = tables.Int64Col(pos=2) # index of the first frame in the munged trajectory
+    n_frames = tables.Int64Col(pos=3) # number of frames appended
+    first_time = tables.Float64Col(pos=4) # simulation time (ps) of the first frame appended, or NaN if none
+    last_time = tables.Float64Col(pos=5) # simulation time (ps) of the last frame appended, or NaN if none
+    flags = tables.Int32Col(pos=6) # time discontinuities found in the packet (DUPLICATES_DROPPED, TIME_GAP, TIME_RESET)
+    n_dropped = tables.Int64Col(pos=7) # number of duplicate frames dropped from the packet
+
+PACKET_NUMBER_PATTERN = re.compile(r'^(?:results|frame)-?(\d+)(?:\.tar\.bz2)?$')
+
+def packet_number(result_packet):
+    """
+    Return the FRAME (gen) number of a result packet from its name (e.g. results12 or results-012.tar.bz2), or -1 if it has none.
+    """
+    match = PACKET_NUMBER_PATTERN.match(os.path.basename(os.path.normpath(result_packet)))
+    return int(match.group(1)) if match else -1
+
+def append_packet_frames(trj_file, result_packet, first_frame, flags=0, n_dropped=0):
+    """
+    Record the frames appended to an open munged trajectory from a result packet.
+
+    Call this after the packet's frames have been written, with the number of frames the trajectory had before.
+
+    Parameters
+    ----------
+    trj_file : mdtraj.formats.HDF5TrajectoryFile
+        Open munged trajectory
+    result_packet : str
+        Result packet path, as recorded in the processed packet ledger
+    first_frame : int
+        Number of frames in the trajectory before the packet was appended
+    flags : int, optional, default=0
+        Time discontinuities found in the packet (bits DUPLICATES_DROPPED, TIME_GAP, TIME_RESET)
+    n_dropped : int, optional, default=0
+        Number of duplicate frames dropped from the packet
+
+    """
+    handle = trj_file._handle
+    if 'frame_index' not in handle.root:
+        handle.create_table(handle.root, 'frame_index', FrameIndexRow, 'Frames appended from each result packet')
+    n_total = handle.root.time.shape[0] if ('time' in handle.root) else 0
+    n_frames = n_total - first_frame
+    (first_time, last_time) = (np.nan, np.nan)
+    if n_frames > 0:
+        (first_time, last_time) = (float(handle.root.time[first_frame]), float(handle.root.time[n_total - 1]))
+    handle.root.frame_index.append([ (result_packet.encode('utf-8'), packet_number(result_packet), first_frame, n_frames, first_time, last_time, flags, n_dropped) ])
+
+def copy_frame_index(source_trj_file, trj_file):
+    """
+    Append the frame index rows of a munged trajectory that are missing from another with the same frames (e.g. a copy with fewer atoms).
+
+    Parameters
+    ----------
+    source_trj_file : mdtraj.formats.HDF5TrajectoryFile
+        Open munged trajectory whose frame index is copied
+    trj_file : mdtraj.formats.HDF5TrajectoryFile
+        Open munged trajectory with the same frames (or a prefix of them)
+
+    """
+    source = source_trj_file._handle.root
+    if 'frame_index' not in source:
+        return
+    handle = trj_file._handle
+    if 'frame_index' not in handle.root:
+        handle.create_table(handle.root, 'frame_index', FrameIndexRow, 'Frames appended from each result packet')
+    n_rows = handle.root.frame_index.nrows
+    if source.frame_index.nrows > n_rows:
+        handle.root.frame_index.append(source.frame_index.read(start=n_rows))
+
+class FrameIndex(object):
+    """
+    Lookups in the frame index of a munged trajectory.
+
+    The index is read once; looking up the frames of a packet takes constant time, and finding the packet
+    of a frame takes logarithmic time in the number of packets.
+
+    Parameters
+    ----------
+    filename : str
+        Path to munged trajectory
+
+    """
+    def __init__(self, filename):
+        with tables.open_file(filename, mode='r') as handle:
+            rows = handle.root.frame_index.read() if ('frame_index' in handle.root) else None
+        self.packets = list()
+        self.packet_numbers = list()
+        self.first_frames = list()
+        self.n_frames = list()
+        self.first_times = list()
+        self.last_times = list()
+        self.flags = list()
+        self.n_dropped = list()
+        if rows is not None:
+            self.packets = [ packet.decode('utf-8') if isinstance(packet, bytes) else packet for packet in rows['packet'] ]
+            self.packet_numbers = [ int(number) for number in rows['packet_number'] ]
+            self.first_frames = [ int(frame) for frame in rows['first_frame'] ]
+            self.n_frames = [ int(n) for n in rows['n_frames'] ]
+            self.first_times = [ float(t) for t in rows['first_time'] ]
+            self.last_times = [ float(t) for t in rows['last_time'] ]
+            self.flags = [ int(flags) for flags in rows['flags'] ]
+            self.n_dropped = [ int(n) for n in rows['n_dropped'] ]
+        self._by_packet = dict((packet, index) for (index, packet) in enumerate(self.packets))
+        self._by_number = dict((number, index) for (index, number) in enumerate(self.packet_numbers) if number >= 0)
+
+    def __len__(self):
+        return len(self.packets)
+
+    def _row(self, packet):
+        if isinstance(packet, str) and (packet in self._by_packet):
+            return self._by_packet[packet]
+        number = packet if isinstance(packet, (int, np.integer)) else packet_number(packet)
+        if number in self._by_number:
+            return self._by_number[number]
+        raise KeyError("Result packet %r is not in the frame index" % (packet,))
+
+    def frame_range(self, packet):
+        """
+        Return the range of frames appended from a result packet.
+
+        Parameters
+        ----------
+        packet : str or int
+            Result packet path (as recorded in the processed packet ledger), or its FRAME (gen) number
+
+        Returns
+        -------
+        start, stop : int
+            The packet's frames are start, start + 1, ..., stop - 1
+
+        Raises
+        ------
+        KeyError
+            If the packet is not in the index
+
+        """
+        index = self._row(packet)
+        return (self.first_frames[index], self.first_frames[index] + self.n_frames[index])
+
+    def time_range(self, packet):
+        """
+        Return the simulation times (in ps) of the first and last frames appended from a result packet (NaN if there were none).
+        """
+        index = self._row(packet)
+        return (self.first_times[index], self.last_times[index])
+
+    def packet_flags(self, packet):
+        """
+        Return the time discontinuities found in a result packet (bits DUPLICATES_DROPPED, TIME_GAP, TIME_RESET) and the number of duplicate frames dropped from it.
+        """
+        index = self._row(packet)
+        return (self.flags[index], self.n_dropped[index])
+
+    def discontinuities(self):
+        """
+        Return (packet, flags, n_dropped) for each indexed result packet in which time discontinuities were found, in the order appended.
+        """
+        return [ (packet, flags, n_dropped) for (packet, flags, n_dropped) in zip(self.packets, self.flags, self.n_dropped) if flags ]
+
+    def packet_of_frame(self, frame):
+        """
+        Return the path of the result packet a frame was appended from, or None if it predates the index.
+        """
+        index = bisect.bisect_right(self.first_frames, frame) - 1
+        while (index >= 0) and (self.n_frames[index] == 0):
+            index -= 1
+        if (index < 0) or (frame >= self.first_frames[index] + self.n_frames[index]):
+            return None
+        return self.packets[index]
+
+def load_packet_frames(filename, packets, atom_indices=None):
+    """
+    Load only the frames of a munged trajectory that were appended from the given result packets.
+
+    Parameters
+    ----------
+    filename : str
+        Path to munged trajectory
+    packets : list of str or int
+        Result packet paths or FRAME (gen) numbers, e.g. range(50, 61)
+    atom_indices : array_like of int, optional, default=None
+        If specified, only these atoms are loaded
+
+    Returns
+    -------
+    trajectory : mdtraj.Trajectory or None
+        The frames of the packets, in the order given, or None if they have no frames
+
+    """
+    frame_index = FrameIndex(filename)
+    ranges = [ frame_index.frame_range(packet) for packet in packets ]
+    trajectories = list()
+    with HDF5TrajectoryFile(filename, mode='r') as trj_file:
+        for (start, stop) in ranges:
+            if stop > start:
+                trj_file.seek(start)
+                trajectories.append(trj_file.read_as_traj(n_frames=stop - start, atom_indices=atom_indices))
+    if not trajectories:
+        return None
+    return md.join(trajectories, check_topology=False)
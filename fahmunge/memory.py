@@ -0,0 +1,89 @@
+"""
+Per-worker memory budgets: resident set size monitoring and adaptive chunk sizing.
+
+Worker processes accumulate memory (topologies, PyTables caches, fragmented heaps) that is rarely
+returned to the operating system. With a memory budget, a worker that exceeds it finishes the result
+packet it is working on and defers the rest of its task to the next iteration; pool workers are
+replaced by fresh processes after each task (see maxtasksperchild of multiprocessing.Pool).
+
+"""
+##############################################################################
+# imports
+##############################################################################
+
+from __future__ import print_function, division
+import os
+import sys
+import resource
+
+##############################################################################
+# memory usage
+##############################################################################
+
+def current_rss():
+    """
+    Determine the resident set size of the current process.
+
+    Returns
+    -------
+    rss : int
+        Resident set size in bytes. On platforms without /proc, the peak resident set size is returned instead.
+
+    """
+    try:
+        with open('/proc/self/statm') as infile:
+            return int(infile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is reported in bytes on macOS and kilobytes elsewhere
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def adaptive_chunksize(n_atoms, memory_limit, default_chunksize=10, max_chunksize=1000, fraction=0.25):
+    """
+    Choose the number of frames to decode at once so that chunk buffers fit within a memory budget.
+
+    Decoding a chunk of an XTC file requires float32 coordinates for every atom in the system
+    (atom subsetting happens after decompression), and mdtraj holds a few copies of them.
+
+    Parameters
+    ----------
+    n_atoms : int
+        Number of atoms in the full (unstripped) system
+    memory_limit : int or None
+        Per-worker memory budget in bytes; if None, `default_chunksize` is returned
+    default_chunksize : int, optional, default=10
+        Chunk size to use without a budget
+    max_chunksize : int, optional, default=1000
+        Largest chunk size to use; larger chunks give diminishing returns
+    fraction : float, optional, default=0.25
+        Fraction of the budget to devote to chunk buffers
+
+    Returns
+    -------
+    chunksize : int
+        Number of frames per chunk
+
+    """
+    if not memory_limit:
+        return default_chunksize
+    BUFFER_COPIES = 3 # decoded coordinates, subset coordinates, and the HDF5 write buffer
+    bytes_per_frame = BUFFER_COPIES * 3 * 4 * max(n_atoms, 1)
+    chunksize = int(fraction * memory_limit // bytes_per_frame)
+    return max(1, min(chunksize, max_chunksize))
+
+def exceeds_budget(memory_limit):
+    """
+    Determine whether the current process has exceeded its memory budget.
+
+    Parameters
+    ----------
+    memory_limit : int or None
+        Memory budget in bytes; if None, the budget is never exceeded
+
+    Returns
+    -------
+    exceeded : bool
+        True if the resident set size is larger than `memory_limit`
+
+    """
+    return bool(memory_limit) and (current_rss() > memory_limit)
@@ -0,0 +1,277 @@
+"""
+Throughput metrics for the munging daemon, exported as a Prometheus node-exporter textfile.
+
+Workers return a record of per-CLONE counters (see `clone_statistics()`), which the parent
+process accumulates per project and periodically writes out with `write_textfile()`.
+The node-exporter textfile collector picks the file up; no live service is needed.
+
+The records of each iteration are also aggregated by an `IterationSummary`, which can be
+appended to a JSON Lines history file with `append_history()` for capacity planning.
+
+"""
+##############################################################################
+# imports
+##############################################################################
+
+from __future__ import print_function, division
+import os, os.path
+import tempfile
+import collections
+import datetime
+import json
+
+##############################################################################
+# per-CLONE statistics
+##############################################################################
+
+# Counters returned by workers for each CLONE processed, with their Prometheus help text
+COUNTERS = collections.OrderedDict([
+    ('packets', 'Result packets appended to munged trajectories'),
+    ('frames', 'Frames appended to munged trajectories'),
+    ('duplicate_frames', 'Frames dropped because they repeated the last frame already appended'),
+    ('time_discontinuities', 'Result packets with gaps or resets in simulation time'),
+    ('input_bytes', 'Bytes of result packets read (compressed size for archives, positions.xtc size for directories)'),
+    ('compressed_bytes', 'Bytes of compressed result packets unpacked'),
+    ('uncompressed_bytes', 'Bytes of uncompressed trajectory data read'),
+    ('output_bytes', 'Bytes by which munged trajectories grew'),
+    ('listdir_seconds', 'Seconds spent listing CLONE directories for result packets'),
+    ('topology_seconds', 'Seconds spent reading topologies and selecting atoms'),
+    ('decompress_seconds', 'Seconds spent unpacking compressed result packets'),
+    ('verify_seconds', 'Seconds spent verifying the integrity of unpacked result packets'),
+    ('decode_seconds', 'Seconds spent decoding trajectory data'),
+    ('write_seconds', 'Seconds spent writing munged trajectories'),
+    ('task_seconds', 'Seconds spent in worker tasks'),
+    ('failures', 'CLONEs whose processing raised an exception'),
+    ('memory_exceeded', 'CLONEs whose processing was cut short because the worker exceeded its memory budget'),
+    ('terminated', 'CLONEs whose processing was cut short by a signal or time limit'),
+    ('recycles', 'Worker tasks cut short, deferring the rest of their batch, after the worker exceeded its memory budget'),
+    ])
+
+def clone_statistics():
+    """
+    Create an empty record for processing a single CLONE.
+
+    Returns
+    -------
+    statistics : dict
+        statistics[name] is zero for every counter name in COUNTERS, and statistics['error']
+        (the class name of the exception that stopped processing, if any) is None
+
+    """
+    statistics = { name : 0 for name in COUNTERS }
+    statistics['error'] = None
+    return statistics
+
+def accumulate_statistics(total, statistics):
+    """
+    Add the counters in `statistics` into `total` in place.
+
+    Parameters
+    ----------
+    total : dict
+        Running totals, as created by clone_statistics(); the first error encountered is kept
+    statistics : dict or None
+        Counters returned by a worker; None (e.g. a task that never ran) is ignored
+
+    """
+    if not statistics:
+        return
+    for name in COUNTERS:
+        total[name] += statistics.get(name, 0)
+    if statistics.get('error') and not total.get('error'):
+        total['error'] = statistics['error']
+
+def task_outcome(statistics):
+    """
+    Classify the record of a single task.
+
+    Returns
+    -------
+    outcome : str
+        'failed', 'terminated', 'deferred' (memory budget exceeded), 'appended' (packets were appended), or 'unchanged'
+
+    """
+    if statistics['failures']:
+        return 'failed'
+    elif statistics['terminated']:
+        return 'terminated'
+    elif statistics['memory_exceeded']:
+        return 'deferred'
+    elif statistics['packets']:
+        return 'appended'
+    return 'unchanged'
+
+##############################################################################
+# iteration summaries
+##############################################################################
+
+class IterationSummary(object):
+    """
+    Aggregate the records returned by the tasks of one iteration.
+
+    Parameters
+    ----------
+    iteration : int, optional, default=None
+        Iteration number, if any
+
+    """
+    def __init__(self, iteration=None):
+        self.iteration = iteration
+        self.totals = clone_statistics()
+        self.projects = collections.defaultdict(clone_statistics)
+        self.outcomes = collections.Counter()
+        self.errors = collections.Counter()
+
+    def add(self, project, statistics):
+        """
+        Add the record returned for one task.
+
+        Parameters
+        ----------
+        project : str
+            Project the task belongs to
+        statistics : dict or None
+            Record returned by the task; None (e.g. a task that never ran) is ignored
+
+        """
+        if not statistics:
+            return
+        accumulate_statistics(self.totals, statistics)
+        accumulate_statistics(self.projects[project], statistics)
+        self.outcomes[task_outcome(statistics)] += 1
+        if statistics.get('error'):
+            self.errors[statistics['error']] += 1
+
+    def record(self, elapsed_seconds):
+        """
+        Return the summary as a JSON-serializable dict.
+
+        Parameters
+        ----------
+        elapsed_seconds : float
+            Wall-clock duration of the iteration
+
+        """
+        def counters(statistics):
+            return collections.OrderedDict((name, statistics[name]) for name in COUNTERS)
+        return collections.OrderedDict([
+            ('time', datetime.datetime.now().isoformat()),
+            ('iteration', self.iteration),
+            ('elapsed_seconds', elapsed_seconds),
+            ('tasks', sum(self.outcomes.values())),
+            ('outcomes', dict(self.outcomes)),
+            ('errors', dict(self.errors)),
+            ('totals', counters(self.totals)),
+            ('projects', collections.OrderedDict((str(project), counters(self.projects[project])) for project in sorted(self.projects, key=str))),
+            ])
+
+    def format(self):
+        """
+        Render a one-line summary of the iteration.
+        """
+        text = '%d tasks (%s); %d packets, %d frames, %.1f MB read, %.1f MB written' % (sum(self.outcomes.values()),
+            ', '.join('%d %s' % (self.outcomes[outcome], outcome) for outcome in sorted(self.outcomes)),
+            self.totals['packets'], self.totals['frames'], self.totals['input_bytes'] / 1.0e6, self.totals['output_bytes'] / 1.0e6)
+        if self.errors:
+            text += '; errors: %s' % ', '.join('%s x%d' % (error, count) for (error, count) in sorted(self.errors.items()))
+        return text
+
+def append_history(filename, record):
+    """
+    Append a record (e.g. IterationSummary.record()) to a JSON Lines history file.
+    """
+    with open(filename, 'a') as outfile:
+        outfile.write(json.dumps(record) + '\n')
+
+class Metrics(object):
+    """
+    Accumulate per-project counters over the lifetime of the daemon.
+
+    """
+    def __init__(self):
+        self.counters = collections.defaultdict(clone_statistics)
+        self.backlog = dict()
+        self.iterations = 0
+        self.iteration_seconds = 0.0
+
+    def add_clone(self, project, statistics):
+        """
+        Accumulate the counters returned by a worker for one CLONE.
+
+        Parameters
+        ----------
+        project : str
+            Project the CLONE belongs to
+        statistics : dict or None
+            Counters returned by the worker; None (e.g. a task that never ran) is ignored
+
+        """
+        accumulate_statistics(self.counters[str(project)], statistics)
+
+    def set_backlog(self, project, n_clones):
+        """
+        Record the number of CLONEs queued for processing in a project this iteration.
+        """
+        self.backlog[str(project)] = n_clones
+        # Make sure every project appears in the export even before any work completes
+        self.counters[str(project)]
+
+    def finish_iteration(self, elapsed_seconds):
+        """
+        Record the completion of an iteration that took `elapsed_seconds`.
+        """
+        self.iterations += 1
+        self.iteration_seconds = elapsed_seconds
+
+    def format(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+
+        Returns
+        -------
+        text : str
+            Metrics text
+
+        """
+        lines = list()
+        for name, help_text in COUNTERS.items():
+            metric = 'fahmunge_%s_total' % name
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s counter' % metric)
+            for project in sorted(self.counters):
+                lines.append('%s{project="%s"} %s' % (metric, project, repr(self.counters[project][name])))
+        lines.append('# HELP fahmunge_backlog_clones CLONEs queued for processing in the current iteration')
+        lines.append('# TYPE fahmunge_backlog_clones gauge')
+        for project in sorted(self.backlog):
+            lines.append('fahmunge_backlog_clones{project="%s"} %d' % (project, self.backlog[project]))
+        lines.append('# HELP fahmunge_iterations_total Munging iterations completed')
+        lines.append('# TYPE fahmunge_iterations_total counter')
+        lines.append('fahmunge_iterations_total %d' % self.iterations)
+        lines.append('# HELP fahmunge_iteration_duration_seconds Duration of the last completed iteration')
+        lines.append('# TYPE fahmunge_iteration_duration_seconds gauge')
+        lines.append('fahmunge_iteration_duration_seconds %s' % repr(self.iteration_seconds))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, filename):
+        """
+        Atomically write all metrics to a node-exporter textfile.
+
+        The metrics are written to a temporary file in the same directory and renamed into place,
+        so the collector never sees a partially written file.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the textfile (should end in .prom)
+
+        """
+        dirname = os.path.dirname(os.path.abspath(filename))
+        (fd, temporary_filename) = tempfile.mkstemp(dir=dirname, prefix='.fahmunge-', suffix='.prom.tmp')
+        try:
+            with os.fdopen(fd, 'w') as outfile:
+                outfile.write(self.format())
+            os.chmod(temporary_filename, 0o644)
+            os.rename(temporary_filename, filename)
+        except Exception:
+            os.unlink(temporary_filename)
+            raise
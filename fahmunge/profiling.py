@@ -0,0 +1,152 @@
+"""
+Lightweight per-stage timing and optional cProfile support for munging workers.
+
+"""
+##############################################################################
+# imports
+##############################################################################
+
+from __future__ import print_function, division
+import os, os.path
+import glob
+import time
+import tempfile
+import contextlib
+import cProfile
+import pstats
+
+##############################################################################
+# stage timing
+##############################################################################
+
+# Stages of CLONE processing, in pipeline order
+STAGES = ['listdir', 'topology', 'decompress', 'verify', 'decode', 'write']
+
+class StageTimer(object):
+    """
+    Accumulate wall-clock time spent in each processing stage into a statistics dict.
+
+    Time spent in stage `name` is added to statistics['%s_seconds' % name]. Updates are not atomic, so
+    a timer must be used by one thread only; other threads should use their own timers, whose totals
+    are merged into this one with merge() once they have finished.
+
+    Parameters
+    ----------
+    statistics : dict, optional, default=None
+        Dict to accumulate into; if None, a new dict is created.
+
+    Examples
+    --------
+    >>> timer = StageTimer()
+    >>> with timer.stage('decode'):
+    ...     pass
+    >>> 'decode_seconds' in timer.statistics
+    True
+
+    """
+    def __init__(self, statistics=None):
+        self.statistics = statistics if (statistics is not None) else dict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        initial_time = time.time()
+        try:
+            yield
+        finally:
+            key = '%s_seconds' % name
+            self.statistics[key] = self.statistics.get(key, 0) + (time.time() - initial_time)
+
+    def merge(self, timer):
+        """
+        Add the stage times accumulated by another timer to this one.
+        """
+        for (key, seconds) in timer.statistics.items():
+            self.statistics[key] = self.statistics.get(key, 0) + seconds
+
+def print_stage_summary(statistics, elapsed_seconds, nprocesses):
+    """
+    Print a summary of where time was spent during an iteration.
+
+    Parameters
+    ----------
+    statistics : dict
+        Counters summed over all CLONEs processed this iteration
+    elapsed_seconds : float
+        Wall-clock time spent processing CLONEs this iteration
+    nprocesses : int
+        Number of worker processes
+
+    """
+    available_seconds = elapsed_seconds * nprocesses
+    if available_seconds <= 0:
+        return
+    print('Stage timing (summed over workers, %.1f s wall clock x %d processes):' % (elapsed_seconds, nprocesses))
+    for stage in STAGES:
+        seconds = statistics.get('%s_seconds' % stage, 0)
+        print('  %-12s %10.2f s (%5.1f%%)' % (stage, seconds, 100.0 * seconds / available_seconds))
+    # Whatever is not spent inside tasks is pool dispatch overhead or idle workers
+    overhead_seconds = max(available_seconds - statistics.get('task_seconds', 0), 0)
+    print('  %-12s %10.2f s (%5.1f%%)' % ('pool/idle', overhead_seconds, 100.0 * overhead_seconds / available_seconds))
+
+##############################################################################
+# cProfile support
+##############################################################################
+
+def profile_call(profile_directory, function, *args, **kwargs):
+    """
+    Call a function under cProfile, dumping the profile into a directory shared by all workers.
+
+    Parameters
+    ----------
+    profile_directory : str
+        Directory into which a uniquely-named .prof dump is written
+    function : callable
+        Function to call with the remaining arguments
+
+    Returns
+    -------
+    result
+        The return value of `function`
+
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profiler.disable()
+        (fd, filename) = tempfile.mkstemp(dir=profile_directory, prefix='task-%d-' % os.getpid(), suffix='.prof')
+        os.close(fd)
+        profiler.dump_stats(filename)
+
+def merge_profiles(profile_directory, output_filename=None, n_lines=25):
+    """
+    Merge all worker profile dumps in a directory into a single report.
+
+    Parameters
+    ----------
+    profile_directory : str
+        Directory containing .prof dumps written by `profile_call`
+    output_filename : str, optional, default=None
+        If specified, the merged profile will be written here for later inspection (e.g. with snakeviz)
+    n_lines : int, optional, default=25
+        Number of functions to print, sorted by cumulative time
+
+    Returns
+    -------
+    stats : pstats.Stats or None
+        Merged statistics, or None if no profiles were found
+
+    """
+    filenames = sorted(glob.glob(os.path.join(profile_directory, '*.prof')))
+    if len(filenames) == 0:
+        return None
+    stats = pstats.Stats(filenames[0])
+    for filename in filenames[1:]:
+        stats.add(filename)
+    print('Merged profile of %d tasks:' % len(filenames))
+    stats.sort_stats('cumulative').print_stats(n_lines)
+    if output_filename:
+        stats.dump_stats(output_filename)
+        print("Merged profile written to '%s'" % output_filename)
+    return stats
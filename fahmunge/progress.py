@@ -0,0 +1,229 @@
+"""
+Live progress reporting for munging iterations.
+
+Workers send small progress messages over a multiprocessing queue as they append result packets
+and finish CLONEs. A thread in the main process consumes them, periodically prints a status line
+(completed CLONEs, frames per second, MB/s decompressed, and an ETA), and atomically rewrites a
+JSON status file with the same information plus per-project completion.
+
+Messages are tuples:
+
+* ('packets', clone_path, n_packets, n_frames, uncompressed_bytes) when result packets are appended
+  (or, with n_packets=0, decoded)
+* ('clone', clone_path) when a CLONE is finished
+
+"""
+##############################################################################
+# imports
+##############################################################################
+
+from __future__ import print_function, division
+import os, os.path
+import time
+import datetime
+import json
+import tempfile
+import threading
+import collections
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+##############################################################################
+# progress
+##############################################################################
+
+def format_duration(seconds):
+    """
+    Format a duration in seconds as H:MM:SS.
+    """
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+class Progress(object):
+    """
+    Track the progress of one iteration from messages sent by workers.
+
+    CLONEs are added as they are discovered and dispatched, so the total is not known (and no ETA
+    is estimated) until finish_discovery() is called.
+
+    Parameters
+    ----------
+    iteration : int
+        Iteration number
+    interval : float, optional, default=60
+        Time (in seconds) between status lines
+    status_filename : str, optional, default=None
+        If specified, a JSON status file rewritten at each status line and when the iteration finishes
+
+    """
+    def __init__(self, iteration, interval=60, status_filename=None):
+        self.iteration = iteration
+        self.interval = interval
+        self.status_filename = status_filename
+        self.clone_projects = dict()
+        self.clone_costs = dict()
+        self.total_cost = 0
+        self.discovery_complete = False
+        self.project_clones = collections.Counter()
+        self.project_done = collections.Counter()
+        self.finished_clones = set()
+        self.done_cost = 0
+        self.packets = 0
+        self.frames = 0
+        self.uncompressed_bytes = 0
+        self.initial_time = time.time()
+        self.queue = multiprocessing.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, clone_path, project, cost=None):
+        """
+        Add a CLONE to be processed this iteration.
+
+        Parameters
+        ----------
+        clone_path : str
+            Source CLONE directory
+        project : str
+            Project
+        cost : float, optional, default=None
+            Predicted cost of the CLONE (in any units); if every CLONE has a cost, the ETA weights CLONEs by cost rather than counting them
+
+        """
+        with self._lock:
+            if clone_path in self.clone_projects:
+                return
+            self.clone_projects[clone_path] = str(project)
+            self.project_clones[str(project)] += 1
+            if cost is not None:
+                self.clone_costs[clone_path] = cost
+                self.total_cost += cost
+
+    def finish_discovery(self):
+        """
+        Record that all CLONEs to be processed this iteration have been added.
+        """
+        with self._lock:
+            self.discovery_complete = True
+
+    def handle(self, message):
+        """
+        Update the progress with a message.
+        """
+        with self._lock:
+            if message[0] == 'packets':
+                (kind, clone_path, n_packets, n_frames, uncompressed_bytes) = message
+                self.packets += n_packets
+                self.frames += n_frames
+                self.uncompressed_bytes += uncompressed_bytes
+            elif message[0] == 'clone':
+                clone_path = message[1]
+                if (clone_path in self.clone_projects) and (clone_path not in self.finished_clones):
+                    self.finished_clones.add(clone_path)
+                    self.project_done[self.clone_projects[clone_path]] += 1
+                    self.done_cost += self.clone_costs.get(clone_path, 0)
+
+    def status(self):
+        """
+        Return the current progress as a JSON-serializable dict.
+        """
+        with self._lock:
+            elapsed_seconds = time.time() - self.initial_time
+            n_clones = len(self.clone_projects)
+            n_done = len(self.finished_clones)
+            if (len(self.clone_costs) == n_clones) and (self.total_cost > 0):
+                fraction = self.done_cost / self.total_cost
+            else:
+                fraction = (n_done / n_clones) if n_clones else (1.0 if self.discovery_complete else 0.0)
+            eta_seconds = elapsed_seconds * (1.0 - fraction) / fraction if (self.discovery_complete and (fraction > 0)) else None
+            return collections.OrderedDict([
+                ('time', datetime.datetime.now().isoformat()),
+                ('iteration', self.iteration),
+                ('elapsed_seconds', elapsed_seconds),
+                ('clones_done', n_done),
+                ('clones_total', n_clones),
+                ('discovery_complete', self.discovery_complete),
+                ('fraction_done', fraction),
+                ('eta_seconds', eta_seconds),
+                ('packets', self.packets),
+                ('frames', self.frames),
+                ('frames_per_second', self.frames / elapsed_seconds if (elapsed_seconds > 0) else 0.0),
+                ('uncompressed_mb_per_second', self.uncompressed_bytes / 1.0e6 / elapsed_seconds if (elapsed_seconds > 0) else 0.0),
+                ('projects', collections.OrderedDict((project, collections.OrderedDict([('clones_done', self.project_done[project]), ('clones_total', n_project_clones)]))
+                    for (project, n_project_clones) in sorted(self.project_clones.items()))),
+                ])
+
+    def format(self, status=None):
+        """
+        Render a one-line status.
+        """
+        status = status or self.status()
+        eta = 'unknown' if (status['eta_seconds'] is None) else format_duration(status['eta_seconds'])
+        total = ('%d' if status['discovery_complete'] else '%d+') % status['clones_total']
+        return 'Progress: %d/%s CLONEs (%.1f%%), %d packets, %.1f frames/s, %.1f MB/s decompressed, elapsed %s, ETA %s' % (status['clones_done'], total,
+            100.0 * status['fraction_done'], status['packets'], status['frames_per_second'], status['uncompressed_mb_per_second'], format_duration(status['elapsed_seconds']), eta)
+
+    def write_status(self, status=None):
+        """
+        Atomically write the status file, if one was requested.
+        """
+        if not self.status_filename:
+            return
+        status = status or self.status()
+        dirname = os.path.dirname(os.path.abspath(self.status_filename))
+        (fd, temporary_filename) = tempfile.mkstemp(dir=dirname, prefix='.fahmunge-', suffix='.json.tmp')
+        try:
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(status, outfile, indent=2)
+            os.chmod(temporary_filename, 0o644)
+            os.rename(temporary_filename, self.status_filename)
+        except Exception:
+            os.unlink(temporary_filename)
+            raise
+
+    def report(self):
+        """
+        Print a status line and write the status file.
+        """
+        status = self.status()
+        print(self.format(status))
+        self.write_status(status)
+
+    def _consume(self):
+        next_report = time.time() + self.interval
+        while True:
+            try:
+                message = self.queue.get(timeout=max(0.0, next_report - time.time()))
+            except queue.Empty:
+                message = ()
+            if message is None:
+                return
+            if message:
+                self.handle(message)
+            if time.time() >= next_report:
+                self.report()
+                next_report = time.time() + self.interval
+
+    def start(self):
+        """
+        Start consuming messages from `queue` in a background thread.
+        """
+        self._thread = threading.Thread(target=self._consume, name='progress')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Consume any remaining messages, then write the final status file.
+        """
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self.write_status()
+        self.queue.close()
+        self.queue.join_thread()
@@ -0,0 +1,122 @@
+"""
+Quarantine of CLONEs whose processing keeps failing, with exponential backoff before each retry.
+
+A CLONE with a corrupt result packet would otherwise be retried (and fail) on every iteration.
+Each failure quarantines the CLONE for twice as long as the previous one, up to a maximum; a
+CLONE that is processed successfully is released. The quarantine list is a small JSON file
+(normally in the output directory) that is only written by the main process and survives restarts.
+
+"""
+##############################################################################
+# imports
+##############################################################################
+
+from __future__ import print_function, division
+import os, os.path
+import time
+import json
+import tempfile
+
+##############################################################################
+# quarantine
+##############################################################################
+
+# Longest time (in seconds) a CLONE is quarantined after repeated failures
+MAX_BACKOFF = 7 * 24 * 60 * 60
+
+def backoff_seconds(n_failures, initial_backoff, max_backoff=MAX_BACKOFF):
+    """
+    Return the time to wait before retrying a CLONE that has failed `n_failures` times in a row.
+    """
+    return min(initial_backoff * 2**min(max(n_failures - 1, 0), 32), max_backoff)
+
+class Quarantine(object):
+    """
+    Persistent list of quarantined CLONEs.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the JSON quarantine file; created when the first CLONE is quarantined.
+    initial_backoff : float
+        Time (in seconds) a CLONE is quarantined after its first failure; this doubles with each consecutive failure.
+    max_backoff : float, optional, default=MAX_BACKOFF
+        Longest time (in seconds) a CLONE is quarantined.
+
+    """
+    def __init__(self, filename, initial_backoff, max_backoff=MAX_BACKOFF):
+        self.filename = filename
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.clones = dict()
+        self.modified = False # True if the quarantine has changed since it was last saved
+        if os.path.exists(filename):
+            with open(filename) as infile:
+                self.clones = json.load(infile)
+
+    def is_quarantined(self, clone_path, now=None):
+        """
+        Return True if the CLONE is quarantined and should not be retried yet.
+        """
+        entry = self.clones.get(clone_path)
+        if entry is None:
+            return False
+        return (now if (now is not None) else time.time()) < entry['retry_after']
+
+    def due_for_retry(self, now=None):
+        """
+        Return the quarantined CLONEs whose backoff has expired.
+        """
+        now = now if (now is not None) else time.time()
+        return [ clone_path for (clone_path, entry) in self.clones.items() if now >= entry['retry_after'] ]
+
+    def record(self, clone_path, statistics, now=None):
+        """
+        Update the quarantine with the record returned for a CLONE.
+
+        A failure quarantines the CLONE; a task that finished without failing or being cut short releases it.
+
+        Parameters
+        ----------
+        clone_path : str
+            Source CLONE directory
+        statistics : dict or None
+            Record returned for the CLONE (see fahmunge.metrics.clone_statistics()); None is ignored
+
+        """
+        if not statistics:
+            return
+        now = now if (now is not None) else time.time()
+        if statistics['failures']:
+            entry = self.clones.get(clone_path, dict(failures=0))
+            entry['failures'] += 1
+            entry['error'] = statistics.get('error')
+            entry['last_failure'] = now
+            entry['retry_after'] = now + backoff_seconds(entry['failures'], self.initial_backoff, self.max_backoff)
+            self.clones[clone_path] = entry
+            print("Quarantining CLONE '%s' for %.0f seconds after %d consecutive failures (%s)" % (clone_path, entry['retry_after'] - now, entry['failures'], entry['error']))
+            self.modified = True
+        elif (clone_path in self.clones) and not (statistics['terminated'] or statistics['memory_exceeded']):
+            print("Releasing CLONE '%s' from quarantine" % clone_path)
+            del self.clones[clone_path]
+            self.modified = True
+
+    def save(self):
+        """
+        Atomically write the quarantine list if it has changed.
+        """
+        if not self.modified:
+            return
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        (fd, temporary_filename) = tempfile.mkstemp(dir=dirname, prefix='.fahmunge-', suffix='.json.tmp')
+        try:
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(self.clones, outfile, indent=2, sort_keys=True)
+            os.rename(temporary_filename, self.filename)
+            self.modified = False
+        except Exception:
+            os.unlink(temporary_filename)
+            raise
+
+    def __len__(self):
+        return len(self.clones)
@@ -0,0 +1,161 @@
+"""
+Dry-run reporting of the munging backlog.
+
+The report walks the same RUN/CLONE discovery path as the munging loop, but only lists
+result packets and reads the processed-packet ledger (from the state database if one is
+available, otherwise from the munged trajectories opened read-only). No trajectories are
+decoded, unpacked, or modified.
+
+"""
+##############################################################################
+# imports
+##############################################################################
+
+from __future__ import print_function, division
+import os, os.path
+import collections
+import json
+
+from fahmunge import automation
+from fahmunge import core21
+from fahmunge import statedb
+
+##############################################################################
+# backlog report
+##############################################################################
+
+def project_backlog(project, project_path, topology_filename, output_paths, state_database=None, clone_states=None):
+    """
+    Compute the pending work for a single project.
+
+    Parameters
+    ----------
+    project : str
+        Project
+    project_path : str
+        Path to FAH project data
+    topology_filename : str
+        Topology filename, which may contain '%(run)d'
+    output_paths : list of str
+        Paths in which munged trajectories for this project are stored, one per named selection;
+        a result packet is pending if any of them has not processed it
+    state_database : fahmunge.statedb.StateDatabase, optional, default=None
+        If specified, the processed-packet ledger is read from here rather than the munged trajectories
+    clone_states : dict, optional, default=None
+        Result of state_database.clone_states(), used to skip CLONEs unchanged since they were last processed
+
+    Returns
+    -------
+    backlog : collections.OrderedDict
+        Counts of CLONEs and pending packets and bytes
+
+    """
+    backlog = collections.OrderedDict([
+        ('project', str(project)),
+        ('n_clones', 0),
+        ('n_clones_pending', 0),
+        ('pending_packets', 0),
+        ('pending_compressed_packets', 0),
+        ('pending_compressed_bytes', 0),
+        ('pending_uncompressed_bytes', 0),
+        ])
+    for (run, clone, clone_path, pdb_filename, processed_clone_filenames) in automation.iterate_clones(project_path, topology_filename, output_paths):
+        backlog['n_clones'] += 1
+        if state_database and all(statedb.clone_is_unchanged(clone_states, clone_path, filename) for filename in processed_clone_filenames):
+            continue
+        pending_packets = core21.pending_result_packets(clone_path, processed_clone_filenames, state_database=state_database)
+        if len(pending_packets) == 0:
+            continue
+        backlog['n_clones_pending'] += 1
+        backlog['pending_packets'] += len(pending_packets)
+        for result_packet in pending_packets:
+            nbytes = core21.result_packet_size(result_packet)
+            if os.path.isdir(result_packet):
+                backlog['pending_uncompressed_bytes'] += nbytes
+            else:
+                backlog['pending_compressed_packets'] += 1
+                backlog['pending_compressed_bytes'] += nbytes
+    return backlog
+
+def estimate_seconds(backlog, bytes_per_second, nprocesses):
+    """
+    Estimate the wall-clock time needed to munge a backlog.
+
+    Parameters
+    ----------
+    backlog : dict
+        Result of project_backlog()
+    bytes_per_second : float or None
+        Recent per-worker throughput in result packet bytes per second
+    nprocesses : int
+        Number of worker processes
+
+    Returns
+    -------
+    seconds : float or None
+        Estimated time, or None if throughput is unknown
+
+    """
+    if not bytes_per_second:
+        return None
+    pending_bytes = backlog['pending_compressed_bytes'] + backlog['pending_uncompressed_bytes']
+    return pending_bytes / bytes_per_second / max(min(nprocesses, backlog['n_clones_pending']), 1)
+
+def report_backlog(projects, output_root, state_database=None, nprocesses=1, emit_json=False, strides=None):
+    """
+    Report the pending munging backlog for all projects.
+
+    Parameters
+    ----------
+    projects : pandas.DataFrame
+        Projects read from the projects CSV file
+    output_root : str
+        Output path for munged data
+    state_database : fahmunge.statedb.StateDatabase, optional, default=None
+        If specified, the ledger and recent throughput are read from here
+    nprocesses : int, optional, default=1
+        Number of worker processes to assume when estimating processing time
+    emit_json : bool, optional, default=False
+        If True, print the report as JSON; otherwise print a table
+    strides : dict of project : int, optional, default=None
+        Stride of the companion trajectories of each project, as returned by automation.pop_project_strides()
+
+    Returns
+    -------
+    report : dict
+        The report, with per-project backlogs under 'projects' and totals under 'total'
+
+    """
+    clone_states = state_database.clone_states() if state_database else None
+    overall_throughput = state_database.throughput() if state_database else None
+    backlogs = list()
+    for (project, project_path, topology_filename, topology_selection) in projects.itertuples():
+        output_path = os.path.join(output_root, "%s/" % project)
+        (output_paths, atom_selection_strings, output_strides) = automation.project_outputs(output_path, topology_selection, (strides or dict()).get(project, 0))
+        backlog = project_backlog(project, project_path, topology_filename, output_paths, state_database=state_database, clone_states=clone_states)
+        bytes_per_second = (state_database.throughput(project) if state_database else None) or overall_throughput
+        backlog['estimated_seconds'] = estimate_seconds(backlog, bytes_per_second, nprocesses)
+        backlogs.append(backlog)
+
+    total = collections.OrderedDict()
+    for key in ['n_clones', 'n_clones_pending', 'pending_packets', 'pending_compressed_packets', 'pending_compressed_bytes', 'pending_uncompressed_bytes']:
+        total[key] = sum(backlog[key] for backlog in backlogs)
+    estimates = [ backlog['estimated_seconds'] for backlog in backlogs ]
+    # Projects are munged concurrently by the same pool, so their estimates add up
+    total['estimated_seconds'] = None if (None in estimates) else sum(estimates)
+    report = collections.OrderedDict([('projects', backlogs), ('total', total)])
+
+    if emit_json:
+        print(json.dumps(report, indent=2))
+        return report
+
+    def format_estimate(seconds):
+        return 'unknown' if (seconds is None) else '%.0f s' % seconds
+
+    print('%10s %10s %10s %10s %14s %14s %12s' % ('project', 'clones', 'pending', 'packets', 'compressed MB', 'xtc MB', 'estimate'))
+    for backlog in backlogs + [ dict(total, project='total') ]:
+        print('%10s %10d %10d %10d %14.1f %14.1f %12s' % (backlog['project'], backlog['n_clones'], backlog['n_clones_pending'], backlog['pending_packets'],
+            backlog['pending_compressed_bytes'] / 1.0e6, backlog['pending_uncompressed_bytes'] / 1.0e6, format_estimate(backlog['estimated_seconds'])))
+    if not state_database:
+        print('Processing time can only be estimated when a state database (--statedb) has recorded recent throughput.')
+    return report
@@ -0,0 +1,147 @@
+"""
+Longest-processing-time-first scheduling of CLONEs with deadline-aware admission.
+
+The cost of a CLONE is estimated from the sizes of its pending result packets (compressed
+archives or uncompressed positions.xtc files) and the per-worker throughput recently recorded
+in the state database. Pending packets are estimated from directory listings and the state
+database only, since the main process would otherwise open every munged trajectory.
+Starting the most expensive CLONEs first keeps a large CLONE from starting just before the
+time limit while smaller ones sit idle behind it.
+
+Because a CLONE can be stopped between result packets and resumed in a later iteration,
+a CLONE is admitted if its first pending packet is predicted to finish before the time
+limit, even if the whole CLONE is not; the rest is deferred to a later iteration.
+
+"""
+##############################################################################
+# imports
+##############################################################################
+
+from __future__ import print_function, division
+import os, os.path
+import heapq
+
+from fahmunge import core21
+
+##############################################################################
+# scheduling
+##############################################################################
+
+def pending_packet_sizes(clone_path, processed_trajectory_filenames, state_database=None):
+    """
+    Estimate the size in bytes of each pending result packet of a CLONE, in processing order, without opening munged trajectories.
+
+    For a munged trajectory the state database tracks, packets missing from its ledger are pending. For any
+    other, packets modified since the trajectory was last written are assumed to be pending (all of them,
+    if it does not exist yet). A packet is pending if it is pending for any of the trajectories.
+
+    Parameters
+    ----------
+    clone_path : str
+        Path to CLONE directory containing ws8/ws9 WUs
+    processed_trajectory_filenames : list of str
+        Munged trajectories of the CLONE, one per named selection and stride
+    state_database : fahmunge.statedb.StateDatabase, optional, default=None
+        If specified, the processed-packet ledger is read from here where available
+
+    Returns
+    -------
+    sizes : list of int
+        Size of each pending result packet (see core21.result_packet_size())
+
+    """
+    if not os.path.isdir(clone_path):
+        return list()
+    result_packets = core21.list_core21_result_packets(clone_path)
+    pending = set()
+    for filename in processed_trajectory_filenames:
+        if not os.path.exists(filename):
+            pending = set(result_packets)
+            break
+        if state_database and (state_database.get_clone(filename) is not None):
+            processed_packets = state_database.processed_packets(filename)
+            pending.update(result_packet for result_packet in result_packets if not core21.result_packet_is_processed(result_packet, processed_packets))
+        else:
+            last_written = os.path.getmtime(filename)
+            for result_packet in result_packets:
+                try:
+                    if os.path.getmtime(result_packet) >= last_written:
+                        pending.add(result_packet)
+                except OSError:
+                    pass # e.g. an archive deleted once it was unpacked
+    return [ core21.result_packet_size(result_packet) for result_packet in result_packets if result_packet in pending ]
+
+def learned_throughput(project, state_database=None, metrics=None):
+    """
+    Return the recent per-worker throughput (in bytes per second) for a project, or None if unknown.
+
+    Parameters
+    ----------
+    project : str
+        Project
+    state_database : fahmunge.statedb.StateDatabase, optional, default=None
+        If specified, throughput is read from recorded iterations (falling back to all projects)
+    metrics : fahmunge.metrics.Metrics, optional, default=None
+        Otherwise, throughput is computed from the counters accumulated by this process
+
+    """
+    if state_database:
+        return state_database.throughput(project) or state_database.throughput()
+    if metrics:
+        counters = metrics.counters.get(str(project))
+        if counters and (counters['task_seconds'] > 0) and (counters['input_bytes'] > 0):
+            return counters['input_bytes'] / counters['task_seconds']
+    return None
+
+def plan_schedule(packet_costs, nworkers, remaining=None, free=None):
+    """
+    Order CLONEs longest-processing-time first, and decide which can be started within the remaining time.
+
+    Admission simulates greedy list scheduling: each CLONE (in LPT order) is assigned to the worker
+    predicted to become free first, and is admitted if its first pending packet is predicted to finish
+    within `remaining`. An admitted CLONE keeps its worker busy until it is predicted to finish, or
+    until the time runs out.
+
+    Parameters
+    ----------
+    packet_costs : list of list of float
+        Predicted cost of each pending result packet of each CLONE, in processing order
+    nworkers : int
+        Number of worker processes
+    remaining : float, optional, default=None
+        Remaining time, in the same units as packet_costs; if None, all CLONEs are admitted
+    free : list of float, optional, default=None
+        Time from now at which each worker is predicted to become free, in the same units as packet_costs;
+        updated in place, so that successive windows of CLONEs can be planned behind the work already admitted.
+        If None, all workers are assumed to be free now.
+
+    Returns
+    -------
+    admitted : list of int
+        Indices of CLONEs to start, in the order they should be started
+    deferred : list of int
+        Indices of CLONEs that are not predicted to make progress in the remaining time
+
+    """
+    costs = [ sum(costs) for costs in packet_costs ]
+    order = sorted(range(len(costs)), key=lambda index: -costs[index])
+    if remaining is None:
+        return (order, list())
+    if free is None:
+        free = [ 0.0 ] * max(nworkers, 1) # time at which each worker is predicted to become free
+    heapq.heapify(free)
+    admitted = list()
+    deferred = list()
+    for index in order:
+        if costs[index] <= 0:
+            # Nothing is pending, but the CLONE still needs to be checked
+            admitted.append(index)
+            continue
+        start = heapq.heappop(free)
+        if start + packet_costs[index][0] <= remaining:
+            admitted.append(index)
+            heapq.heappush(free, min(start + costs[index], remaining))
+        else:
+            deferred.append(index)
+            heapq.heappush(free, start)
+    return (admitted, deferred)
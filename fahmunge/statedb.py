@@ -0,0 +1,302 @@
+"""
+Optional central SQLite state database recording munging progress for each CLONE.
+
+The munged HDF5 files remain the source of truth: each one lists the result packets
+it already contains. The state database mirrors that information (plus the CLONE
+directory mtime and the last error seen) so that the scheduler can decide which
+CLONEs have new work without opening every HDF5 file on every iteration.
+
+"""
+##############################################################################
+# imports
+##############################################################################
+
+from __future__ import print_function, division
+import os, os.path
+import sqlite3
+import time
+
+##############################################################################
+# schema
+##############################################################################
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clones (
+    output_filename TEXT PRIMARY KEY,
+    clone_path TEXT NOT NULL,
+    n_packets INTEGER NOT NULL DEFAULT 0,
+    n_frames INTEGER NOT NULL DEFAULT 0,
+    last_mtime REAL,
+    last_error TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS packets (
+    output_filename TEXT NOT NULL,
+    packet TEXT NOT NULL,
+    n_frames INTEGER,
+    processed REAL,
+    PRIMARY KEY (output_filename, packet)
+);
+CREATE TABLE IF NOT EXISTS throughput (
+    project TEXT NOT NULL,
+    recorded REAL NOT NULL,
+    input_bytes INTEGER NOT NULL,
+    task_seconds REAL NOT NULL
+);
+"""
+
+class StateDatabase(object):
+    """
+    SQLite (WAL-mode) ledger of processed result packets and per-CLONE progress.
+
+    Rows are keyed by the munged trajectory filename, which is unique per project/RUN/CLONE.
+    Each worker process should open its own StateDatabase on the same file; WAL mode allows
+    concurrent readers alongside a single writer, and writers wait up to `timeout` seconds for the lock.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the SQLite database file; created if it does not exist.
+    timeout : float, optional, default=60.0
+        Time (in seconds) to wait for a database lock held by another process.
+
+    """
+    def __init__(self, filename, timeout=60.0):
+        self.filename = filename
+        self._connection = sqlite3.connect(filename, timeout=timeout, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        """Close the database connection."""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def clone_states(self):
+        """
+        Retrieve the scheduling state of all known CLONEs in a single query.
+
+        Returns
+        -------
+        states : dict of str : (float, str)
+            states[output_filename] is (last_mtime, last_error) for that CLONE.
+
+        """
+        cursor = self._connection.execute('SELECT output_filename, last_mtime, last_error FROM clones')
+        return { output_filename : (last_mtime, last_error) for (output_filename, last_mtime, last_error) in cursor }
+
+    def get_clone(self, output_filename):
+        """
+        Retrieve the recorded progress for a CLONE.
+
+        Parameters
+        ----------
+        output_filename : str
+            Munged trajectory filename for the CLONE
+
+        Returns
+        -------
+        clone : dict or None
+            Dict with keys clone_path, n_packets, n_frames, last_mtime, last_error, updated, or None if unknown.
+
+        """
+        row = self._connection.execute('SELECT clone_path, n_packets, n_frames, last_mtime, last_error, updated FROM clones WHERE output_filename=?', (output_filename,)).fetchone()
+        if row is None:
+            return None
+        keys = ('clone_path', 'n_packets', 'n_frames', 'last_mtime', 'last_error', 'updated')
+        return dict(zip(keys, row))
+
+    def processed_packets(self, output_filename):
+        """
+        Retrieve the set of result packets recorded as processed for a CLONE.
+
+        Parameters
+        ----------
+        output_filename : str
+            Munged trajectory filename for the CLONE
+
+        Returns
+        -------
+        packets : set of str
+            Result packet paths (as stored in the HDF5 `processed_folders` ledger)
+
+        """
+        cursor = self._connection.execute('SELECT packet FROM packets WHERE output_filename=?', (output_filename,))
+        return set(packet for (packet,) in cursor)
+
+    def record_packet(self, output_filename, clone_path, packet, n_frames):
+        """
+        Record that a result packet has been appended to the munged trajectory.
+
+        Parameters
+        ----------
+        output_filename : str
+            Munged trajectory filename for the CLONE
+        clone_path : str
+            Source CLONE directory
+        packet : str
+            Result packet path, as recorded in the HDF5 `processed_folders` ledger
+        n_frames : int
+            Number of frames appended from this packet
+
+        """
+        now = time.time()
+        with self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.execute('INSERT OR REPLACE INTO packets (output_filename, packet, n_frames, processed) VALUES (?,?,?,?)', (output_filename, packet, n_frames, now))
+            self._connection.execute('INSERT OR IGNORE INTO clones (output_filename, clone_path) VALUES (?,?)', (output_filename, clone_path))
+            self._connection.execute('UPDATE clones SET n_packets=n_packets+1, n_frames=n_frames+?, updated=? WHERE output_filename=?', (n_frames, now, output_filename))
+
+    def reconcile_clone(self, output_filename, clone_path, packets, n_frames, last_mtime):
+        """
+        Replace the recorded state of a CLONE with the contents of its munged trajectory.
+
+        This clears any recorded error.
+
+        Parameters
+        ----------
+        output_filename : str
+            Munged trajectory filename for the CLONE
+        clone_path : str
+            Source CLONE directory
+        packets : list of str
+            All result packets listed in the HDF5 `processed_folders` ledger
+        n_frames : int
+            Total number of frames in the munged trajectory
+        last_mtime : float
+            mtime of the CLONE directory observed before its result packets were listed
+
+        """
+        now = time.time()
+        recorded = self.processed_packets(output_filename)
+        packets = set(packets)
+        with self._connection:
+            self._connection.execute('BEGIN')
+            stale = recorded - packets
+            if stale:
+                self._connection.executemany('DELETE FROM packets WHERE output_filename=? AND packet=?', [ (output_filename, packet) for packet in stale ])
+            missing = packets - recorded
+            if missing:
+                self._connection.executemany('INSERT INTO packets (output_filename, packet, n_frames, processed) VALUES (?,?,NULL,?)', [ (output_filename, packet, now) for packet in missing ])
+            self._connection.execute('INSERT OR REPLACE INTO clones (output_filename, clone_path, n_packets, n_frames, last_mtime, last_error, updated) VALUES (?,?,?,?,?,NULL,?)',
+                (output_filename, clone_path, len(packets), n_frames, last_mtime, now))
+
+    def touch_clone(self, output_filename, last_mtime):
+        """
+        Record that a CLONE was examined and found to have no new result packets.
+
+        Parameters
+        ----------
+        output_filename : str
+            Munged trajectory filename for the CLONE
+        last_mtime : float
+            mtime of the CLONE directory observed before its result packets were listed
+
+        """
+        with self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.execute('UPDATE clones SET last_mtime=?, last_error=NULL, updated=? WHERE output_filename=?', (last_mtime, time.time(), output_filename))
+
+    def record_error(self, output_filename, clone_path, error):
+        """
+        Record the last error encountered while processing a CLONE.
+
+        CLONEs with a recorded error are always rescheduled.
+
+        Parameters
+        ----------
+        output_filename : str
+            Munged trajectory filename for the CLONE
+        clone_path : str
+            Source CLONE directory
+        error : str
+            Description of the error
+
+        """
+        with self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.execute('INSERT OR IGNORE INTO clones (output_filename, clone_path) VALUES (?,?)', (output_filename, clone_path))
+            self._connection.execute('UPDATE clones SET last_error=?, updated=? WHERE output_filename=?', (error, time.time(), output_filename))
+
+    def record_throughput(self, project, input_bytes, task_seconds):
+        """
+        Record the work done for a project during one iteration, for estimating future processing time.
+
+        Parameters
+        ----------
+        project : str
+            Project
+        input_bytes : int
+            Bytes of result packets processed (see fahmunge.core21.result_packet_size)
+        task_seconds : float
+            Worker time spent processing them
+
+        """
+        if (input_bytes <= 0) or (task_seconds <= 0):
+            return
+        with self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.execute('INSERT INTO throughput (project, recorded, input_bytes, task_seconds) VALUES (?,?,?,?)', (str(project), time.time(), input_bytes, task_seconds))
+
+    def throughput(self, project=None, n_recent=10):
+        """
+        Estimate recent processing throughput from recorded iterations.
+
+        Parameters
+        ----------
+        project : str, optional, default=None
+            If specified, only consider this project; otherwise consider all projects.
+        n_recent : int, optional, default=10
+            Number of most recent records to consider
+
+        Returns
+        -------
+        bytes_per_second : float or None
+            Throughput per worker, or None if nothing has been recorded
+
+        """
+        if project is None:
+            cursor = self._connection.execute('SELECT input_bytes, task_seconds FROM throughput ORDER BY recorded DESC LIMIT ?', (n_recent,))
+        else:
+            cursor = self._connection.execute('SELECT input_bytes, task_seconds FROM throughput WHERE project=? ORDER BY recorded DESC LIMIT ?', (str(project), n_recent))
+        rows = cursor.fetchall()
+        total_seconds = sum(task_seconds for (input_bytes, task_seconds) in rows)
+        if total_seconds <= 0:
+            return None
+        return sum(input_bytes for (input_bytes, task_seconds) in rows) / total_seconds
+
+def clone_is_unchanged(clone_states, clone_path, output_filename):
+    """
+    Determine from the state database alone whether a CLONE can be skipped this iteration.
+
+    A CLONE is unchanged if it was last processed without error, its munged trajectory
+    still exists, and its directory mtime matches the one recorded before its result
+    packets were last listed (adding or unpacking a result packet updates the directory mtime).
+
+    Parameters
+    ----------
+    clone_states : dict
+        Result of StateDatabase.clone_states()
+    clone_path : str
+        Source CLONE directory
+    output_filename : str
+        Munged trajectory filename for the CLONE
+
+    Returns
+    -------
+    unchanged : bool
+        True if the CLONE does not need to be processed
+
+    """
+    if output_filename not in clone_states:
+        return False
+    (last_mtime, last_error) = clone_states[output_filename]
+    if (last_mtime is None) or (last_error is not None):
+        return False
+    try:
+        mtime = os.stat(clone_path).st_mtime
+    except OSError:
+        return False
+    return (mtime == last_mtime) and os.path.exists(output_filename)
@@ -0,0 +1,27 @@
+from __future__ import print_function
+
+import sys
+import signal
+import shutil
+import tempfile
+
+import pytest
+
+@pytest.fixture
+def tempdir():
+    tempdir = tempfile.mkdtemp()
+    yield tempdir
+    shutil.rmtree(tempdir)
+
+@pytest.fixture
+def munge(monkeypatch):
+    """Return a function that runs munge-fah-data with the given command-line arguments."""
+    from fahmunge import cli
+    handlers = dict((signum, signal.getsignal(signum)) for signum in [signal.SIGINT, signal.SIGTERM])
+    def run(*args):
+        monkeypatch.setattr(sys, 'argv', ['munge-fah-data'] + [ str(arg) for arg in args ])
+        cli.main()
+    yield run
+    # The munger catches signals to stop safely; restore the handlers it replaced
+    for (signum, handler) in handlers.items():
+        signal.signal(signum, handler)
@@ -0,0 +1,228 @@
+"""
+Generate synthetic Folding@home project trees for tests and benchmarks.
+
+Projects follow the layout produced by the FAH work server::
+
+    PROJ<project>/RUN<run>/CLONE<clone>/results0/positions.xtc        (ws9)
+    PROJ<project>/RUN<run>/CLONE<clone>/results-001.tar.bz2           (ws8 and earlier)
+
+Each system consists of a small solute (one atom per residue) solvated by three-site waters,
+so that the usual 'not water' topology selection strips most of the atoms.
+
+"""
+##############################################################################
+# imports
+##############################################################################
+
+from __future__ import print_function, division
+import os, os.path
+import tarfile
+import shutil
+import tempfile
+import collections
+import numpy as np
+import mdtraj as md
+from mdtraj.formats import XTCTrajectoryFile
+
+##############################################################################
+# synthetic projects
+##############################################################################
+
+SyntheticProject = collections.namedtuple('SyntheticProject', ['project', 'location', 'pdb', 'topology_selection', 'n_runs', 'n_clones', 'n_packets', 'n_frames', 'n_atoms'])
+
+def create_topology(n_atoms, n_solute_atoms=None):
+    """
+    Create a solvated system topology.
+
+    Parameters
+    ----------
+    n_atoms : int
+        Approximate total number of atoms; rounded so that the solvent consists of whole waters
+    n_solute_atoms : int, optional, default=None
+        Number of solute atoms (one CA per ALA residue); defaults to 10% of n_atoms
+
+    Returns
+    -------
+    topology : mdtraj.Topology
+        The system topology
+
+    """
+    if n_solute_atoms is None:
+        n_solute_atoms = max(n_atoms // 10, 1)
+    n_waters = max((n_atoms - n_solute_atoms) // 3, 0)
+    topology = md.Topology()
+    chain = topology.add_chain()
+    for index in range(n_solute_atoms):
+        residue = topology.add_residue('ALA', chain)
+        topology.add_atom('CA', md.element.carbon, residue)
+    chain = topology.add_chain()
+    for index in range(n_waters):
+        residue = topology.add_residue('HOH', chain)
+        oxygen = topology.add_atom('O', md.element.oxygen, residue)
+        for name in ['H1', 'H2']:
+            hydrogen = topology.add_atom(name, md.element.hydrogen, residue)
+            topology.add_bond(oxygen, hydrogen)
+    return topology
+
+def write_xtc(filename, n_frames, n_atoms, initial_time=0.0, timestep=1.0, box_length=5.0, random_state=None):
+    """
+    Write an XTC file of random coordinates in a cubic box.
+
+    Parameters
+    ----------
+    filename : str
+        XTC file to write
+    n_frames : int
+        Number of frames
+    n_atoms : int
+        Number of atoms
+    initial_time : float, optional, default=0.0
+        Time (in ps) of the frame preceding the first frame written
+    timestep : float, optional, default=1.0
+        Time (in ps) between frames
+    box_length : float, optional, default=5.0
+        Box edge length (in nm)
+    random_state : numpy.random.RandomState, optional, default=None
+        Source of random coordinates
+
+    """
+    if random_state is None:
+        random_state = np.random.RandomState(0)
+    xyz = (box_length * random_state.rand(n_frames, n_atoms, 3)).astype(np.float32)
+    time = initial_time + timestep * np.arange(1, n_frames+1, dtype=np.float32)
+    step = np.arange(1, n_frames+1, dtype=np.int32)
+    box = np.tile(box_length * np.eye(3, dtype=np.float32), (n_frames, 1, 1))
+    with XTCTrajectoryFile(filename, 'w') as xtc:
+        xtc.write(xyz, time=time, step=step, box=box)
+
+def write_result_packet(clone_path, packet_index, compressed, n_frames, n_atoms, timestep=1.0, random_state=None):
+    """
+    Write a single ws8 (compressed) or ws9 (uncompressed) core21 result packet.
+
+    Parameters
+    ----------
+    clone_path : str
+        CLONE directory
+    packet_index : int
+        Index of the result packet (FRAME number)
+    compressed : bool
+        If True, write ws8-style results-NNN.tar.bz2; otherwise write ws9-style resultsN/
+    n_frames : int
+        Number of frames in the packet
+    n_atoms : int
+        Number of atoms in the system
+    timestep : float, optional, default=1.0
+        Time (in ps) between frames
+    random_state : numpy.random.RandomState, optional, default=None
+        Source of random coordinates
+
+    Returns
+    -------
+    result_packet : str
+        Path to the result packet written
+
+    """
+    initial_time = packet_index * n_frames * timestep
+    if not compressed:
+        result_packet = os.path.join(clone_path, 'results%d' % packet_index)
+        os.makedirs(result_packet)
+        write_xtc(os.path.join(result_packet, 'positions.xtc'), n_frames, n_atoms, initial_time, timestep, random_state=random_state)
+        return result_packet
+
+    result_packet = os.path.join(clone_path, 'results-%03d.tar.bz2' % packet_index)
+    staging_directory = tempfile.mkdtemp()
+    try:
+        write_xtc(os.path.join(staging_directory, 'positions.xtc'), n_frames, n_atoms, initial_time, timestep, random_state=random_state)
+        with open(os.path.join(staging_directory, 'checkpointState.xml'), 'w') as outfile:
+            outfile.write('<State time="%f"/>\n' % (initial_time + n_frames * timestep))
+        with tarfile.open(result_packet, mode='w:bz2') as archive:
+            for filename in ['positions.xtc', 'checkpointState.xml']:
+                archive.add(os.path.join(staging_directory, filename), arcname=filename)
+    finally:
+        shutil.rmtree(staging_directory)
+    return result_packet
+
+def create_project(path, project=10000, n_runs=2, n_clones=2, n_packets=3, n_frames=10, n_atoms=300, n_solute_atoms=None,
+    packet_format='mixed', per_run_topology=False, seed=0):
+    """
+    Create a synthetic core21 FAH project tree.
+
+    Parameters
+    ----------
+    path : str
+        Directory in which to create the project; PROJ<project>/ and topology files are created here
+    project : int, optional, default=10000
+        Project number
+    n_runs : int, optional, default=2
+        Number of RUNs
+    n_clones : int, optional, default=2
+        Number of CLONEs per RUN
+    n_packets : int, optional, default=3
+        Number of result packets per CLONE
+    n_frames : int, optional, default=10
+        Number of frames per result packet
+    n_atoms : int, optional, default=300
+        Approximate number of atoms in the system (see create_topology)
+    n_solute_atoms : int, optional, default=None
+        Number of solute atoms; defaults to 10% of n_atoms
+    packet_format : str, optional, default='mixed'
+        'ws8' writes results-NNN.tar.bz2 archives, 'ws9' writes resultsN directories,
+        and 'mixed' alternates between them starting with ws9
+    per_run_topology : bool, optional, default=False
+        If True, write one PDB per RUN and use a '%(run)d' PDB filename template
+    seed : int, optional, default=0
+        Random seed for coordinates
+
+    Returns
+    -------
+    project : SyntheticProject
+        Description of the project suitable for a projects CSV entry
+
+    """
+    if packet_format not in ['ws8', 'ws9', 'mixed']:
+        raise ValueError("packet_format must be one of 'ws8', 'ws9', or 'mixed'; got '%s'" % packet_format)
+    random_state = np.random.RandomState(seed)
+    topology = create_topology(n_atoms, n_solute_atoms)
+    n_atoms = topology.n_atoms
+    location = os.path.join(path, 'PROJ%d' % project)
+
+    # Write topologies
+    xyz = (5.0 * random_state.rand(1, n_atoms, 3)).astype(np.float32)
+    reference = md.Trajectory(xyz, topology, unitcell_lengths=5.0*np.ones((1,3)), unitcell_angles=90.0*np.ones((1,3)))
+    if per_run_topology:
+        pdb = os.path.join(path, 'p%d' % project, 'RUN%(run)d', 'system.pdb')
+        for run in range(n_runs):
+            os.makedirs(os.path.dirname(pdb % vars()))
+            reference.save_pdb(pdb % vars())
+    else:
+        pdb = os.path.join(path, 'p%d' % project, 'system.pdb')
+        os.makedirs(os.path.dirname(pdb))
+        reference.save_pdb(pdb)
+
+    # Write result packets
+    for run in range(n_runs):
+        for clone in range(n_clones):
+            clone_path = os.path.join(location, 'RUN%d' % run, 'CLONE%d' % clone)
+            os.makedirs(clone_path)
+            for packet_index in range(n_packets):
+                compressed = (packet_format == 'ws8') or ((packet_format == 'mixed') and (packet_index % 2 == 1))
+                write_result_packet(clone_path, packet_index, compressed, n_frames, n_atoms, random_state=random_state)
+
+    return SyntheticProject(project, location, pdb, 'not water', n_runs, n_clones, n_packets, n_frames, n_atoms)
+
+def write_projects_csv(filename, projects):
+    """
+    Write a projects CSV file for munge-fah-data.
+
+    Parameters
+    ----------
+    filename : str
+        CSV file to write
+    projects : list of SyntheticProject
+        Projects to include
+
+    """
+    with open(filename, 'w') as outfile:
+        outfile.write('project,location,pdb,topology_selection\n')
+        for project in projects:
+            outfile.write('"%d","%s","%s","%s"\n' % (project.project, project.location, project.pdb, project.topology_selection))
@@ -0,0 +1,141 @@
+from __future__ import print_function
+
+import os
+import time
+import signal
+import shutil
+import tempfile
+import threading
+from multiprocessing import Pool
+
+from fahmunge import automation, cli, core21
+from fahmunge.tests.synthetic import create_project
+
+def square(x):
+    return x * x
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+def test_iterate_windows():
+    """Test splitting an iterable into windows."""
+    assert list(automation.iterate_windows(iter(range(7)), 3)) == [ [0, 1, 2], [3, 4, 5], [6] ]
+    assert list(automation.iterate_windows(iter([]), 3)) == []
+
+def test_bounded_map():
+    """Test that tasks are drawn lazily, with a bounded number outstanding."""
+    drawn = list()
+    def tasks():
+        for x in range(20):
+            drawn.append(x)
+            yield x
+    pool = Pool(2)
+    try:
+        results = dict()
+        for (task, result, error) in automation.bounded_map(pool, square, tasks(), 3):
+            assert error is None
+            # No more than max_outstanding tasks were drawn beyond those completed
+            assert len(drawn) <= len(results) + 3
+            results[task] = result
+        assert results == dict((x, x * x) for x in range(20))
+        # Once stopped, no further tasks are drawn
+        drawn = list()
+        completed = list(automation.bounded_map(pool, square, tasks(), 3, should_stop=lambda: len(drawn) >= 5))
+        assert len(completed) == len(drawn) == 5
+    finally:
+        pool.close()
+        pool.join()
+
+def test_bounded_map_wakeup():
+    """Test that waiting for tasks is interrupted at the deadline and by the wakeup event, without polling."""
+    pool = Pool(1)
+    try:
+        for wake in ['deadline', 'event']:
+            initial_time = time.time()
+            checks = list()
+            wakeup = threading.Event()
+            stop = threading.Event()
+            def should_stop():
+                checks.append(time.time() - initial_time)
+                return stop.is_set() or ((wake == 'deadline') and (time.time() > initial_time + 0.5))
+            if wake == 'event':
+                # e.g. a signal handler
+                def interrupt():
+                    time.sleep(0.5)
+                    stop.set()
+                    wakeup.set()
+                threading.Thread(target=interrupt).start()
+            completed = list(automation.bounded_map(pool, sleep, iter(lambda: 2.0, None), 1, should_stop=should_stop, wakeup=wakeup, deadline=(initial_time + 0.5) if (wake == 'deadline') else None))
+            # The task in flight is still collected, but stopping was noticed long before it completed
+            assert [ task for (task, result, error) in completed ] == [2.0]
+            assert len(checks) >= 2
+            assert 0.4 < checks[1] < 1.5
+    finally:
+        pool.close()
+        pool.join()
+
+def test_signal_handler():
+    """Test that a caught signal requests termination and wakes anything waiting on it."""
+    handlers = dict((signum, signal.getsignal(signum)) for signum in [signal.SIGINT, signal.SIGTERM])
+    try:
+        signal_handler = core21.SignalHandler()
+        assert not signal_handler.wakeup.wait(0.01)
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert signal_handler.wakeup.wait(5.0)
+        assert signal_handler.terminate
+    finally:
+        for (signum, handler) in handlers.items():
+            signal.signal(signum, handler)
+
+def test_scan_project():
+    """Test finding RUNs with different numbers of CLONEs and missing indices."""
+    project_path = tempfile.mkdtemp()
+    try:
+        for (run, clone) in [ (0, 0), (0, 1), (0, 2), (2, 0), (2, 5), (10, 3) ]:
+            os.makedirs(os.path.join(project_path, 'RUN%d' % run, 'CLONE%d' % clone))
+        # Names that are not RUN/CLONE directories are ignored
+        os.makedirs(os.path.join(project_path, 'RUN0', 'CLONE1-old'))
+        os.makedirs(os.path.join(project_path, 'RUNS'))
+        open(os.path.join(project_path, 'RUN3'), 'w').close()
+        layout = automation.scan_project(project_path)
+        assert layout == [ (0, [0, 1, 2]), (2, [0, 5]), (10, [3]) ]
+        assert automation.get_num_runs_clones(project_path) == (3, 6)
+        assert [ (run, clone) for (run, clone, clone_path, pdb_filename, filenames) in automation.iterate_clones(project_path, 'run%(run)d.pdb', ['out']) ] == [ (0, 0), (0, 1), (0, 2), (2, 0), (2, 5), (10, 3) ]
+        # New RUNs and CLONEs are found on the next scan
+        os.makedirs(os.path.join(project_path, 'RUN2', 'CLONE6'))
+        os.makedirs(os.path.join(project_path, 'RUN4', 'CLONE0'))
+        assert automation.scan_project(project_path) == [ (0, [0, 1, 2]), (2, [0, 5, 6]), (4, [0]), (10, [3]) ]
+    finally:
+        shutil.rmtree(project_path)
+
+def test_batch_clones():
+    """Test grouping CLONEs by project and topology into bounded batches, most costly first."""
+    clones = [ ('RUN%d/CLONE%d' % (run, clone), 'run%d.pdb' % run) for run in range(2) for clone in range(3) ] + [ ('RUN0/CLONE0', 'run0.pdb') ]
+    projects = [10000] * 6 + [10001]
+    costs = [1, 1, 1, 5, 0, 0, 1]
+    (batches, batch_projects) = automation.batch_clones(clones, projects, 2, costs)
+    assert [ [ clone_path for (clone_path, topology_filename) in batch ] for batch in batches ] == [
+        ['RUN1/CLONE0', 'RUN1/CLONE1'], ['RUN0/CLONE0', 'RUN0/CLONE1'], ['RUN0/CLONE2'], ['RUN0/CLONE0'], ['RUN1/CLONE2'] ]
+    assert batch_projects == [10000, 10000, 10000, 10001, 10000]
+    # Without costs, discovery order is preserved
+    (batches, batch_projects) = automation.batch_clones(clones, projects, 3)
+    assert [ len(batch) for batch in batches ] == [3, 3, 1]
+    assert all(len(set(topology_filename for (clone_path, topology_filename) in batch)) == 1 for batch in batches)
+
+def test_worker_reads_topology_once(tempdir, monkeypatch, capsys):
+    """Test that a worker reads the topology shared by a batch of CLONEs only once."""
+    project = create_project(tempdir, n_runs=1, n_clones=3, n_packets=1, n_frames=3, n_atoms=60)
+    batch = [ (os.path.join(project.location, 'RUN0', 'CLONE%d' % clone), project.pdb, [os.path.join(tempdir, 'run0-clone%d.h5' % clone)], [project.topology_selection], [1]) for clone in range(3) ]
+    topology_filenames = list()
+    read_topology_selections = core21.read_topology_selections
+    def read(topology_filename, atom_selection_strings):
+        topology_filenames.append(topology_filename)
+        return read_topology_selections(topology_filename, atom_selection_strings)
+    monkeypatch.setattr(core21, 'read_topology_selections', read)
+    cli.setup_worker(threading.Event(), False, False)
+    records = cli.worker((project.project, batch))
+    assert [ record['packets'] for record in records ] == [1, 1, 1]
+    assert topology_filenames == [project.pdb]
+    # Only the read that actually happened is reported
+    assert capsys.readouterr().out.count('Reading topology') == 1
@@ -0,0 +1,241 @@
+from __future__ import print_function
+
+import os
+import shutil
+
+import numpy as np
+import mdtraj as md
+import pytest
+
+from fahmunge import core21
+from fahmunge.tests.synthetic import create_project
+
+def test_list_core21_result_packets(tempdir):
+    """Test listing of mixed ws8/ws9 result packets in FRAME order."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=4, n_frames=2, n_atoms=30)
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    result_packets = core21.list_core21_result_packets(clone_path)
+    assert [ os.path.basename(packet) for packet in result_packets ] == ['results0', 'results-001.tar.bz2', 'results2', 'results-003.tar.bz2']
+
+def test_process_core21_clone(tempdir):
+    """Test munging a CLONE and appending newly arrived packets."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=3, n_frames=5, n_atoms=60)
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    output_filename = os.path.join(tempdir, 'run0-clone0.h5')
+
+    statistics = core21.process_core21_clone(clone_path, project.pdb, output_filename, project.topology_selection)
+    assert statistics['packets'] == 3
+    assert statistics['frames'] == 15
+    traj = md.load(output_filename)
+    assert traj.n_frames == 15
+    assert traj.n_atoms == 6
+
+    # Reprocessing should not append anything
+    statistics = core21.process_core21_clone(clone_path, project.pdb, output_filename, project.topology_selection)
+    assert statistics['packets'] == 0
+    assert md.load(output_filename).n_frames == 15
+
+def test_iterate_xtc_chunks(tempdir):
+    """Test that raw XTC chunks match the frames mdtraj.load would produce."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=1, n_frames=7, n_atoms=60)
+    xtc_filename = os.path.join(project.location, 'RUN0', 'CLONE0', 'results0', 'positions.xtc')
+    atom_indices = md.load(project.pdb).topology.select(project.topology_selection)
+    chunks = list(core21.iterate_xtc_chunks(xtc_filename, atom_indices=atom_indices, chunksize=3))
+    assert [ len(xyz) for (xyz, times, cell_lengths, cell_angles) in chunks ] == [3, 3, 1]
+    traj = md.load(xtc_filename, top=project.pdb, atom_indices=atom_indices)
+    assert np.allclose(np.concatenate([ chunk[0] for chunk in chunks ]), traj.xyz)
+    assert np.allclose(np.concatenate([ chunk[1] for chunk in chunks ]), traj.time)
+    assert np.allclose(np.concatenate([ chunk[2] for chunk in chunks ]), traj.unitcell_lengths)
+    assert np.allclose(np.concatenate([ chunk[3] for chunk in chunks ]), traj.unitcell_angles)
+
+def test_process_core21_clone_selections(tempdir):
+    """Test writing several atom selections from one pass, including a selection added later."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=3, n_frames=5, n_atoms=60)
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    filenames = [ os.path.join(tempdir, name, 'run0-clone0.h5') for name in ['solute', 'water', 'ca'] ]
+    for filename in filenames:
+        os.makedirs(os.path.dirname(filename))
+    selections = ['not water', 'water and resid 10 to 12', 'name CA and resid 0 to 1']
+
+    statistics = core21.process_core21_clone(clone_path, project.pdb, filenames[:2], selections[:2])
+    assert statistics['packets'] == 3
+    statistics = core21.process_core21_clone(clone_path, project.pdb, filenames, selections)
+    assert statistics['packets'] == 3
+    statistics = core21.process_core21_clone(clone_path, project.pdb, filenames, selections)
+    assert statistics['packets'] == 0
+
+    topology = md.load(project.pdb).topology
+    for (filename, selection) in zip(filenames, selections):
+        atom_indices = topology.select(selection)
+        reference = md.load(os.path.join(clone_path, 'results0', 'positions.xtc'), top=project.pdb, atom_indices=atom_indices)
+        traj = md.load(filename)
+        assert traj.n_frames == 15
+        assert traj.n_atoms == len(atom_indices)
+        assert np.allclose(traj.xyz[:5], reference.xyz)
+
+def test_process_core21_clone_stride(tempdir):
+    """Test that a strided companion trajectory stays globally strided across packets and iterations."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=3, n_frames=5, n_atoms=60, packet_format='ws9')
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    filenames = [ os.path.join(tempdir, 'run0-clone0.h5'), os.path.join(tempdir, 'run0-clone0-stride4.h5') ]
+    selections = [project.topology_selection] * 2
+
+    # Process the first two packets, then the third as if it had just arrived
+    shutil.move(os.path.join(clone_path, 'results2'), os.path.join(tempdir, 'results2'))
+    core21.process_core21_clone(clone_path, project.pdb, filenames, selections, strides=[1, 4])
+    shutil.move(os.path.join(tempdir, 'results2'), os.path.join(clone_path, 'results2'))
+    statistics = core21.process_core21_clone(clone_path, project.pdb, filenames, selections, strides=[1, 4])
+    assert statistics['packets'] == 1
+
+    traj = md.load(filenames[0])
+    strided = md.load(filenames[1])
+    assert traj.n_frames == 15
+    assert strided.n_frames == 4
+    assert np.allclose(strided.xyz, traj.xyz[::4])
+    assert np.allclose(strided.time, traj.time[::4])
+
+def test_atom_count_mismatch(tempdir):
+    """Test that result packets with a different number of atoms than the topology are caught, but truncated ones are not reported as such."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=2, n_frames=2, n_atoms=60)
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    (directory_packet, archive_packet) = core21.list_core21_result_packets(clone_path)
+    topology = md.load(project.pdb).topology
+    topology.add_atom('X', md.element.hydrogen, topology.add_residue('X', topology.add_chain()))
+    for result_packet in [directory_packet, archive_packet]:
+        with pytest.raises(core21.AtomCountMismatch):
+            core21.ensure_result_packet_is_decompressed(result_packet, topology)
+    # Nothing is left behind by the archive that failed
+    assert sorted(os.listdir(clone_path)) == sorted(os.path.basename(packet) for packet in [directory_packet, archive_packet])
+
+    # Truncation and corruption are reported as integrity failures, whatever the topology
+    xtc_filename = os.path.join(directory_packet, 'positions.xtc')
+    with open(xtc_filename, 'rb') as infile:
+        contents = infile.read()
+    for corrupt_contents in [contents[:6], b'\0' * len(contents)]:
+        with open(xtc_filename, 'wb') as outfile:
+            outfile.write(corrupt_contents)
+        with pytest.raises(Exception) as excinfo:
+            core21.ensure_result_packet_is_decompressed(directory_packet, topology)
+        assert not isinstance(excinfo.value, core21.AtomCountMismatch)
+        assert 'integrity' in str(excinfo.value)
+
+def test_scan_xtc_headers(tempdir):
+    """Test structural validation of XTC files from their frame headers."""
+    for n_atoms in [5, 60]:
+        xtc_filename = os.path.join(tempdir, 'positions%d.xtc' % n_atoms)
+        with md.formats.XTCTrajectoryFile(xtc_filename, 'w') as xtc_file:
+            xtc_file.write(np.random.rand(7, n_atoms, 3).astype(np.float32), time=2.0 * np.arange(7) + 10.0)
+        assert core21.scan_xtc_headers(xtc_filename) == (n_atoms, 7, 10.0, 22.0)
+        # Truncation is detected in the coordinates and in the header
+        with open(xtc_filename, 'rb') as infile:
+            contents = infile.read()
+        for size in [len(contents) - 4, 30]:
+            with open(xtc_filename, 'wb') as outfile:
+                outfile.write(contents[:size])
+            with pytest.raises(Exception):
+                core21.scan_xtc_headers(xtc_filename)
+
+def test_truncated_ws9_packet(tempdir, monkeypatch):
+    """Test that a truncated ws9 packet directory is caught from its XTC headers before any of its frames are decoded."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=2, n_frames=5, n_atoms=60, packet_format='ws9')
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    output_filename = os.path.join(tempdir, 'run0-clone0.h5')
+    xtc_filename = os.path.join(clone_path, 'results1', 'positions.xtc')
+    with open(xtc_filename, 'rb') as infile:
+        contents = infile.read()
+    with open(xtc_filename, 'wb') as outfile:
+        outfile.write(contents[:int(0.7 * len(contents))])
+    topology = md.load(project.pdb).topology
+    with pytest.raises(Exception):
+        core21.ensure_result_packet_is_decompressed(os.path.join(clone_path, 'results1'), topology)
+
+    decoded = list()
+    iterate_xtc_chunks = core21.iterate_xtc_chunks
+    def record(xtc_filename, *args, **kwargs):
+        decoded.append(xtc_filename)
+        return iterate_xtc_chunks(xtc_filename, *args, **kwargs)
+    monkeypatch.setattr(core21, 'iterate_xtc_chunks', record)
+    with pytest.raises(Exception):
+        core21.process_core21_clone(clone_path, project.pdb, output_filename, project.topology_selection, chunksize=2)
+    assert decoded == [ os.path.join(clone_path, 'results0', 'positions.xtc') ]
+    assert md.load(output_filename).n_frames == 5
+    assert len(core21.read_processed_packets(output_filename)) == 1
+
+def test_iterate_decompressed_result_packets(tempdir):
+    """Test that prefetched packets are yielded in order and a failure is raised at the packet that failed."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=4, n_frames=2, n_atoms=60, packet_format='ws8')
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    result_packets = core21.list_core21_result_packets(clone_path)
+    with open(result_packets[2], 'wb') as outfile:
+        outfile.write(b'not an archive')
+    topology = md.load(project.pdb).topology
+    unpacked = list()
+    with pytest.raises(Exception):
+        for result_packet in core21.iterate_decompressed_result_packets(result_packets, topology, prefetch=2):
+            unpacked.append(result_packet)
+    assert unpacked == [ os.path.join(clone_path, 'results%d' % index) for index in range(2) ]
+    # Nothing is left behind by the packet that failed
+    assert sorted(os.listdir(clone_path)) == ['results-000.tar.bz2', 'results-001.tar.bz2', 'results-002.tar.bz2', 'results-003.tar.bz2', 'results0', 'results1']
+
+def test_unpack_relative_path(tempdir, monkeypatch):
+    """Test unpacking ahead of the writer for a CLONE given relative to the working directory."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=4, n_frames=5, n_atoms=60, packet_format='ws8')
+    monkeypatch.chdir(tempdir)
+    clone_path = os.path.relpath(os.path.join(project.location, 'RUN0', 'CLONE0'))
+    # Unpacking must not change the working directory of the threads reading packets meanwhile
+    working_directories = list()
+    extract_bz2_archive = core21.extract_bz2_archive
+    def extract(filename, path):
+        working_directories.append(os.getcwd())
+        extract_bz2_archive(filename, path)
+    monkeypatch.setattr(core21, 'extract_bz2_archive', extract)
+
+    statistics = core21.process_core21_clone(clone_path, os.path.relpath(project.pdb), 'run0-clone0.h5', project.topology_selection, prefetch=1)
+    assert statistics['packets'] == 4
+    assert md.load('run0-clone0.h5').n_frames == 20
+    assert working_directories == [ os.getcwd() ] * 4
+    # Time spent unpacking ahead of the writer is merged into the statistics once the CLONE is done
+    assert statistics['decompress_seconds'] > 0
+
+def test_process_core21_clone_rollback(tempdir, monkeypatch):
+    """Test that frames of a packet that fails partway through are discarded, so retries do not duplicate them."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=3, n_frames=5, n_atoms=60, packet_format='ws9')
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    filenames = [ os.path.join(tempdir, 'run0-clone0.h5'), os.path.join(tempdir, 'run0-clone0-stride2.h5') ]
+    selections = [project.topology_selection] * 2
+
+    # Truncate the second packet in the middle of a frame
+    xtc_filename = os.path.join(clone_path, 'results1', 'positions.xtc')
+    with open(xtc_filename, 'rb') as infile:
+        contents = infile.read()
+    with open(xtc_filename, 'wb') as outfile:
+        outfile.write(contents[:int(0.7 * len(contents))])
+    for attempt in range(2):
+        with pytest.raises(Exception):
+            core21.process_core21_clone(clone_path, project.pdb, filenames, selections, strides=[1, 2], chunksize=2)
+        assert md.load(filenames[0]).n_frames == 5
+        assert md.load(filenames[1]).n_frames == 3
+        assert len(core21.read_processed_packets(filenames[0])) == 1
+
+    # Fail while writing the second packet after some of its frames have been appended
+    with open(xtc_filename, 'wb') as outfile:
+        outfile.write(contents)
+    iterate_xtc_chunks = core21.iterate_xtc_chunks
+    def fail_after_first_chunk(*args, **kwargs):
+        chunks = iterate_xtc_chunks(*args, **kwargs)
+        yield next(chunks)
+        raise IOError('simulated failure')
+    monkeypatch.setattr(core21, 'iterate_xtc_chunks', fail_after_first_chunk)
+    with pytest.raises(IOError):
+        core21.process_core21_clone(clone_path, project.pdb, filenames, selections, strides=[1, 2], chunksize=2)
+    assert md.load(filenames[0]).n_frames == 5
+    assert md.load(filenames[1]).n_frames == 3
+    monkeypatch.setattr(core21, 'iterate_xtc_chunks', iterate_xtc_chunks)
+
+    statistics = core21.process_core21_clone(clone_path, project.pdb, filenames, selections, strides=[1, 2], chunksize=2)
+    assert statistics['packets'] == 2
+    traj = md.load(filenames[0])
+    strided = md.load(filenames[1])
+    assert traj.n_frames == 15
+    assert np.allclose(traj.time, np.arange(1, 16))
+    assert np.allclose(strided.xyz, traj.xyz[::2])
@@ -0,0 +1,151 @@
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import mdtraj as md
+import pytest
+
+from mdtraj.formats import XTCTrajectoryFile
+
+from fahmunge import core21, tiered, frameindex
+from fahmunge.tests.synthetic import create_project, write_result_packet
+
+def test_packet_number():
+    """Test parsing FRAME numbers from result packet names."""
+    assert frameindex.packet_number('/data/PROJ1/RUN0/CLONE0/results12') == 12
+    assert frameindex.packet_number('/data/PROJ1/RUN0/CLONE0/results-012.tar.bz2') == 12
+    assert frameindex.packet_number('/data/PROJ1/RUN0/CLONE0/') == -1
+
+def test_frame_index(tempdir):
+    """Test that the frame index records the frames appended from each packet, including strided trajectories."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=4, n_frames=5, n_atoms=60)
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    output_filenames = [ os.path.join(tempdir, 'run0-clone0.h5'), os.path.join(tempdir, 'stride3', 'run0-clone0.h5') ]
+    os.makedirs(os.path.dirname(output_filenames[1]))
+    core21.process_core21_clone(clone_path, project.pdb, output_filenames, [project.topology_selection] * 2, strides=[1, 3])
+
+    frame_index = frameindex.FrameIndex(output_filenames[0])
+    traj = md.load(output_filenames[0])
+    assert len(frame_index) == 4
+    for packet in range(4):
+        assert frame_index.frame_range(packet) == (5 * packet, 5 * packet + 5)
+        assert np.allclose(frame_index.time_range(packet), traj.time[[5 * packet, 5 * packet + 4]])
+    assert frame_index.frame_range(os.path.join(clone_path, 'results2')) == (10, 15)
+    assert frame_index.packet_of_frame(12) == os.path.join(clone_path, 'results2')
+    assert frame_index.packet_of_frame(20) is None
+    with pytest.raises(KeyError):
+        frame_index.frame_range(7)
+    subset = frameindex.load_packet_frames(output_filenames[0], [1, 2])
+    assert np.allclose(subset.xyz, traj.xyz[5:15])
+
+    # Source frames 0, 3, 6, ... are kept across packet boundaries
+    strided_index = frameindex.FrameIndex(output_filenames[1])
+    assert [ strided_index.frame_range(packet) for packet in range(4) ] == [ (0, 2), (2, 4), (4, 5), (5, 7) ]
+    assert strided_index.packet_of_frame(4) == os.path.join(clone_path, 'results2')
+
+    # Packets appended later are indexed after the earlier ones
+    write_result_packet(clone_path, 4, False, 5, project.n_atoms)
+    core21.process_core21_clone(clone_path, project.pdb, output_filenames[0], project.topology_selection)
+    assert frameindex.FrameIndex(output_filenames[0]).frame_range(4) == (20, 25)
+
+@pytest.mark.skipif(not tiered.shared_memory_available(), reason='requires multiprocessing.shared_memory')
+def test_frame_index_tiered(tempdir):
+    """Test that separate decoder and writer pools maintain the same frame index."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=3, n_frames=4, n_atoms=60)
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    output_filename = os.path.join(tempdir, 'run0-clone0.h5')
+    tiered.munge_clones([ (clone_path, project.pdb, output_filename, project.topology_selection) ], [project.project], 1, 1)
+    frame_index = frameindex.FrameIndex(output_filename)
+    assert [ frame_index.frame_range(packet) for packet in range(3) ] == [ (0, 4), (4, 8), (8, 12) ]
+
+def write_packet_frames(clone_path, packet_index, xyz, times):
+    """Write a ws9 result packet with the given frames."""
+    result_packet = os.path.join(clone_path, 'results%d' % packet_index)
+    os.makedirs(result_packet)
+    box = np.tile(5.0 * np.eye(3, dtype=np.float32), (len(xyz), 1, 1))
+    with XTCTrajectoryFile(os.path.join(result_packet, 'positions.xtc'), 'w') as xtc:
+        xtc.write(xyz, time=np.asarray(times, dtype=np.float32), step=np.arange(len(xyz), dtype=np.int32), box=box)
+
+def write_discontinuous_packets(clone_path, n_atoms):
+    """
+    Write packets 1-3 after packet 0 (5 frames at times 1-5 ps).
+
+    Packet 1 repeats the last frame of packet 0 twice before continuing, packet 2 skips 10 ps,
+    and packet 3 restarts from 20 ps.
+    """
+    with XTCTrajectoryFile(os.path.join(clone_path, 'results0', 'positions.xtc'), 'r') as xtc:
+        (xyz, times, step, box) = xtc.read()
+    random_state = np.random.RandomState(1)
+    new_frames = lambda n: (5.0 * random_state.rand(n, n_atoms, 3)).astype(np.float32)
+    write_packet_frames(clone_path, 1, np.concatenate([xyz[-1:], xyz[-1:], new_frames(3)]), [5, 5, 6, 7, 8])
+    write_packet_frames(clone_path, 2, new_frames(3), [19, 20, 21])
+    write_packet_frames(clone_path, 3, new_frames(3), [20, 21, 22])
+
+def test_time_discontinuities(tempdir):
+    """Test that duplicate boundary frames are dropped and gaps and resets in time are flagged."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=1, n_frames=5, n_atoms=60, packet_format='ws9')
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    output_filename = os.path.join(tempdir, 'run0-clone0.h5')
+    core21.process_core21_clone(clone_path, project.pdb, output_filename, project.topology_selection)
+    # Packets appended on a later pass are compared with the last frame on disk; chunks of one frame test dropping across chunks
+    write_discontinuous_packets(clone_path, project.n_atoms)
+    statistics = core21.process_core21_clone(clone_path, project.pdb, output_filename, project.topology_selection, chunksize=1)
+    assert statistics['duplicate_frames'] == 2
+    assert statistics['time_discontinuities'] == 2
+
+    traj = md.load(output_filename)
+    assert np.allclose(traj.time, [1, 2, 3, 4, 5, 6, 7, 8, 19, 20, 21, 20, 21, 22])
+    frame_index = frameindex.FrameIndex(output_filename)
+    assert frame_index.frame_range(1) == (5, 8)
+    assert frame_index.packet_flags(0) == (0, 0)
+    assert frame_index.packet_flags(1) == (frameindex.DUPLICATES_DROPPED, 2)
+    assert frame_index.packet_flags(2) == (frameindex.TIME_GAP, 0)
+    assert frame_index.packet_flags(3) == (frameindex.TIME_RESET, 0)
+    assert [ packet for (packet, flags, n_dropped) in frame_index.discontinuities() ] == [ os.path.join(clone_path, 'results%d' % packet) for packet in [1, 2, 3] ]
+
+@pytest.mark.skipif(not tiered.shared_memory_available(), reason='requires multiprocessing.shared_memory')
+def test_time_discontinuities_tiered(tempdir):
+    """Test that separate decoder and writer pools drop and flag the same frames."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=1, n_frames=5, n_atoms=60, packet_format='ws9')
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    write_discontinuous_packets(clone_path, project.n_atoms)
+    output_filename = os.path.join(tempdir, 'run0-clone0.h5')
+    tiered.munge_clones([ (clone_path, project.pdb, output_filename, project.topology_selection) ], [project.project], 1, 1)
+    assert np.allclose(md.load(output_filename).time, [1, 2, 3, 4, 5, 6, 7, 8, 19, 20, 21, 20, 21, 22])
+    frame_index = frameindex.FrameIndex(output_filename)
+    assert [ frame_index.packet_flags(packet) for packet in range(4) ] == [ (0, 0), (frameindex.DUPLICATES_DROPPED, 2), (frameindex.TIME_GAP, 0), (frameindex.TIME_RESET, 0) ]
+
+@pytest.mark.parametrize('tiered_pools', [False, True])
+def test_time_continuity_mixed_progress(tempdir, tiered_pools):
+    """Test that continuity is checked separately for trajectories appended up to different packets."""
+    if tiered_pools and not tiered.shared_memory_available():
+        pytest.skip('requires multiprocessing.shared_memory')
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=1, n_frames=5, n_atoms=60, packet_format='ws9')
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    output_filenames = [ os.path.join(tempdir, 'run0-clone0.h5'), os.path.join(tempdir, 'run0-clone0-stride2.h5') ]
+    selections = [project.topology_selection] * 2
+    def munge(filenames, strides):
+        if tiered_pools:
+            tiered.munge_clones([ (clone_path, project.pdb, filenames, selections[:len(filenames)], strides) ], [project.project], 1, 1)
+        else:
+            core21.process_core21_clone(clone_path, project.pdb, filenames, selections[:len(filenames)], strides=strides, chunksize=2)
+    munge(output_filenames, [1, 2])
+    # The unstrided trajectory gets ahead of the strided one, which does not store the last frame of packet 0
+    write_discontinuous_packets(clone_path, project.n_atoms)
+    munge(output_filenames[:1], [1])
+    # Packet 4 repeats the last frame of packet 3, and is new to both trajectories
+    with XTCTrajectoryFile(os.path.join(clone_path, 'results3', 'positions.xtc'), 'r') as xtc:
+        (xyz, times, step, box) = xtc.read()
+    write_packet_frames(clone_path, 4, np.concatenate([xyz[-1:], xyz[-1:] + 1.0]), [22, 23])
+    munge(output_filenames, [1, 2])
+
+    traj = md.load(output_filenames[0])
+    strided = md.load(output_filenames[1])
+    assert np.allclose(traj.time, [1, 2, 3, 4, 5, 6, 7, 8, 19, 20, 21, 20, 21, 22, 23])
+    assert np.allclose(strided.time, traj.time[::2])
+    assert np.allclose(strided.xyz, traj.xyz[::2])
+    for filename in output_filenames:
+        frame_index = frameindex.FrameIndex(filename)
+        assert frame_index.packet_flags(1) == (frameindex.DUPLICATES_DROPPED, 2)
+        assert frame_index.packet_flags(4) == (frameindex.DUPLICATES_DROPPED, 1)
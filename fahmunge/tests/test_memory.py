@@ -0,0 +1,42 @@
+from __future__ import print_function
+
+import os
+import threading
+
+import mdtraj as md
+
+from fahmunge import cli, memory
+from fahmunge.tests.synthetic import create_project, write_projects_csv
+
+def test_adaptive_chunksize():
+    """Test that chunk buffers are sized to fit within the memory budget."""
+    assert memory.adaptive_chunksize(1000, None, default_chunksize=7) == 7
+    assert memory.adaptive_chunksize(1000, 36000 * 20) == 5
+    assert memory.adaptive_chunksize(10**9, 10**6) == 1
+    assert memory.adaptive_chunksize(10, 10**12) == 1000
+    assert not memory.exceeds_budget(None)
+    assert memory.exceeds_budget(1)
+
+def test_worker_defers_batch(tempdir):
+    """Test that a worker over its memory budget defers the rest of its batch after the first CLONE."""
+    project = create_project(tempdir, n_runs=1, n_clones=3, n_packets=1, n_frames=3, n_atoms=60)
+    output_filenames = [ os.path.join(tempdir, 'run0-clone%d.h5' % clone) for clone in range(3) ]
+    batch = [ (os.path.join(project.location, 'RUN0', 'CLONE%d' % clone), project.pdb, [output_filenames[clone]], [project.topology_selection], [1]) for clone in range(3) ]
+    cli.setup_worker(threading.Event(), False, False, memory_limit=1)
+    records = cli.worker((project.project, batch))
+    assert [ record['packets'] for record in records ] == [1, 0, 0]
+    assert [ record['memory_exceeded'] for record in records ] == [0, 1, 1]
+    assert [ record['recycles'] for record in records ] == [0, 1, 0]
+    assert [ os.path.exists(filename) for filename in output_filenames ] == [True, False, False]
+
+def test_memory_limit(tempdir, munge):
+    """Test that work deferred by workers exceeding their budget is completed in later iterations."""
+    project = create_project(tempdir, n_runs=1, n_clones=2, n_packets=2, n_frames=3, n_atoms=60)
+    projects_filename = os.path.join(tempdir, 'projects.csv')
+    write_projects_csv(projects_filename, [project])
+    output_path = os.path.join(tempdir, 'munged')
+    # Any worker exceeds a 1 MB budget, so each task appends a single packet
+    munge('--projects', projects_filename, '--outpath', output_path, '--maxits', 5, '--memory-limit', 1, '--batch-size', 2)
+    for clone in range(2):
+        traj = md.load(os.path.join(output_path, str(project.project), 'run0-clone%d.h5' % clone))
+        assert traj.n_frames == project.n_packets * project.n_frames
@@ -0,0 +1,83 @@
+from __future__ import print_function
+
+import os
+import json
+
+from fahmunge import metrics
+from fahmunge.tests.synthetic import create_project, write_projects_csv
+
+def test_metrics_format():
+    """Test per-project counters and gauges in the Prometheus text exposition format."""
+    statistics = metrics.clone_statistics()
+    statistics['packets'] = 2
+    statistics['input_bytes'] = 1000
+    project_metrics = metrics.Metrics()
+    project_metrics.add_clone(10000, statistics)
+    project_metrics.add_clone(10000, statistics)
+    project_metrics.add_clone(10000, None)
+    project_metrics.set_backlog(10001, 5)
+    project_metrics.finish_iteration(12.5)
+    lines = project_metrics.format().splitlines()
+    assert 'fahmunge_packets_total{project="10000"} 4' in lines
+    assert 'fahmunge_input_bytes_total{project="10000"} 2000' in lines
+    # Projects with a backlog are exported before any work completes
+    assert 'fahmunge_packets_total{project="10001"} 0' in lines
+    assert 'fahmunge_backlog_clones{project="10001"} 5' in lines
+    assert 'fahmunge_iterations_total 1' in lines
+    assert 'fahmunge_iteration_duration_seconds 12.5' in lines
+    assert '# TYPE fahmunge_frames_total counter' in lines
+
+def test_metrics_file(tempdir, munge):
+    """Test that --metrics-file exports the work done by each iteration."""
+    project = create_project(tempdir, n_runs=1, n_clones=2, n_packets=2, n_frames=3, n_atoms=60)
+    projects_filename = os.path.join(tempdir, 'projects.csv')
+    write_projects_csv(projects_filename, [project])
+    metrics_directory = os.path.join(tempdir, 'textfiles')
+    os.makedirs(metrics_directory)
+    metrics_filename = os.path.join(metrics_directory, 'munge.prom')
+    munge('--projects', projects_filename, '--outpath', os.path.join(tempdir, 'munged'), '--maxits', 1, '--metrics-file', metrics_filename)
+    lines = open(metrics_filename).read().splitlines()
+    assert 'fahmunge_packets_total{project="10000"} 4' in lines
+    assert 'fahmunge_frames_total{project="10000"} 12' in lines
+    assert 'fahmunge_backlog_clones{project="10000"} 2' in lines
+    assert 'fahmunge_iterations_total 1' in lines
+    # The textfile is renamed into place, leaving no temporary files for the collector to find
+    assert os.listdir(metrics_directory) == ['munge.prom']
+
+def test_iteration_summary():
+    """Test classification of task records into outcomes and their one-line summary."""
+    summary = metrics.IterationSummary(3)
+    appended = metrics.clone_statistics()
+    (appended['packets'], appended['frames']) = (2, 20)
+    failed = metrics.clone_statistics()
+    (failed['failures'], failed['error']) = (1, 'AtomCountMismatch')
+    deferred = metrics.clone_statistics()
+    (deferred['packets'], deferred['memory_exceeded']) = (1, 1)
+    for statistics in [appended, failed, deferred, metrics.clone_statistics(), None]:
+        summary.add(10000, statistics)
+    record = summary.record(4.0)
+    assert record['iteration'] == 3
+    assert record['tasks'] == 4
+    assert record['outcomes'] == { 'appended' : 1, 'failed' : 1, 'deferred' : 1, 'unchanged' : 1 }
+    assert record['errors'] == { 'AtomCountMismatch' : 1 }
+    assert record['totals']['packets'] == record['projects']['10000']['packets'] == 3
+    assert summary.format() == '4 tasks (1 appended, 1 deferred, 1 failed, 1 unchanged); 3 packets, 20 frames, 0.0 MB read, 0.0 MB written; errors: AtomCountMismatch x1'
+
+def test_history_file(tempdir, munge):
+    """Test that --history-file appends a JSON record of each iteration, including failed tasks."""
+    project = create_project(tempdir, n_runs=1, n_clones=2, n_packets=2, n_frames=3, n_atoms=60, packet_format='ws8')
+    with open(os.path.join(project.location, 'RUN0', 'CLONE1', 'results-001.tar.bz2'), 'wb') as outfile:
+        outfile.write(b'not an archive')
+    projects_filename = os.path.join(tempdir, 'projects.csv')
+    write_projects_csv(projects_filename, [project])
+    history_filename = os.path.join(tempdir, 'history.jsonl')
+    munge('--projects', projects_filename, '--outpath', os.path.join(tempdir, 'munged'), '--maxits', 2, '--history-file', history_filename)
+    records = [ json.loads(line) for line in open(history_filename) ]
+    assert [ record['iteration'] for record in records ] == [0, 1]
+    assert records[0]['outcomes'] == { 'appended' : 1, 'failed' : 1 }
+    assert sum(records[0]['errors'].values()) == 1
+    assert records[0]['totals']['packets'] == 2
+    assert records[0]['projects'][str(project.project)]['frames'] == 6
+    # The failed CLONE is quarantined, and the other has nothing new
+    assert records[1]['outcomes'] == { 'unchanged' : 1 }
+    assert records[1]['totals']['packets'] == 0
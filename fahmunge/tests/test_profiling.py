@@ -0,0 +1,46 @@
+from __future__ import print_function
+
+import os
+import pstats
+
+from fahmunge import profiling
+from fahmunge.tests.synthetic import create_project, write_projects_csv
+
+def test_stage_timer():
+    """Test that time spent in repeated stages accumulates into the statistics dict."""
+    statistics = { 'packets' : 1 }
+    timer = profiling.StageTimer(statistics)
+    for index in range(3):
+        with timer.stage('decode'):
+            pass
+    try:
+        with timer.stage('write'):
+            raise ValueError()
+    except ValueError:
+        pass
+    assert statistics['decode_seconds'] >= 0
+    # Stages interrupted by exceptions are still timed
+    assert 'write_seconds' in statistics
+    assert statistics['packets'] == 1
+    # Times accumulated by another thread's timer are merged
+    other = profiling.StageTimer({ 'decode_seconds' : 2.0, 'decompress_seconds' : 1.0 })
+    decode_seconds = statistics['decode_seconds']
+    timer.merge(other)
+    assert statistics['decode_seconds'] == decode_seconds + 2.0
+    assert statistics['decompress_seconds'] == 1.0
+
+def test_profile(tempdir, munge, capsys):
+    """Test that --profile writes a merged per-iteration profile and prints a stage summary."""
+    project = create_project(tempdir, n_runs=1, n_clones=2, n_packets=2, n_frames=3, n_atoms=60)
+    projects_filename = os.path.join(tempdir, 'projects.csv')
+    write_projects_csv(projects_filename, [project])
+    profile_directory = os.path.join(tempdir, 'profiles')
+    os.makedirs(profile_directory)
+    munge('--projects', projects_filename, '--outpath', os.path.join(tempdir, 'munged'), '--maxits', 1, '--profile', '--profile-dir', profile_directory)
+    assert os.listdir(profile_directory) == ['profile-iteration0.prof']
+    stats = pstats.Stats(os.path.join(profile_directory, 'profile-iteration0.prof'))
+    assert any(function_name == 'process_core21_clone' for (filename, line, function_name) in stats.stats)
+    output = capsys.readouterr().out
+    assert 'Stage timing' in output
+    for stage in profiling.STAGES:
+        assert '  %-12s' % stage in output
@@ -0,0 +1,48 @@
+from __future__ import print_function
+
+import os
+import json
+
+from fahmunge import progress
+from fahmunge.tests.synthetic import create_project, write_projects_csv
+
+def test_progress():
+    """Test completion and ETA from worker messages, weighting CLONEs by cost once all are known."""
+    status = progress.Progress(0, interval=3600)
+    status.add('RUN0/CLONE0', 10000, cost=3.0)
+    status.add('RUN0/CLONE1', 10000, cost=1.0)
+    status.add('RUN0/CLONE0', 10000, cost=3.0)
+    status.handle(('packets', 'RUN0/CLONE0', 2, 20, 4000))
+    status.handle(('clone', 'RUN0/CLONE0'))
+    status.handle(('clone', 'RUN0/CLONE0'))
+    # No ETA is estimated until all CLONEs are known
+    assert status.status()['eta_seconds'] is None
+    assert status.format().startswith('Progress: 1/2+ CLONEs (75.0%), 2 packets')
+    status.finish_discovery()
+    record = status.status()
+    assert (record['clones_done'], record['clones_total']) == (1, 2)
+    assert record['fraction_done'] == 0.75
+    assert record['eta_seconds'] is not None
+    assert (record['packets'], record['frames']) == (2, 20)
+    assert record['projects'] == { '10000' : { 'clones_done' : 1, 'clones_total' : 2 } }
+    assert progress.format_duration(3725) == '1:02:05'
+
+def test_status_file(tempdir, munge):
+    """Test that --status-file records the final progress of the iteration."""
+    project = create_project(tempdir, n_runs=1, n_clones=3, n_packets=2, n_frames=3, n_atoms=60)
+    projects_filename = os.path.join(tempdir, 'projects.csv')
+    write_projects_csv(projects_filename, [project])
+    status_directory = os.path.join(tempdir, 'status')
+    os.makedirs(status_directory)
+    status_filename = os.path.join(status_directory, 'status.json')
+    munge('--projects', projects_filename, '--outpath', os.path.join(tempdir, 'munged'), '--maxits', 1, '--status-file', status_filename, '--progress-every', 1)
+    with open(status_filename) as infile:
+        status = json.load(infile)
+    assert status['iteration'] == 0
+    assert status['discovery_complete']
+    assert (status['clones_done'], status['clones_total']) == (3, 3)
+    assert status['fraction_done'] == 1.0
+    assert (status['packets'], status['frames']) == (6, 18)
+    assert status['projects'] == { str(project.project) : { 'clones_done' : 3, 'clones_total' : 3 } }
+    # The status file is renamed into place, leaving no temporary files behind
+    assert os.listdir(status_directory) == ['status.json']
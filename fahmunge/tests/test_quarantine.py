@@ -0,0 +1,41 @@
+from __future__ import print_function
+
+import os
+
+from fahmunge import quarantine
+from fahmunge.metrics import clone_statistics
+
+def test_quarantine(tempdir):
+    """Test that failing CLONEs are quarantined with exponential backoff, persisted, and released after succeeding."""
+    filename = os.path.join(tempdir, 'quarantine.json')
+    clone_path = '/data/PROJ10000/RUN0/CLONE0'
+    failed = clone_statistics()
+    failed['failures'] = 1
+    failed['error'] = 'ReadError'
+
+    clones = quarantine.Quarantine(filename, 60)
+    clones.record(clone_path, failed, now=0)
+    assert clones.is_quarantined(clone_path, now=59)
+    assert not clones.is_quarantined(clone_path, now=60)
+    assert clones.due_for_retry(now=60) == [clone_path]
+    clones.record(clone_path, failed, now=60)
+    assert clones.is_quarantined(clone_path, now=179)
+    assert not clones.is_quarantined(clone_path, now=180)
+    clones.save()
+
+    # The quarantine survives restarts
+    clones = quarantine.Quarantine(filename, 60)
+    assert clones.clones[clone_path]['failures'] == 2
+    assert clones.clones[clone_path]['error'] == 'ReadError'
+
+    # A CLONE cut short by termination stays quarantined; one processed successfully is released
+    terminated = clone_statistics()
+    terminated['terminated'] = 1
+    clones.record(clone_path, terminated, now=180)
+    assert len(clones) == 1
+    clones.record(clone_path, clone_statistics(), now=180)
+    assert len(clones) == 0
+    clones.save()
+    assert quarantine.Quarantine(filename, 60).clones == dict()
+
+    assert quarantine.backoff_seconds(100, 60) == quarantine.MAX_BACKOFF
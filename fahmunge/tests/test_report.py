@@ -0,0 +1,43 @@
+from __future__ import print_function
+
+import os
+import json
+
+import numpy as np
+
+from fahmunge.tests.synthetic import create_project, write_projects_csv, write_result_packet
+
+def test_report(tempdir, munge, capsys):
+    """Test that --report counts pending packets without munging them."""
+    project = create_project(tempdir, n_runs=1, n_clones=2, n_packets=2, n_frames=3, n_atoms=60, packet_format='ws9')
+    projects_filename = os.path.join(tempdir, 'projects.csv')
+    write_projects_csv(projects_filename, [project])
+    output_path = os.path.join(tempdir, 'munged')
+    munge('--projects', projects_filename, '--outpath', output_path, '--maxits', 1)
+
+    # New packets arrive for one CLONE
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE1')
+    random_state = np.random.RandomState(1)
+    write_result_packet(clone_path, 2, False, project.n_frames, project.n_atoms, random_state=random_state)
+    write_result_packet(clone_path, 3, True, project.n_frames, project.n_atoms, random_state=random_state)
+    munged_filenames = sorted(os.path.join(dirpath, filename) for (dirpath, dirnames, filenames) in os.walk(output_path) for filename in filenames)
+    modification_times = [ os.path.getmtime(filename) for filename in munged_filenames ]
+    capsys.readouterr()
+
+    munge('--projects', projects_filename, '--outpath', output_path, '--report', '--json')
+    report = json.loads(capsys.readouterr().out)
+    (backlog,) = report['projects']
+    assert backlog['project'] == str(project.project)
+    assert backlog['n_clones'] == 2
+    assert backlog['n_clones_pending'] == 1
+    assert backlog['pending_packets'] == 2
+    assert backlog['pending_compressed_packets'] == 1
+    assert backlog['pending_compressed_bytes'] == os.path.getsize(os.path.join(clone_path, 'results-003.tar.bz2'))
+    assert backlog['pending_uncompressed_bytes'] > 0
+    assert report['total']['pending_packets'] == 2
+    # Throughput is unknown without a state database
+    assert report['total']['estimated_seconds'] is None
+    # Nothing was munged or unpacked
+    assert sorted(os.path.join(dirpath, filename) for (dirpath, dirnames, filenames) in os.walk(output_path) for filename in filenames) == munged_filenames
+    assert [ os.path.getmtime(filename) for filename in munged_filenames ] == modification_times
+    assert not os.path.exists(os.path.join(clone_path, 'results3'))
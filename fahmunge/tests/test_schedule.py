@@ -0,0 +1,74 @@
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import mdtraj as md
+import tables
+
+from fahmunge import core21, schedule, statedb
+from fahmunge.tests.synthetic import create_project, write_projects_csv, write_result_packet
+
+def test_plan_schedule():
+    """Test longest-processing-time-first ordering and deadline-aware admission."""
+    packet_costs = [ [1.0], [4.0, 4.0], [], [2.0, 1.0], [30.0] ]
+    # Without a deadline, every CLONE is started, most expensive first
+    assert schedule.plan_schedule(packet_costs, 2) == ([4, 1, 3, 0, 2], [])
+    # CLONE 4 cannot finish a packet in time; CLONE 1 is started and stopped between packets
+    (admitted, deferred) = schedule.plan_schedule(packet_costs, 2, remaining=10.0)
+    assert admitted == [1, 3, 0, 2]
+    assert deferred == [4]
+    # With one worker, CLONE 1 occupies it until t=8, leaving no time for CLONE 3's first packet
+    (admitted, deferred) = schedule.plan_schedule(packet_costs, 1, remaining=9.0)
+    assert admitted == [1, 0, 2]
+    assert deferred == [4, 3]
+    # Windows planned one after another queue behind the CLONEs already admitted
+    free = [ 0.0 ]
+    assert schedule.plan_schedule(packet_costs[:2], 1, remaining=9.0, free=free) == ([1, 0], [])
+    assert free == [ 9.0 ]
+    assert schedule.plan_schedule(packet_costs[2:4], 1, remaining=9.0, free=free) == ([0], [1])
+    free = [ 5.0, 0.0 ]
+    assert schedule.plan_schedule([ [2.0, 2.0], [3.0] ], 2, remaining=8.0, free=free) == ([0, 1], [])
+    assert sorted(free) == [ 5.0, 7.0 ]
+
+def test_pending_packet_sizes(tempdir, monkeypatch):
+    """Test estimating pending packets from the directory listing and state database, without opening munged trajectories."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=2, n_frames=3, n_atoms=60, packet_format='ws9')
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    filenames = [ os.path.join(tempdir, 'run0-clone0.h5') ]
+    def sizes(indices):
+        return [ core21.result_packet_size(os.path.join(clone_path, 'results%d' % index)) for index in indices ]
+    assert schedule.pending_packet_sizes(clone_path, filenames) == sizes([0, 1])
+    state_database = statedb.StateDatabase(os.path.join(tempdir, 'state.db'))
+    core21.process_core21_clone(clone_path, project.pdb, filenames, [project.topology_selection], state_database=state_database)
+    write_result_packet(clone_path, 2, False, project.n_frames, project.n_atoms)
+    # Make sure the new packet is newer than the trajectory even on filesystems with coarse timestamps
+    modification_time = os.path.getmtime(filenames[0]) + 10
+    os.utime(os.path.join(clone_path, 'results2'), (modification_time, modification_time))
+
+    def open_file(*args, **kwargs):
+        raise AssertionError('munged trajectories must not be opened')
+    monkeypatch.setattr(tables, 'open_file', open_file)
+    assert schedule.pending_packet_sizes(clone_path, filenames) == sizes([2])
+    assert schedule.pending_packet_sizes(clone_path, filenames, state_database=state_database) == sizes([2])
+    # Packets are pending for a trajectory that does not exist yet, e.g. for a selection added later
+    assert schedule.pending_packet_sizes(clone_path, filenames + [os.path.join(tempdir, 'new.h5')]) == sizes([0, 1, 2])
+
+def test_scheduled_windows(tempdir, munge):
+    """Test munging with a time limit and a state database, which schedules each window of CLONEs."""
+    project = create_project(tempdir, n_runs=2, n_clones=3, n_packets=2, n_frames=3, n_atoms=60)
+    projects_filename = os.path.join(tempdir, 'projects.csv')
+    write_projects_csv(projects_filename, [project])
+    output_path = os.path.join(tempdir, 'munged')
+    statedb_filename = os.path.join(tempdir, 'state.db')
+    # Throughput is learned in the first iteration and used to plan the CLONEs arriving in the second
+    munge('--projects', projects_filename, '--outpath', output_path, '--maxits', 1, '--nprocesses', 2, '--window-size', 2, '--time', 3600, '--statedb', statedb_filename)
+    for run in range(2):
+        for clone in range(3):
+            write_result_packet(os.path.join(project.location, 'RUN%d' % run, 'CLONE%d' % clone), 2, True, project.n_frames, project.n_atoms)
+    munge('--projects', projects_filename, '--outpath', output_path, '--maxits', 1, '--nprocesses', 2, '--window-size', 2, '--time', 3600, '--statedb', statedb_filename)
+    for run in range(2):
+        for clone in range(3):
+            traj = md.load(os.path.join(output_path, str(project.project), 'run%d-clone%d.h5' % (run, clone)))
+            assert traj.n_frames == 3 * project.n_frames
+            assert np.allclose(traj.time, np.arange(1, 3 * project.n_frames + 1))
@@ -0,0 +1,40 @@
+from __future__ import print_function
+
+import os
+import tempfile
+
+from fahmunge.statedb import StateDatabase, clone_is_unchanged
+
+def test_statedb_ledger():
+    """Test recording, reconciling, and skipping CLONEs with the state database."""
+    tempdir = tempfile.mkdtemp()
+    clone_path = os.path.join(tempdir, 'CLONE0')
+    os.makedirs(clone_path)
+    output_filename = os.path.join(tempdir, 'run0-clone0.h5')
+    open(output_filename, 'w').close()
+
+    db = StateDatabase(os.path.join(tempdir, 'state.db'))
+    db.record_packet(output_filename, clone_path, os.path.join(clone_path, 'results0'), 10)
+    db.record_packet(output_filename, clone_path, os.path.join(clone_path, 'results1'), 10)
+    clone = db.get_clone(output_filename)
+    assert clone['n_packets'] == 2
+    assert clone['n_frames'] == 20
+    # No mtime has been recorded yet, so the CLONE must be processed
+    assert not clone_is_unchanged(db.clone_states(), clone_path, output_filename)
+
+    # Reconcile against the trajectory contents, which drop results1
+    mtime = os.stat(clone_path).st_mtime
+    db.reconcile_clone(output_filename, clone_path, [os.path.join(clone_path, 'results0')], 10, mtime)
+    assert db.processed_packets(output_filename) == set([os.path.join(clone_path, 'results0')])
+    assert clone_is_unchanged(db.clone_states(), clone_path, output_filename)
+
+    # Errors force reprocessing
+    db.record_error(output_filename, clone_path, 'Exception: corrupt')
+    assert not clone_is_unchanged(db.clone_states(), clone_path, output_filename)
+    db.touch_clone(output_filename, mtime)
+    assert clone_is_unchanged(db.clone_states(), clone_path, output_filename)
+
+    # A missing trajectory forces reprocessing
+    os.unlink(output_filename)
+    assert not clone_is_unchanged(db.clone_states(), clone_path, output_filename)
+    db.close()
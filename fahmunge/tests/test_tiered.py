@@ -0,0 +1,33 @@
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import mdtraj as md
+import pytest
+
+from fahmunge import core21, tiered
+from fahmunge.tests.synthetic import create_project
+
+@pytest.mark.skipif(not tiered.shared_memory_available(), reason='requires multiprocessing.shared_memory')
+def test_munge_clones(tempdir):
+    """Test that separate decoder and writer pools produce the same trajectory as whole-CLONE processing."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=5, n_frames=4, n_atoms=60)
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    reference_filename = os.path.join(tempdir, 'reference.h5')
+    core21.process_core21_clone(clone_path, project.pdb, reference_filename, project.topology_selection)
+
+    output_filename = os.path.join(tempdir, 'run0-clone0.h5')
+    work_args = (clone_path, project.pdb, output_filename, project.topology_selection)
+    [statistics] = tiered.munge_clones([work_args], [project.project], 1, 2)
+    assert statistics['packets'] == 5
+    assert statistics['frames'] == 20
+    reference = md.load(reference_filename)
+    traj = md.load(output_filename)
+    assert np.allclose(traj.xyz, reference.xyz)
+    assert np.allclose(traj.time, reference.time)
+    assert core21.read_processed_packets(output_filename) == core21.read_processed_packets(reference_filename)
+
+    # Nothing is left to append
+    [statistics] = tiered.munge_clones([work_args], [project.project], 1, 2)
+    assert statistics['packets'] == 0
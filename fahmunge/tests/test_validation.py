@@ -0,0 +1,64 @@
+from __future__ import print_function
+
+import os
+import json
+
+import pandas as pd
+import pytest
+
+from fahmunge import validation
+from fahmunge.tests.synthetic import create_project, write_projects_csv
+
+def test_validate_projects(tempdir, capsys):
+    """Test parallel validation of a projects CSV file, with cached topology validation."""
+    projects = [ create_project(tempdir, project=10000, n_runs=2, n_clones=1, n_packets=1, n_frames=2, n_atoms=60, per_run_topology=True),
+        create_project(tempdir, project=10001, n_runs=1, n_clones=3, n_packets=1, n_frames=2, n_atoms=60) ]
+    projects_filename = os.path.join(tempdir, 'projects.csv')
+    write_projects_csv(projects_filename, projects)
+    cache_filename = os.path.join(tempdir, 'validation-cache.json')
+    # All three topology files have the same contents, so one topology selection is cached
+    validation.validate_projects(pd.read_csv(projects_filename, index_col=0), nprocesses=2, validate_topology_selection=True, cache_filename=cache_filename)
+    with open(cache_filename) as infile:
+        assert len(json.load(infile)['selections']) == 1
+    output = capsys.readouterr().out
+    assert "Project 10001: 1 RUNs 3 CLONEs found" in output
+    assert "(cached)" not in output
+    # Unchanged topologies are not loaded again
+    validation.validate_projects(pd.read_csv(projects_filename, index_col=0), nprocesses=2, validate_topology_selection=True, cache_filename=cache_filename)
+    assert "(cached)" in capsys.readouterr().out
+    # Selections matching no atoms are still caught
+    projects_table = pd.read_csv(projects_filename, index_col=0)
+    projects_table['topology_selection'] = 'resname XYZ'
+    with pytest.raises(Exception):
+        validation.validate_projects(projects_table, nprocesses=2, validate_topology_selection=True, cache_filename=cache_filename)
+
+def test_validate_projects_hashes_changed_topologies(tempdir, capsys, monkeypatch):
+    """Test that topology files are hashed again only when their size or modification time changes."""
+    project = create_project(tempdir, project=10000, n_runs=2, n_clones=1, n_packets=1, n_frames=2, n_atoms=60, per_run_topology=True)
+    projects_filename = os.path.join(tempdir, 'projects.csv')
+    write_projects_csv(projects_filename, [project])
+    cache_filename = os.path.join(tempdir, 'validation-cache.json')
+    validation.validate_projects(pd.read_csv(projects_filename, index_col=0), nprocesses=1, validate_topology_selection=True, cache_filename=cache_filename)
+    with open(cache_filename) as infile:
+        files = json.load(infile)['files']
+    assert len(files) == 2
+    capsys.readouterr()
+    hashed = list()
+    file_hash = validation.file_hash
+    def recording_file_hash(filename):
+        hashed.append(filename)
+        return file_hash(filename)
+    monkeypatch.setattr(validation, 'file_hash', recording_file_hash)
+    # Unchanged topology files are not read
+    validation.validate_projects(pd.read_csv(projects_filename, index_col=0), nprocesses=1, validate_topology_selection=True, cache_filename=cache_filename)
+    assert hashed == []
+    assert "(cached)" in capsys.readouterr().out
+    # A touched topology file is hashed again, but its unchanged contents are not loaded again
+    touched_filename = sorted(files)[0]
+    stat = os.stat(touched_filename)
+    os.utime(touched_filename, (stat.st_atime, stat.st_mtime + 10))
+    validation.validate_projects(pd.read_csv(projects_filename, index_col=0), nprocesses=1, validate_topology_selection=True, cache_filename=cache_filename)
+    assert hashed == [ touched_filename ]
+    output = capsys.readouterr().out
+    assert "(cached)" in output
+    assert "selection '%s' has 60 atoms\n" % project.topology_selection not in output
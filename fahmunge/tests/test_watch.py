@@ -0,0 +1,96 @@
+from __future__ import print_function
+
+import os
+import time
+
+import mdtraj as md
+import pytest
+
+from fahmunge import core21, watch
+from fahmunge.tests.synthetic import create_project
+
+def inotify_available():
+    try:
+        watch.Inotify().close()
+        return True
+    except OSError:
+        return False
+
+@pytest.mark.skipif(not inotify_available(), reason='requires inotify')
+def test_project_watcher(tempdir):
+    """Test that new result packets, CLONEs, and RUNs are reported, and that unrelated files are not."""
+    project_path = os.path.join(tempdir, 'PROJ10000')
+    os.makedirs(os.path.join(project_path, 'RUN0', 'CLONE0'))
+    watcher = watch.ProjectWatcher([project_path], settle_seconds=0.1)
+    try:
+        def wait_for_changes():
+            watcher.wakeup.wait(5)
+            watcher.wakeup.clear()
+            time.sleep(max(0.0, watcher.settle_time() - time.time()))
+            return watcher.collect()
+
+        os.mkdir(os.path.join(project_path, 'RUN0', 'CLONE0', 'results0'))
+        assert wait_for_changes() == (set([os.path.join(project_path, 'RUN0', 'CLONE0')]), False)
+
+        # Archives are reported once written
+        with open(os.path.join(project_path, 'RUN0', 'CLONE0', 'results-001.tar.bz2'), 'w') as outfile:
+            outfile.write('packet')
+        assert wait_for_changes() == (set([os.path.join(project_path, 'RUN0', 'CLONE0')]), False)
+
+        os.makedirs(os.path.join(project_path, 'RUN1', 'CLONE3'))
+        os.mkdir(os.path.join(project_path, 'RUN0', 'CLONE1'))
+        changed_clones = set()
+        while len(changed_clones) < 2 and watcher.wakeup.wait(5):
+            watcher.wakeup.clear()
+            time.sleep(0.2)
+            changed_clones |= watcher.collect()[0]
+        assert changed_clones == set([os.path.join(project_path, 'RUN1', 'CLONE3'), os.path.join(project_path, 'RUN0', 'CLONE1')])
+        watcher.wakeup.clear()
+
+        with open(os.path.join(project_path, 'RUN0', 'CLONE1', 'logfile_01.txt'), 'w') as outfile:
+            outfile.write('log')
+        assert not watcher.wakeup.wait(1)
+        assert not watcher.has_changes()
+    finally:
+        watcher.close()
+
+@pytest.mark.skipif(not inotify_available(), reason='requires inotify')
+def test_project_watcher_settle(tempdir):
+    """Test that a CLONE is collected only once the files of its new packet are no longer being written."""
+    project_path = os.path.join(tempdir, 'PROJ10000')
+    clone_path = os.path.join(project_path, 'RUN0', 'CLONE0')
+    os.makedirs(clone_path)
+    watcher = watch.ProjectWatcher([project_path], settle_seconds=0.5)
+    try:
+        os.mkdir(os.path.join(clone_path, 'results0'))
+        assert watcher.wakeup.wait(5)
+        for index in range(5):
+            with open(os.path.join(clone_path, 'results0', 'positions.xtc'), 'ab') as outfile:
+                outfile.write(b'frame')
+            time.sleep(0.2)
+            assert watcher.has_changes()
+            assert watcher.unsettled_clones() == set([clone_path])
+            assert watcher.collect() == (set(), False)
+        time.sleep(max(0.0, watcher.settle_time() - time.time()))
+        assert watcher.unsettled_clones() == set()
+        assert watcher.collect() == (set([clone_path]), False)
+        assert not watcher.has_changes()
+        assert watcher.settle_time() is None
+    finally:
+        watcher.close()
+
+@pytest.mark.skipif(not inotify_available(), reason='requires inotify')
+def test_project_watcher_ignores_unpacking(tempdir):
+    """Test that packet directories unpacked from archives by the munger are not reported."""
+    project = create_project(tempdir, n_runs=1, n_clones=1, n_packets=2, n_frames=2, n_atoms=60, packet_format='ws8')
+    clone_path = os.path.join(project.location, 'RUN0', 'CLONE0')
+    watcher = watch.ProjectWatcher([project.location], settle_seconds=0.1)
+    try:
+        topology = md.load(project.pdb).topology
+        for result_packet in core21.list_core21_result_packets(clone_path):
+            core21.ensure_result_packet_is_decompressed(result_packet, topology)
+        assert os.path.isdir(os.path.join(clone_path, 'results1'))
+        assert not watcher.wakeup.wait(1)
+        assert not watcher.has_changes()
+    finally:
+        watcher.close()
@@ -0,0 +1,603 @@
+"""
+Two-tier munging: a pool of decoder processes unpacks, verifies, and decodes result packets into
+shared memory blocks, while a pool of writer processes appends them to munged trajectories.
+
+Decompression and XTC decoding are independent for every result packet, so many cores can work on
+the backlog of a single CLONE at once. Appends to a munged trajectory must happen in order, so the
+parent process hands the decoded packets of a CLONE to at most one writer at a time, in FRAME order.
+
+Frames are handed from decoders to writers through multiprocessing.shared_memory (Python 3.8+) rather
+than being pickled through the pool. The writer (or the parent, for packets that are never written)
+unlinks each block once it has been consumed.
+
+"""
+##############################################################################
+# imports
+##############################################################################
+
+from __future__ import print_function, division
+import os, os.path
+import time
+import threading
+import numpy as np
+try:
+    import queue
+except ImportError:
+    import Queue as queue # Python 2
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None # Python < 3.8
+
+from fahmunge import core21
+from fahmunge import frameindex
+from fahmunge.metrics import clone_statistics, accumulate_statistics
+from fahmunge.profiling import StageTimer
+from fahmunge.statedb import StateDatabase
+
+##############################################################################
+# shared memory frame blocks
+##############################################################################
+
+def shared_memory_available():
+    """
+    Return True if multiprocessing.shared_memory is available on this interpreter.
+    """
+    return shared_memory is not None
+
+def _frame_arrays(buffer, n_frames, n_atoms):
+    """
+    Views of the coordinates, times, box lengths, and box angles packed into one float32 buffer.
+    """
+    sizes = [n_frames * n_atoms * 3, n_frames, n_frames * 3, n_frames * 3]
+    offsets = np.cumsum([0] + sizes)
+    data = np.ndarray((offsets[-1],), dtype=np.float32, buffer=buffer)
+    xyz = data[offsets[0]:offsets[1]].reshape(n_frames, n_atoms, 3)
+    times = data[offsets[1]:offsets[2]]
+    cell_lengths = data[offsets[2]:offsets[3]].reshape(n_frames, 3)
+    cell_angles = data[offsets[3]:offsets[4]].reshape(n_frames, 3)
+    return (xyz, times, cell_lengths, cell_angles)
+
+def share_frames(xyz, times, cell_lengths=None, cell_angles=None):
+    """
+    Copy decoded frames into a new shared memory block.
+
+    The block is not tracked by this process, so it survives the process exiting; whoever
+    consumes it must call release_frames().
+
+    Parameters
+    ----------
+    xyz : numpy.ndarray with shape (n_frames, n_atoms, 3)
+        Coordinates
+    times : numpy.ndarray with shape (n_frames,)
+        Simulation times
+    cell_lengths, cell_angles : numpy.ndarray with shape (n_frames, 3), optional, default=None
+        Box lengths and angles, or None if the trajectory has no box
+
+    Returns
+    -------
+    block : dict
+        Descriptor of the block, which can be passed between processes
+
+    """
+    (n_frames, n_atoms) = xyz.shape[0:2]
+    block = dict(name=None, n_frames=n_frames, n_atoms=n_atoms, has_box=(cell_lengths is not None))
+    if n_frames == 0:
+        return block
+    nbytes = 4 * n_frames * (3 * n_atoms + 7)
+    memory = shared_memory.SharedMemory(create=True, size=nbytes)
+    try:
+        resource_tracker.unregister(memory._name, 'shared_memory')
+    except Exception:
+        pass
+    arrays = _frame_arrays(memory.buf, n_frames, n_atoms)
+    arrays[0][:] = xyz
+    arrays[1][:] = times
+    if block['has_box']:
+        arrays[2][:] = cell_lengths
+        arrays[3][:] = cell_angles
+    del arrays
+    memory.close()
+    block['name'] = memory.name
+    return block
+
+def check_shared_frames(block, continuity):
+    """
+    Check the time continuity of the frames in a shared memory block.
+
+    Parameters
+    ----------
+    block : dict
+        Descriptor returned by share_frames()
+    continuity : fahmunge.core21.TimeContinuity
+        Continuity check for a munged trajectory, which is updated with the frames kept
+
+    Returns
+    -------
+    n_duplicates, flags : int
+        As returned by core21.TimeContinuity.check()
+
+    """
+    if block['name'] is None:
+        return (0, 0)
+    memory = shared_memory.SharedMemory(name=block['name'])
+    try:
+        (xyz, times, cell_lengths, cell_angles) = _frame_arrays(memory.buf, block['n_frames'], block['n_atoms'])
+        result = continuity.check(xyz, times)
+        del xyz, times, cell_lengths, cell_angles
+    finally:
+        memory.close()
+    return result
+
+def write_shared_frames(trj_file, block, skip=0, **kwargs):
+    """
+    Append the frames in a shared memory block to an open munged trajectory.
+
+    Parameters
+    ----------
+    trj_file : mdtraj.formats.HDF5TrajectoryFile
+        Open munged trajectory
+    block : dict
+        Descriptor returned by share_frames()
+    skip : int, optional, default=0
+        Number of leading frames not to write (e.g. duplicates found by check_shared_frames())
+    **kwargs
+        Additional arguments passed to core21.append_frames() (subset_indices, stride, source_frames)
+
+    Returns
+    -------
+    n_written : int
+        Number of frames written
+
+    """
+    if block['name'] is None:
+        return 0
+    memory = shared_memory.SharedMemory(name=block['name'])
+    try:
+        (xyz, times, cell_lengths, cell_angles) = (array[skip:] for array in _frame_arrays(memory.buf, block['n_frames'], block['n_atoms']))
+        if not block['has_box']:
+            (cell_lengths, cell_angles) = (None, None)
+        n_written = core21.append_frames(trj_file, xyz, times, cell_lengths, cell_angles, **kwargs)
+        del xyz, times, cell_lengths, cell_angles
+    finally:
+        memory.close()
+    return n_written
+
+def release_frames(block):
+    """
+    Free a shared memory block; it is not an error if it has already been freed.
+
+    Parameters
+    ----------
+    block : dict
+        Descriptor returned by share_frames()
+
+    """
+    if block['name'] is None:
+        return
+    try:
+        memory = shared_memory.SharedMemory(name=block['name'])
+    except (OSError, ValueError):
+        return
+    memory.close()
+    memory.unlink()
+
+##############################################################################
+# decoders
+##############################################################################
+
+_topology_cache = dict()
+
+def cached_topology(topology_filename, atom_selection_strings):
+    """
+    Return core21.read_topology_selections(topology_filename, atom_selection_strings), caching recent topologies in this process.
+    """
+    return core21.cached_topology_selections(topology_filename, atom_selection_strings, _topology_cache)
+
+def setup_decoder(delete_on_unpack, compress_xml, chunksize):
+    global decoder_options
+    decoder_options = dict(delete_on_unpack=delete_on_unpack, compress_xml=compress_xml, chunksize=chunksize)
+    # Let the parent process decide when to stop; a signal should not kill a decoder mid-packet
+    core21.SignalHandler()
+
+def decode_result_packet(task):
+    """
+    Unpack and verify a result packet, then decode the atoms selected by any selection into a shared memory block.
+
+    Parameters
+    ----------
+    task : tuple
+        (result_packet, topology_filename, atom_selection_strings)
+
+    Returns
+    -------
+    result : dict
+        'result_packet' (unpacked packet path), 'block' (shared memory descriptor), 'statistics',
+        and 'error' (None, or a description of the exception that occurred)
+
+    """
+    (result_packet, topology_filename, atom_selection_strings) = task
+    initial_time = time.time()
+    statistics = clone_statistics()
+    timer = StageTimer(statistics)
+    result = dict(result_packet=result_packet, block=None, statistics=statistics, error=None)
+    try:
+        with timer.stage('topology'):
+            (work_unit_topology, atom_indices, selections) = cached_topology(topology_filename, atom_selection_strings)
+        result_packet = core21.ensure_result_packet_is_decompressed(result_packet, work_unit_topology, atom_indices=atom_indices,
+            timer=timer, **decoder_options)
+        xtc_filename = os.path.join(result_packet, 'positions.xtc')
+        statistics['uncompressed_bytes'] += os.path.getsize(xtc_filename)
+        with timer.stage('decode'):
+            for (xyz, times, cell_lengths, cell_angles) in core21.iterate_xtc_chunks(xtc_filename, atom_indices=atom_indices, chunksize=None):
+                result['block'] = share_frames(xyz, times, cell_lengths, cell_angles)
+            if result['block'] is None:
+                result['block'] = share_frames(np.zeros([0, len(atom_indices), 3], np.float32), np.zeros([0], np.float32))
+        result['result_packet'] = result_packet
+    except Exception as e:
+        print("Decoding result packet '%s' failed: %s" % (result_packet, str(e)))
+        result['error'] = '%s: %s' % (e.__class__.__name__, str(e))
+        statistics['error'] = e.__class__.__name__
+    statistics['task_seconds'] = time.time() - initial_time
+    return result
+
+##############################################################################
+# writers
+##############################################################################
+
+def setup_writer(statedb_filename):
+    global writer_state_database
+    writer_state_database = StateDatabase(statedb_filename) if statedb_filename else None
+    core21.SignalHandler()
+
+def write_decoded_packets(task):
+    """
+    Append consecutive decoded result packets to the munged trajectories of a CLONE.
+
+    Every shared memory block in the task is released, whether or not it was written.
+
+    Parameters
+    ----------
+    task : tuple
+        (clone_path, topology_filename, processed_trajectory_filenames, atom_selection_strings, strides, clone_mtime, decoded_packets, complete)
+        where decoded_packets is a list of (result_packet, block) in FRAME order, and complete is True if these
+        are the last pending packets of the CLONE.
+
+    Returns
+    -------
+    statistics : dict
+        Record of the work done (see fahmunge.metrics.clone_statistics()); 'packets' is the number of packets appended
+
+    """
+    (clone_path, topology_filename, processed_trajectory_filenames, atom_selection_strings, strides, clone_mtime, decoded_packets, complete) = task
+    initial_time = time.time()
+    statistics = clone_statistics()
+    timer = StageTimer(statistics)
+    state_database = writer_state_database
+    trj_files = list()
+    initial_sizes = core21.file_sizes(processed_trajectory_filenames)
+    try:
+        with timer.stage('topology'):
+            (work_unit_topology, atom_indices, selections) = cached_topology(topology_filename, atom_selection_strings)
+        for (filename, (subset_indices, trajectory_topology)) in zip(processed_trajectory_filenames, selections):
+            trj_files.append(core21.open_processed_trajectory(filename, trajectory_topology))
+        processed_folders = [ set(core21.read_processed_folders(trj_file)) for trj_file in trj_files ]
+        source_frames = [ core21.read_source_frames(trj_file) for trj_file in trj_files ]
+        continuities = dict() # continuity check of each trajectory, started when its first packet is written
+        for (result_packet, block) in decoded_packets:
+            if len(result_packet) > core21.MAX_FILEPATH_LENGTH:
+                raise Exception("Filename is longer than hard-coded MAX_FILEPATH_LENGTH limit (%d > %d). Increase MAX_FILEPATH_LENGTH and re-install." % (len(result_packet), core21.MAX_FILEPATH_LENGTH))
+            outputs = [ index for (index, folders) in enumerate(processed_folders) if result_packet not in folders ]
+            if outputs:
+                print("   Processing %s" % result_packet)
+            (packet_duplicates, packet_flags) = (0, 0)
+            for index in outputs:
+                # Drop frames repeating the last frame appended to this trajectory, and note any jumps in time
+                if index not in continuities:
+                    continuities[index] = core21.time_continuity(trj_files[index], strides[index], selections[index][0])
+                with timer.stage('verify'):
+                    (n_duplicates, flags) = check_shared_frames(block, continuities[index])
+                (packet_duplicates, packet_flags) = (max(packet_duplicates, n_duplicates), packet_flags | flags)
+                first_frame = core21.count_frames(trj_files[index])
+                mark = core21.mark_trajectory(trj_files[index])
+                try:
+                    with timer.stage('write'):
+                        n_written = write_shared_frames(trj_files[index], block, skip=n_duplicates, subset_indices=selections[index][0], stride=strides[index], source_frames=source_frames[index])
+                    trj_files[index]._handle.root.processed_folders.append([result_packet])
+                    frameindex.append_packet_frames(trj_files[index], result_packet, first_frame, flags=flags, n_dropped=n_duplicates)
+                    if strides[index] > 1:
+                        trj_files[index]._handle.root._v_attrs.source_frames = source_frames[index] + block['n_frames'] - n_duplicates
+                        continuities[index].save(trj_files[index], selections[index][0])
+                except:
+                    # Discard a partially appended packet, which will be appended again when it is retried
+                    core21.truncate_trajectory(trj_files[index], mark)
+                    raise
+                source_frames[index] += block['n_frames'] - n_duplicates
+                if state_database:
+                    trj_files[index].flush()
+                    state_database.record_packet(processed_trajectory_filenames[index], clone_path, result_packet, n_written)
+            if outputs:
+                statistics['frames'] += block['n_frames'] - packet_duplicates
+                if packet_flags:
+                    print("   %s: %s (%d duplicate frames dropped)" % (result_packet, frameindex.describe_flags(packet_flags), packet_duplicates))
+                    statistics['duplicate_frames'] += packet_duplicates
+                    statistics['time_discontinuities'] += int(bool(packet_flags & (frameindex.TIME_GAP | frameindex.TIME_RESET)))
+            release_frames(block)
+            statistics['packets'] += 1
+        if state_database:
+            for (filename, trj_file) in zip(processed_trajectory_filenames, trj_files):
+                state_database.reconcile_clone(filename, clone_path, core21.read_processed_folders(trj_file), core21.count_frames(trj_file), clone_mtime if complete else None)
+    except Exception as e:
+        print("Writing CLONE '%s' failed: %s" % (clone_path, str(e)))
+        statistics['failures'] = 1
+        statistics['error'] = e.__class__.__name__
+        if state_database:
+            for filename in processed_trajectory_filenames:
+                state_database.record_error(filename, clone_path, '%s: %s' % (e.__class__.__name__, str(e)))
+    finally:
+        for trj_file in trj_files:
+            trj_file.close()
+        for (result_packet, block) in decoded_packets:
+            release_frames(block)
+    statistics['output_bytes'] += sum(max(final_size - initial_size, 0) for (initial_size, final_size) in zip(initial_sizes, core21.file_sizes(processed_trajectory_filenames)))
+    statistics['task_seconds'] = time.time() - initial_time
+    return statistics
+
+##############################################################################
+# orchestration
+##############################################################################
+
+def failure_statistics(e, failures=1):
+    """
+    Create the record of a task that raised exception `e` before it could return one.
+    """
+    statistics = clone_statistics()
+    statistics['failures'] = failures
+    statistics['error'] = e.__class__.__name__
+    return statistics
+
+class _CloneSchedule(object):
+    """
+    Progress of one CLONE through the decoder and writer pools.
+    """
+    def __init__(self, project, work_args):
+        self.project = project
+        (self.clone_path, self.topology_filename, processed_trajectory_filename, atom_selection_string) = work_args[:4]
+        strides = work_args[4] if (len(work_args) > 4) else None
+        (self.processed_trajectory_filenames, self.atom_selection_strings, self.strides) = core21.normalize_outputs(processed_trajectory_filename, atom_selection_string, strides)
+        self.clone_mtime = None
+        self.pending_packets = None # result packets still to be appended, planned when first reached
+        self.pending_packet_sizes = None
+        self.n_submitted = 0 # packets handed to decoders
+        self.n_written = 0 # packets appended by writers
+        self.decoded = dict() # packet index : (result_packet, block) awaiting a writer
+        self.writing = False # True if a writer currently owns this CLONE
+        self.failed_index = None # index of the first packet that could not be decoded or written
+        self.statistics = clone_statistics()
+        self.reported = False # True once the CLONE has been reported finished
+
+    def plan(self, state_database=None, reconcile=False):
+        """
+        List the result packets of this CLONE that have not yet been appended to all of its munged trajectories.
+        """
+        clone_path = self.clone_path
+        timer = StageTimer(self.statistics)
+        self.clone_mtime = os.stat(clone_path).st_mtime if os.path.isdir(clone_path) else None
+        with timer.stage('listdir'):
+            result_packets = core21.list_core21_result_packets(clone_path) if os.path.isdir(clone_path) else list()
+            processed_packets = list()
+            for filename in self.processed_trajectory_filenames:
+                if state_database and (not reconcile) and os.path.exists(filename):
+                    processed_packets.append(state_database.processed_packets(filename))
+                else:
+                    processed_packets.append(core21.read_processed_packets(filename))
+        self.pending_packets = [ result_packet for result_packet in result_packets if not all(core21.result_packet_is_processed(result_packet, packets) for packets in processed_packets) ]
+        self.pending_packet_sizes = [ core21.result_packet_size(result_packet) for result_packet in self.pending_packets ]
+        for (result_packet, result_packet_bytes) in zip(self.pending_packets, self.pending_packet_sizes):
+            if not os.path.isdir(result_packet):
+                self.statistics['compressed_bytes'] += result_packet_bytes
+        if state_database and result_packets and (not self.pending_packets):
+            for filename in self.processed_trajectory_filenames:
+                if os.path.exists(filename):
+                    state_database.touch_clone(filename, self.clone_mtime)
+
+    def n_packets(self):
+        """Number of packets that will be attempted this iteration."""
+        return len(self.pending_packets) if (self.failed_index is None) else self.failed_index
+
+def munge_clones(clones_to_process, clone_projects, nwriters, ndecoders, statedb_filename=None, reconcile=False,
+    delete_on_unpack=False, compress_xml=False, chunksize=10, should_terminate=None, max_outstanding=None, wakeup=None, deadline=None, progress=None):
+    """
+    Munge CLONEs with separate decoder and writer pools.
+
+    Parameters
+    ----------
+    clones_to_process : sequence of tuple
+        (clone_path, topology_filename, processed_trajectory_filename, atom_selection_string[, strides]) for each CLONE, where
+        processed_trajectory_filename and atom_selection_string may be lists with one entry per selection
+    clone_projects : sequence of str
+        Project of each CLONE in clones_to_process
+    nwriters : int
+        Number of writer processes; each writes one CLONE at a time
+    ndecoders : int
+        Number of decoder processes
+    statedb_filename : str, optional, default=None
+        If specified, processed packets and CLONE progress are recorded in this state database
+    reconcile : bool, optional, default=False
+        If True, read the processed packets from the munged trajectories rather than the state database
+    delete_on_unpack : bool, optional, default=False
+        If True, will delete old ws8-style .tar.bz2 files after they have been unpacked.
+        WARNING: THIS COULD BE DANGEROUS
+    compress_xml : bool, optional, default=False
+        If True, will compress XML files after unpacking them.
+    chunksize : int, optional, default=10
+        Number of frames to read per chunk when verifying unpacked packets
+    should_terminate : callable, optional, default=None
+        If specified, no new work is started once should_terminate() returns True; work in progress is finished
+    max_outstanding : int, optional, default=None
+        Maximum number of packets being decoded or held in shared memory awaiting a writer.
+        If None, 2 * (ndecoders + nwriters) is used.
+    wakeup : threading.Event, optional, default=None
+        Event set whenever should_terminate() may have changed (e.g. SignalHandler.wakeup); it is also set when a task completes.
+    deadline : float, optional, default=None
+        Time (as returned by time.time()) at which should_terminate() is next checked even if nothing else happens
+    progress : callable, optional, default=None
+        If specified, called with a progress message (see fahmunge.progress) as packets are decoded and written and CLONEs are finished
+
+    Returns
+    -------
+    statistics : list of dict
+        Counters describing the work done for each CLONE in clones_to_process
+
+    """
+    from multiprocessing import Pool
+
+    if not shared_memory_available():
+        raise Exception('Separate decoder processes require multiprocessing.shared_memory (Python 3.8 or later)')
+    if max_outstanding is None:
+        max_outstanding = 2 * (ndecoders + nwriters)
+    state_database = StateDatabase(statedb_filename) if statedb_filename else None
+    schedules = [ _CloneSchedule(project, work_args) for (project, work_args) in zip(clone_projects, clones_to_process) ]
+    events = queue.Queue() # (kind, schedule, packet index, result) posted by pool callbacks
+    if wakeup is None:
+        wakeup = threading.Event()
+
+    def post(event):
+        events.put(event)
+        wakeup.set()
+
+    def report_if_finished(schedule):
+        # A CLONE is finished once every packet it will attempt this iteration has been written
+        if progress and (not schedule.reported) and (schedule.pending_packets is not None) and (not schedule.writing) and (schedule.n_written >= schedule.n_packets()):
+            schedule.reported = True
+            progress(('clone', schedule.clone_path))
+
+    def submit_decode(pool, schedule):
+        packet_index = schedule.n_submitted
+        task = (schedule.pending_packets[packet_index], schedule.topology_filename, schedule.atom_selection_strings)
+        pool.apply_async(decode_result_packet, (task,),
+            callback=lambda result: post(('decoded', schedule, packet_index, result)),
+            error_callback=lambda e: post(('decoded', schedule, packet_index, dict(block=None, statistics=failure_statistics(e, failures=0), error=str(e)))))
+        schedule.n_submitted += 1
+
+    def submit_write(pool, schedule):
+        decoded_packets = list()
+        while (schedule.n_written + len(decoded_packets)) in schedule.decoded:
+            decoded_packets.append(schedule.decoded.pop(schedule.n_written + len(decoded_packets)))
+        if not decoded_packets:
+            return False
+        complete = (schedule.failed_index is None) and (schedule.n_written + len(decoded_packets) == len(schedule.pending_packets))
+        task = (schedule.clone_path, schedule.topology_filename, schedule.processed_trajectory_filenames, schedule.atom_selection_strings, schedule.strides,
+            schedule.clone_mtime, decoded_packets, complete)
+        n_packets = len(decoded_packets)
+        def failed(e):
+            post(('written', schedule, n_packets, failure_statistics(e)))
+        pool.apply_async(write_decoded_packets, (task,), callback=lambda statistics: post(('written', schedule, n_packets, statistics)), error_callback=failed)
+        schedule.writing = True
+        return True
+
+    decoders = Pool(ndecoders, setup_decoder, (delete_on_unpack, compress_xml, chunksize))
+    writers = Pool(nwriters, setup_writer, (statedb_filename,))
+    n_decoding = 0 # packets submitted to decoders whose results have not arrived
+    n_held = 0 # decoded packets held in shared memory awaiting a writer
+    n_writing = 0 # write tasks in progress
+    cursor = 0 # index of the CLONE whose packets are next handed to decoders
+    terminating = False
+    try:
+        while True:
+            if (not terminating) and should_terminate and should_terminate():
+                print('Termination requested; finishing packets in progress...')
+                terminating = True
+
+            # Hand packets to decoders in CLONE and FRAME order, bounding the packets held in memory
+            while (not terminating) and (cursor < len(schedules)) and (n_decoding + n_held < max_outstanding):
+                schedule = schedules[cursor]
+                if schedule.pending_packets is None:
+                    schedule.plan(state_database, reconcile)
+                if schedule.n_submitted >= schedule.n_packets():
+                    report_if_finished(schedule)
+                    cursor += 1
+                    continue
+                submit_decode(decoders, schedule)
+                n_decoding += 1
+
+            if (n_decoding == 0) and (n_writing == 0) and (terminating or cursor >= len(schedules)):
+                break
+
+            try:
+                (kind, schedule, index, result) = events.get_nowait()
+            except queue.Empty:
+                # Sleep until a task completes, a signal is caught, or the deadline passes
+                timeout = None if (terminating or (deadline is None)) else max(0.0, deadline - time.time())
+                wakeup.wait(timeout)
+                wakeup.clear()
+                continue
+
+            if kind == 'decoded':
+                n_decoding -= 1
+                accumulate_statistics(schedule.statistics, result['statistics'])
+                if result['error'] is not None:
+                    if (schedule.failed_index is None) or (index < schedule.failed_index):
+                        if schedule.failed_index is None:
+                            schedule.statistics['failures'] += 1
+                            if state_database:
+                                for filename in schedule.processed_trajectory_filenames:
+                                    state_database.record_error(filename, schedule.clone_path, result['error'])
+                        schedule.failed_index = index
+                    # Packets after the failure will not be written this iteration
+                    for packet_index in [ packet_index for packet_index in schedule.decoded if packet_index > index ]:
+                        release_frames(schedule.decoded.pop(packet_index)[1])
+                        n_held -= 1
+                elif (schedule.failed_index is not None) and (index >= schedule.failed_index):
+                    release_frames(result['block'])
+                else:
+                    schedule.decoded[index] = (result['result_packet'], result['block'])
+                    n_held += 1
+                    if progress:
+                        progress(('packets', schedule.clone_path, 0, 0, result['statistics']['uncompressed_bytes']))
+            elif kind == 'written':
+                # The writer has freed every block in its batch
+                n_writing -= 1
+                n_held -= index
+                schedule.writing = False
+                accumulate_statistics(schedule.statistics, result)
+                schedule.statistics['input_bytes'] += sum(schedule.pending_packet_sizes[schedule.n_written:schedule.n_written+result['packets']])
+                schedule.n_written += result['packets']
+                if progress:
+                    progress(('packets', schedule.clone_path, result['packets'], result['frames'], 0))
+                if result['failures']:
+                    schedule.failed_index = schedule.n_written
+                    for packet_index in list(schedule.decoded):
+                        release_frames(schedule.decoded.pop(packet_index)[1])
+                        n_held -= 1
+
+            # Hand consecutive decoded packets of this CLONE to a writer unless one already owns it
+            if (not terminating) and (not schedule.writing) and submit_write(writers, schedule):
+                n_writing += 1
+            report_if_finished(schedule)
+    finally:
+        decoders.close()
+        writers.close()
+        decoders.join()
+        writers.join()
+        # Free frames that were decoded but never written
+        while True:
+            try:
+                (kind, schedule, index, result) = events.get_nowait()
+            except queue.Empty:
+                break
+            if (kind == 'decoded') and result.get('block'):
+                release_frames(result['block'])
+        for schedule in schedules:
+            for (result_packet, block) in schedule.decoded.values():
+                release_frames(block)
+            schedule.decoded.clear()
+        if state_database:
+            state_database.close()
+
+    # CLONEs left unfinished by termination (rather than failures) will be resumed in a later iteration
+    for schedule in schedules:
+        if terminating and (schedule.failed_index is None) and ((schedule.pending_packets is None) or (schedule.n_written < schedule.n_packets())):
+            schedule.statistics['terminated'] = 1
+
+    return [ schedule.statistics for schedule in schedules ]
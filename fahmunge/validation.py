@@ -0,0 +1,238 @@
+"""
+Validation of the projects CSV file at startup.
+
+Each entry is checked for its data path, its (possibly per-RUN) topology files, and its named
+selections; with topology validation, each topology is loaded and every selection evaluated.
+Entries are scanned in parallel, and topologies are loaded in parallel across all entries. The
+results of loading topologies are cached by the hash of the topology file contents and the
+selection, and the hash of each topology file is cached by its path, size, and modification time,
+so that unchanged topology files are neither loaded nor read again on restart.
+
+"""
+##############################################################################
+# imports
+##############################################################################
+
+from __future__ import print_function, division
+import os, os.path
+import json
+import hashlib
+import tempfile
+import collections
+from multiprocessing import Pool
+
+from fahmunge import automation
+
+##############################################################################
+# validation
+##############################################################################
+
+def file_hash(filename, blocksize=2**20):
+    """
+    Return the SHA-1 hex digest of the contents of a file.
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def cache_key(digest, selection):
+    """
+    Return the validation cache key for a topology with the given hash and a selection.
+    """
+    return '%s:%s' % (digest, selection)
+
+def scan_entry(entry):
+    """
+    Check the data path, topology files, and named selections of one entry of the projects CSV file, without loading topologies.
+
+    Parameters
+    ----------
+    entry : tuple
+        (project, location, pdb, topology_selection)
+
+    Returns
+    -------
+    message : str
+        Line to report for this entry
+    selections : list of str
+        Atom selections of the named selections of the entry
+    pdb_filenames : list of str
+        Topology files of the entry, in RUN order and without duplicates
+
+    Raises
+    ------
+    Exception
+        If the entry is misconfigured
+
+    """
+    (project, location, pdb, topology_selection) = entry
+    # Check project path exists.
+    if not os.path.exists(location):
+        raise Exception("Project %s: Cannot find data path '%s'. Check that you specified the correct location." % (project, location))
+    # Check PDB file(s) exist; atom counts are checked against result packets as they are processed (see core21.verify_result_packet())
+    layout = automation.scan_project(location)
+    n_runs = len(layout)
+    n_clones = sum(len(clones) for (run, clones) in layout)
+    message = "Project %s: %d RUNs %d CLONEs found; topology_selection = '%s'" % (project, n_runs, n_clones, topology_selection)
+    # Check named selections are well-formed
+    try:
+        selections = [ selection for (name, selection) in automation.parse_topology_selections(topology_selection) ]
+    except ValueError as e:
+        raise Exception("Project %s: %s" % (project, str(e)))
+    if '%' in pdb:
+        # perform filename substitution on all RUNs
+        pdb_filenames = list()
+        for (run, clones) in layout:
+            pdb_filename = pdb % vars()
+            if pdb_filename not in pdb_filenames:
+                pdb_filenames.append(pdb_filename)
+    else:
+        pdb_filenames = [ pdb ] # just one filename
+    for pdb_filename in pdb_filenames:
+        if not os.path.exists(pdb_filename):
+            raise Exception("Project %s: PDB filename specified as '%s' but '%s' was not found. Check that you specified the correct path and PDB files are present." % (project, pdb, pdb_filename))
+    return (message, selections, pdb_filenames)
+
+def validate_topology(task):
+    """
+    Load a topology and count the atoms matched by each selection.
+
+    Parameters
+    ----------
+    task : tuple
+        (pdb_filename, selections)
+
+    Returns
+    -------
+    n_atoms : int
+        Number of atoms in the topology
+    n_selected : list of int
+        Number of atoms matched by each selection
+
+    """
+    import mdtraj as md
+    (pdb_filename, selections) = task
+    # TODO: Report on original and stripped atom numbers
+    topology = md.load(pdb_filename).topology
+    return (topology.n_atoms, [ len(topology.select(selection)) for selection in selections ])
+
+def read_cache(cache_filename):
+    """
+    Read the validation cache, returning an empty cache if it does not exist or cannot be read.
+
+    The cache is a dict with 'files', mapping each topology filename to the size, modification time, and
+    hash of its contents when it was last hashed, and 'selections', mapping cache_key(digest, selection)
+    to the number of atoms in the topology and matched by the selection.
+    """
+    if cache_filename and os.path.exists(cache_filename):
+        try:
+            with open(cache_filename) as infile:
+                return json.load(infile)
+        except (IOError, ValueError):
+            pass
+    return dict(files=dict(), selections=dict())
+
+def write_cache(cache_filename, cache):
+    """
+    Atomically write the validation cache.
+    """
+    dirname = os.path.dirname(os.path.abspath(cache_filename))
+    (fd, temporary_filename) = tempfile.mkstemp(dir=dirname, prefix='.fahmunge-', suffix='.json.tmp')
+    try:
+        with os.fdopen(fd, 'w') as outfile:
+            json.dump(cache, outfile, indent=2, sort_keys=True)
+        os.rename(temporary_filename, cache_filename)
+    except Exception:
+        os.unlink(temporary_filename)
+        raise
+
+def validate_projects(projects, nprocesses=1, validate_topology_selection=False, cache_filename=None):
+    """
+    Validate the entries of the projects CSV file in parallel, printing a report for each entry in order.
+
+    Parameters
+    ----------
+    projects : pandas.DataFrame
+        Projects read from the projects CSV file
+    nprocesses : int, optional, default=1
+        Number of entries to scan, and topology files to hash or load, in parallel
+    validate_topology_selection : bool, optional, default=False
+        If True, load each topology and check that every selection matches at least one atom
+    cache_filename : str, optional, default=None
+        If specified, a JSON file caching the results of topology validation (see read_cache())
+
+    Raises
+    ------
+    Exception
+        If an entry is misconfigured
+
+    """
+    cache = read_cache(cache_filename)
+    entries = [ tuple(entry) for entry in projects.itertuples() ]
+    if not validate_topology_selection:
+        # Only entries are scanned
+        nprocesses = min(nprocesses, len(entries))
+    nprocesses = max(1, nprocesses)
+    pool = Pool(nprocesses) if (nprocesses > 1) else None
+    imap = pool.imap if pool else map
+    validated_keys = set() # selections validated by loading topologies during this call
+    cache_changed = False
+    try:
+        scanned_entries = list(imap(scan_entry, entries))
+        if validate_topology_selection:
+            # Hash only topology files whose size or modification time changed since they were last hashed
+            pdb_filenames = list()
+            for (message, selections, entry_pdb_filenames) in scanned_entries:
+                pdb_filenames.extend(filename for filename in entry_pdb_filenames if filename not in pdb_filenames)
+            signatures = dict()
+            for filename in pdb_filenames:
+                stat = os.stat(filename)
+                signatures[filename] = dict(size=stat.st_size, mtime=stat.st_mtime)
+            files = cache['files']
+            changed_filenames = [ filename for filename in pdb_filenames
+                if (filename not in files) or any(files[filename].get(key) != value for (key, value) in signatures[filename].items()) ]
+            for (filename, digest) in zip(changed_filenames, imap(file_hash, changed_filenames)):
+                files[filename] = dict(signatures[filename], digest=digest)
+            cache_changed = len(changed_filenames) > 0
+
+            # Load each distinct topology with selections that have not been validated yet
+            tasks = collections.OrderedDict() # (digest, selections) : pdb_filename
+            for (message, selections, entry_pdb_filenames) in scanned_entries:
+                for filename in entry_pdb_filenames:
+                    digest = files[filename]['digest']
+                    if not all(cache_key(digest, selection) in cache['selections'] for selection in selections):
+                        tasks.setdefault((digest, tuple(selections)), filename)
+            results = imap(validate_topology, [ (filename, list(selections)) for ((digest, selections), filename) in tasks.items() ])
+            for ((digest, selections), (n_atoms, n_selected)) in zip(tasks, results):
+                for (selection, n_selected_atoms) in zip(selections, n_selected):
+                    key = cache_key(digest, selection)
+                    cache['selections'][key] = dict(n_atoms=n_atoms, n_selected=n_selected_atoms)
+                    validated_keys.add(key)
+                    cache_changed = True
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    if cache_filename and cache_changed:
+        write_cache(cache_filename, cache)
+
+    # Report each entry in order
+    for (message, selections, pdb_filenames) in scanned_entries:
+        print(message)
+        if not validate_topology_selection:
+            continue
+        reported_digests = set()
+        for pdb_filename in pdb_filenames:
+            # Topology files with the same contents are reported once
+            digest = cache['files'][pdb_filename]['digest']
+            if digest in reported_digests:
+                continue
+            reported_digests.add(digest)
+            for selection in selections:
+                key = cache_key(digest, selection)
+                result = cache['selections'][key]
+                print("  %s : %d atoms; selection '%s' has %d atoms%s" % (pdb_filename, result['n_atoms'], selection, result['n_selected'], '' if (key in validated_keys) else ' (cached)'))
+                if result['n_selected'] == 0:
+                    raise Exception("topology_selection '%s' matches zero atoms!" % selection)
@@ -0,0 +1,326 @@
+"""
+Watching FAH project trees for new result packets with Linux inotify.
+
+A ProjectWatcher watches every project directory (for new RUNs), RUN directory (for new CLONEs),
+and CLONE directory (for new `resultsN` directories and `results-NNN.tar.bz2` archives), and
+collects the CLONEs that received new result packets so that only those need to be examined.
+A CLONE is only collected once its new packets have settled, i.e. no files have been written
+to them for a while, so that packets are not munged while they are still being written.
+Packet directories that the munger itself unpacks from archives are not reported.
+
+inotify is accessed through ctypes, so no additional packages are required. inotify is not
+available on every platform or filesystem (e.g. NFS does not report changes made by other
+hosts), events can be dropped when the kernel queue overflows, and the number of watches
+is limited by /proc/sys/fs/inotify/max_user_watches; callers should therefore still scan
+all CLONEs periodically.
+
+"""
+##############################################################################
+# imports
+##############################################################################
+
+from __future__ import print_function, division
+import os, os.path
+import re
+import errno
+import select
+import time
+import struct
+import threading
+import ctypes
+import ctypes.util
+from fahmunge.core21 import UNPACK_PREFIX
+
+##############################################################################
+# inotify
+##############################################################################
+
+# Constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+class Inotify(object):
+    """
+    Minimal ctypes wrapper around the Linux inotify API.
+    """
+    def __init__(self):
+        self._libc = _load_libc()
+        if self._libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available on this platform')
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask):
+        """
+        Watch a path, returning its watch descriptor.
+        """
+        encoded_path = path if isinstance(path, bytes) else path.encode('utf-8')
+        wd = self._libc.inotify_add_watch(self.fd, encoded_path, mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def rm_watch(self, wd):
+        """
+        Stop watching the path with the given watch descriptor.
+        """
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        """
+        Wait up to timeout seconds for events, returning a list of (wd, mask, cookie, name).
+        """
+        (readable, writable, exceptional) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return list()
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return list()
+            raise
+        events = list()
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            (wd, mask, cookie, length) = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset+length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+##############################################################################
+# project watcher
+##############################################################################
+
+RUN_PATTERN = re.compile(r'^RUN\d+$')
+CLONE_PATTERN = re.compile(r'^CLONE\d+$')
+RESULT_PACKET_PATTERN = re.compile(r'^results(\d+|-\d+\.tar\.bz2)$')
+
+# Time without writes after which new result packets are considered complete
+SETTLE_SECONDS = 1.0
+
+class ProjectWatcher(object):
+    """
+    Watch FAH project trees for new result packets.
+
+    Events are read by a background thread, which sets `wakeup` whenever a CLONE receives a new
+    result packet or events may have been missed. New packet directories are watched until they
+    settle, so that writes to the files in them postpone collection of their CLONE.
+
+    Parameters
+    ----------
+    project_paths : list of str
+        Paths to FAH project data (containing RUN*/CLONE* directories)
+    wakeup : threading.Event, optional, default=None
+        Event to set when something changes (e.g. SignalHandler.wakeup)
+    settle_seconds : float, optional, default=SETTLE_SECONDS
+        Time without writes to its new result packets after which a CLONE is collected
+
+    Raises
+    ------
+    OSError
+        If inotify is not available
+
+    """
+    def __init__(self, project_paths, wakeup=None, settle_seconds=SETTLE_SECONDS):
+        self._inotify = Inotify()
+        self._watches = dict() # watch descriptor : (kind, path)
+        self._lock = threading.Lock()
+        self._changed_clones = dict() # CLONE path : time its new packets were last written to
+        self._packet_watches = dict() # CLONE path : watch descriptors of its new packet directories
+        self._unpack_cookies = set() # cookies of renames of directories unpacked by the munger
+        self._missed_events = False
+        self.settle_seconds = settle_seconds
+        self.wakeup = wakeup if (wakeup is not None) else threading.Event()
+        for project_path in project_paths:
+            self._watch_project(project_path)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._read_events, name='watch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _add_watch(self, kind, path, mask):
+        try:
+            wd = self._inotify.add_watch(path, mask)
+        except OSError as e:
+            if kind == 'packet':
+                # The packet will settle from the time it was created instead
+                return None
+            # e.g. ENOSPC when max_user_watches is exhausted; rely on full scans
+            if not self._missed_events:
+                print("Cannot watch '%s' (%s); new packets will be found by periodic full scans" % (path, e.strerror))
+            self._missed_events = True
+            return None
+        with self._lock:
+            self._watches[wd] = (kind, path)
+        return wd
+
+    def _subdirectories(self, path, pattern):
+        try:
+            return [ os.path.join(path, name) for name in os.listdir(path) if pattern.match(name) ]
+        except OSError:
+            return list()
+
+    def _watch_project(self, project_path):
+        self._add_watch('project', project_path, IN_CREATE | IN_MOVED_TO | IN_ONLYDIR)
+        for run_path in self._subdirectories(project_path, RUN_PATTERN):
+            self._watch_run(run_path)
+
+    def _watch_run(self, run_path, changed=False):
+        self._add_watch('run', run_path, IN_CREATE | IN_MOVED_TO | IN_ONLYDIR)
+        for clone_path in self._subdirectories(run_path, CLONE_PATTERN):
+            self._watch_clone(clone_path, changed=changed)
+
+    def _watch_clone(self, clone_path, changed=False):
+        self._add_watch('clone', clone_path, IN_CREATE | IN_MOVED_FROM | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ONLYDIR)
+        if changed:
+            # Packets may have arrived before the watch was added
+            self._mark_changed(clone_path)
+
+    def _watch_packet(self, packet_path):
+        clone_path = os.path.normpath(os.path.dirname(packet_path))
+        wd = self._add_watch('packet', packet_path, IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_ONLYDIR)
+        if wd is not None:
+            with self._lock:
+                self._packet_watches.setdefault(clone_path, list()).append(wd)
+        self._mark_changed(clone_path)
+
+    def _mark_changed(self, clone_path):
+        with self._lock:
+            self._changed_clones[os.path.normpath(clone_path)] = time.time()
+        self.wakeup.set()
+
+    def _mark_written(self, clone_path):
+        # Postpone collection of a CLONE whose new packets are still being written
+        with self._lock:
+            if clone_path in self._changed_clones:
+                self._changed_clones[clone_path] = time.time()
+
+    def _read_events(self):
+        while not self._stop.is_set():
+            try:
+                events = self._inotify.read_events(timeout=0.5)
+            except (OSError, ValueError, select.error):
+                break
+            for (wd, mask, cookie, name) in events:
+                if mask & IN_Q_OVERFLOW:
+                    with self._lock:
+                        self._missed_events = True
+                    self.wakeup.set()
+                    continue
+                with self._lock:
+                    (kind, path) = self._watches.get(wd, (None, None))
+                    if mask & IN_IGNORED:
+                        self._watches.pop(wd, None)
+                if kind is None or (mask & IN_IGNORED):
+                    continue
+                is_directory = bool(mask & IN_ISDIR)
+                if (kind == 'project') and is_directory and RUN_PATTERN.match(name):
+                    self._watch_run(os.path.join(path, name), changed=True)
+                elif (kind == 'run') and is_directory and CLONE_PATTERN.match(name):
+                    self._watch_clone(os.path.join(path, name), changed=True)
+                elif (kind == 'clone') and (mask & IN_MOVED_FROM):
+                    if is_directory and name.startswith(UNPACK_PREFIX):
+                        self._unpack_cookies.add(cookie)
+                elif (kind == 'clone') and RESULT_PACKET_PATTERN.match(name):
+                    if (mask & IN_MOVED_TO) and (cookie in self._unpack_cookies):
+                        # Unpacked from an archive by the munger, which has already processed or is processing it
+                        self._unpack_cookies.discard(cookie)
+                    elif is_directory:
+                        # Packet directories are reported when created, but collected only once their files are written
+                        self._watch_packet(os.path.join(path, name))
+                    elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        # Archives are reported once written (or moved into place)
+                        self._mark_changed(path)
+                elif kind == 'packet':
+                    self._mark_written(os.path.normpath(os.path.dirname(path)))
+
+    def has_changes(self):
+        """
+        Return True if any CLONE has received new result packets, or events may have been missed, since they were last collected.
+        """
+        with self._lock:
+            return bool(self._changed_clones) or self._missed_events
+
+    def settle_time(self):
+        """
+        Return the time (as returned by time.time()) at which the first CLONE with new result packets will have settled, or None if there are none.
+        """
+        with self._lock:
+            if not self._changed_clones:
+                return None
+            return min(self._changed_clones.values()) + self.settle_seconds
+
+    def unsettled_clones(self):
+        """
+        Return the normalized paths of CLONEs whose new result packets may still be being written.
+        """
+        settled_time = time.time() - self.settle_seconds
+        with self._lock:
+            return set(clone_path for (clone_path, written_time) in self._changed_clones.items() if written_time > settled_time)
+
+    def collect(self):
+        """
+        Return and forget the CLONEs that received new result packets that have since settled.
+
+        CLONEs whose new packets are still being written are kept until they settle (see settle_time()).
+
+        Returns
+        -------
+        changed_clones : set of str
+            Normalized paths of CLONE directories that received new result packets
+        missed_events : bool
+            True if events may have been missed, in which case all CLONEs should be scanned
+
+        """
+        settled_time = time.time() - self.settle_seconds
+        with self._lock:
+            changed_clones = set(clone_path for (clone_path, written_time) in self._changed_clones.items() if written_time <= settled_time)
+            for clone_path in changed_clones:
+                del self._changed_clones[clone_path]
+            packet_watches = [ wd for clone_path in changed_clones for wd in self._packet_watches.pop(clone_path, list()) ]
+            missed_events = self._missed_events
+            self._missed_events = False
+        # Settled packet directories need no longer be watched
+        for wd in packet_watches:
+            self._inotify.rm_watch(wd)
+        return (changed_clones, missed_events)
+
+    @property
+    def n_watches(self):
+        with self._lock:
+            return len(self._watches)
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        self._stop.set()
+        self._thread.join()
+        self._inotify.close()